@@ -0,0 +1,49 @@
+"""Benchmarks for the Enhydris aggregator.
+
+These are not unit tests; they measure how long various parts of the
+aggregator take. Run them from the directory of Enhydris, in the same way
+as the unit tests, e.g.:
+
+    DJANGO_SETTINGS_MODULE=enhydris.settings \\
+        python -m enhydris_aggregator.benchmarks.writers
+
+Benchmarks that need the database run on a temporary test database, which
+is created and destroyed in the same way as when running the unit tests.
+"""
+
+from contextlib import contextmanager
+import time
+
+import django
+
+
+def setup():
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    from django.db import connection
+    from django.test.utils import (setup_test_environment,
+                                   teardown_test_environment)
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def best_time(func, repeat=3):
+    """Run func repeat times and return the shortest duration in seconds."""
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if result is None or duration < result:
+            result = duration
+    return result
@@ -0,0 +1,175 @@
+"""Time a complete run of the aggregate command against simulated sources.
+
+The sources are served by benchmarks.simulator, with a dataset whose size
+and shape are specified with the options. The run is timed end to end and
+per stage (downloading, transforming, writing and deleting; see
+metrics.Metrics), and the result is stored as a JSON file in the results
+directory, so that runs can be compared, e.g.:
+
+    python -m enhydris_aggregator.benchmarks.aggregate --stations 100000
+    python -m enhydris_aggregator.benchmarks.aggregate --stations 100000 \\
+        --pipeline-depth 0 --compare benchmark-results/SOME-EARLIER-RUN.json
+
+The run is made twice on the same database, so that the second one also
+deletes the objects of the first one.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from . import setup, test_database
+from .simulator import add_dataset_arguments, get_dataset, Simulator
+
+STAGES = ('download_time', 'transform_time', 'wait_time', 'write_time')
+
+
+def get_totals(metrics):
+    """Return the totals of a metrics report over sources and models."""
+    result = {'duration': metrics['duration'], 'delete_time': 0,
+              'objects': 0, 'response_bytes': 0}
+    result.update((stage, 0) for stage in STAGES)
+    for source in metrics['sources']:
+        result['delete_time'] += source['delete_time']
+        for model in source['models'].values():
+            for key in STAGES + ('objects', 'response_bytes'):
+                result[key] += model[key]
+    return result
+
+
+def get_model_totals(metrics):
+    """Return the totals of each model over the sources."""
+    result = {}
+    for source in metrics['sources']:
+        for model_name, model in source['models'].items():
+            totals = result.setdefault(model_name, dict.fromkeys(
+                STAGES + ('objects',), 0))
+            for key in totals:
+                totals[key] += model[key]
+    return result
+
+
+def run(args, config):
+    from django.core.management import call_command
+    from django.test import override_settings
+
+    runs = []
+    for i in range(2):
+        fd, metrics_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            with override_settings(ENHYDRIS_AGGREGATOR=config):
+                start_time = time.perf_counter()
+                call_command('aggregate', force=True, metrics=metrics_file,
+                             batch_size=args.batch_size,
+                             fetch_workers=args.fetch_workers,
+                             pipeline_depth=args.pipeline_depth)
+                duration = time.perf_counter() - start_time
+            with open(metrics_file) as f:
+                metrics = json.load(f)
+        finally:
+            os.unlink(metrics_file)
+        runs.append({'wall_time': duration, 'totals': get_totals(metrics),
+                     'models': get_model_totals(metrics),
+                     'metrics': metrics})
+    return runs
+
+
+def print_runs(runs, previous=None):
+    print('{:24} {:>10} {:>10}{}'.format(
+        'seconds', 'first run', 'second run',
+        '' if previous is None else '   previous (first, second)'))
+    for key in ('wall_time', 'duration', 'delete_time') + STAGES:
+        values = [r['wall_time'] if key == 'wall_time' else r['totals'][key]
+                  for r in runs]
+        line = '{:24} {:10.3f} {:10.3f}'.format(key, *values)
+        if previous is not None:
+            old = [r['wall_time'] if key == 'wall_time'
+                   else r['totals'][key] for r in previous]
+            line += '   {:10.3f} {:10.3f}'.format(*old)
+        print(line)
+    totals = runs[0]['totals']
+    print('{} objects, {:.1f} MiB downloaded, {:.0f} objects/s'.format(
+        totals['objects'], totals['response_bytes'] / 2 ** 20,
+        totals['objects'] / runs[0]['wall_time']))
+    print()
+    print('{:20} {:>9} '.format('model (first run)', 'objects') +
+          ' '.join('{:>10}'.format(x.replace('_time', ''))
+                   for x in STAGES))
+    for model_name, totals in sorted(runs[0]['models'].items()):
+        print('{:20} {:9} '.format(model_name, totals['objects']) +
+              ' '.join('{:10.3f}'.format(totals[x]) for x in STAGES))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    add_dataset_arguments(parser)
+    parser.add_argument('--sources', type=int, default=1,
+                        help='Number of simulated source databases')
+    parser.add_argument('--writer', default='bulk')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--pipeline-depth', type=int, default=4)
+    parser.add_argument('--results-dir', default='benchmark-results',
+                        help='Directory where the results are stored')
+    parser.add_argument('--label', default='',
+                        help='A name for this run, added to the file name')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Show the results of an earlier run, stored in '
+                        'FILE, next to the new ones')
+    args = parser.parse_args()
+
+    setup()
+    import django
+    from django.db import connection
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['runs']
+
+    dataset = get_dataset(args)
+    simulator = Simulator(dataset, args.latency, args.bandwidth)
+    simulator.start()
+    offset = 10 ** len(str(max(dataset.get_count(x) for x in (
+        'Timeseries', 'PoliticalDivision', 'Station'))))
+    config = {
+        'SOURCE_DATABASES': [{'URL': simulator.url, 'ID_OFFSET': (i + 1) *
+                              offset} for i in range(args.sources)],
+        'WRITER': args.writer,
+    }
+    try:
+        with test_database():
+            runs = run(args, config)
+            vendor = connection.vendor
+    finally:
+        simulator.stop()
+
+    print_runs(runs, previous)
+    result = {
+        'started': runs[0]['metrics']['started'],
+        'parameters': dict(vars(args), dataset=dataset.as_dict()),
+        'environment': {
+            'python': sys.version.split()[0],
+            'django': django.get_version(),
+            'database': vendor,
+            'platform': platform.platform(),
+        },
+        'runs': runs,
+    }
+    os.makedirs(args.results_dir, exist_ok=True)
+    filename = os.path.join(args.results_dir, '{}{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S'),
+        '-' + args.label if args.label else ''))
+    with open(filename, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print('\nResults stored in {}'.format(filename))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Measure the speed of ordering.Reorderer on large hierarchies."""
+
+import argparse
+import random
+
+from . import best_time
+from ..ordering import Reorderer
+
+
+def chain(n):
+    """A single chain, with each child served before its parent."""
+    return [{'id': i, 'parent': i - 1 if i else None}
+            for i in reversed(range(n))]
+
+
+def tree(n):
+    """A binary tree, served in random order."""
+    objects = [{'id': i, 'parent': (i - 1) // 2 if i else None}
+               for i in range(n)]
+    random.Random(0).shuffle(objects)
+    return objects
+
+
+def flat(n):
+    """One parent with all the others as its children, served last."""
+    return [{'id': i, 'parent': 0} for i in range(1, n)] + \
+        [{'id': 0, 'parent': None}]
+
+
+def run(objects):
+    for obj in Reorderer().reorder(objects):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for make_objects in (chain, tree, flat):
+        objects = make_objects(args.nodes)
+        duration = best_time(lambda: run(objects), args.repeat)
+        print('{:5} {:8.3f} s {:10.0f} objects/s'.format(
+            make_objects.__name__, duration, args.nodes / duration))
+
+
+if __name__ == '__main__':
+    main()
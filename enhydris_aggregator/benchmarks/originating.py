@@ -0,0 +1,72 @@
+"""Measure the speed of finding the originating database of a time series.
+
+sources.get_originating_url(), which looks up a cached range table, is
+compared with the lookup that the template tag did before
+(legacy_get_originating_url()), which copied and sorted SOURCE_DATABASES
+on every call.
+"""
+
+import argparse
+from copy import deepcopy
+import random
+import sys
+
+from . import best_time, setup
+
+
+def make_source_databases(n):
+    return [{'URL': 'http://source{}.example.com/'.format(i),
+             'ID_OFFSET': (i + 1) * 100000} for i in range(n)]
+
+
+def legacy_get_originating_url(timeseries_id):
+    from django.conf import settings
+    from ..fetch import urljoin
+
+    source_databases = deepcopy(
+        settings.ENHYDRIS_AGGREGATOR['SOURCE_DATABASES'])
+    source_databases.sort(key=lambda x: x['ID_OFFSET'])
+    originating_db = None
+    for i, source_db in enumerate(source_databases):
+        min_id = source_db['ID_OFFSET']
+        try:
+            max_id = source_databases[i + 1]['ID_OFFSET']
+        except IndexError:
+            max_id = sys.maxsize
+        if timeseries_id > min_id and timeseries_id < max_id:
+            originating_db = source_db
+            break
+    original_id = timeseries_id - originating_db['ID_OFFSET']
+    return urljoin(originating_db['URL'], 'timeseries', 'd',
+                   str(original_id) + '/')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sources', type=int, default=20)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+    from django.test import override_settings
+    from ..sources import get_originating_url
+
+    source_databases = make_source_databases(args.sources)
+    ids = [random.randrange(100001, (args.sources + 1) * 100000)
+           for i in range(args.lookups)]
+    ids = [x for x in ids if x % 100000]
+    config = {'SOURCE_DATABASES': source_databases}
+    results = {}
+    with override_settings(ENHYDRIS_AGGREGATOR=config):
+        for name, func in (('legacy', legacy_get_originating_url),
+                           ('bisect', get_originating_url)):
+            results[name] = best_time(
+                lambda: [func(x) for x in ids], args.repeat)
+            print('{:6} {:8.3f} s {:10.0f} lookups/s'.format(
+                name, results[name], len(ids) / results[name]))
+    print('speedup {:.1f}x'.format(results['legacy'] / results['bisect']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Measure the speed of transforming objects with plans.TransformPlan.
+
+The plans are compared with the per-object field introspection that the
+aggregator used before (legacy_transform()).
+"""
+
+import argparse
+
+from . import best_time, setup
+
+
+def make_objects(n):
+    return [{
+        'id': i,
+        'last_modified': '2012-06-12T13:57:56.307020Z',
+        'name': 'Air temperature',
+        'name_alt': 'Θερμοκρασία αέρα',
+        'hidden': False,
+        'precision': 1,
+        'remarks': '',
+        'remarks_alt': '',
+        'nominal_offset_minutes': None,
+        'nominal_offset_months': None,
+        'actual_offset_minutes': 0,
+        'actual_offset_months': 0,
+        'datafile': 'http://some.place.com/some/file',
+        'start_date_utc': '2012-02-01T14:00:00Z',
+        'end_date_utc': '2013-07-06T17:15:00Z',
+        'gentity': 1360,
+        'variable': 5683,
+        'unit_of_measurement': 14,
+        'time_zone': 1,
+        'instrument': None,
+        'time_step': 7,
+        'interval_type': 18,
+    } for i in range(n)]
+
+
+def legacy_transform(model, item, id_offset):
+    from django.db.models import FileField
+
+    many_to_many = {}
+    for key in list(item.keys()):
+        if key in ('original_id', 'original_db', 'is_active',
+                   'last_modified'):
+            del item[key]
+            continue
+        for old_prefix, new_prefix in (
+                ('nominal_offset_', 'timestamp_rounding_'),
+                ('actual_offset_', 'timestamp_offset_')):
+            if key.startswith(old_prefix):
+                new_key = new_prefix + key[len(old_prefix):]
+                item[new_key] = item.pop(key)
+                key = new_key
+        field = model._meta.get_field(key)
+        if field.many_to_one or field.one_to_one:
+            item[key + '_id'] = item.pop(key)
+        if field.many_to_many:
+            many_to_many[key] = [x + id_offset for x in item.pop(key)]
+        field = model._meta.get_field(key)
+        if isinstance(field, FileField):
+            del item[key]
+    for key in item.keys():
+        if (key == 'id' or key.endswith('_id')) and item[key] is not None:
+            item[key] += id_offset
+    return item, many_to_many
+
+
+def run_legacy(model, objects):
+    for item in objects:
+        legacy_transform(model, dict(item), 10000)
+
+
+def run_plans(model, objects):
+    from ..plans import get_plan
+
+    for item in objects:
+        get_plan(model, item).apply(item, 10000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+    from enhydris.hcore import models
+
+    objects = make_objects(args.rows)
+    results = {}
+    for name, func in (('legacy', run_legacy), ('plans', run_plans)):
+        results[name] = best_time(
+            lambda: func(models.Timeseries, objects), args.repeat)
+        print('{:6} {:8.3f} s {:10.0f} rows/s'.format(
+            name, results[name], args.rows / results[name]))
+    print('speedup {:.1f}x'.format(results['legacy'] / results['plans']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+"""A simulated Enhydris API that serves large synthetic datasets.
+
+The server is multi-threaded, like a production web server, and generates
+the objects of each list view as it sends them, so that datasets much
+larger than the memory (e.g. a million stations) can be served. It can
+also delay each response (latency) and limit the rate at which it sends
+data (bandwidth). It can be used on its own, e.g. to try the aggregator
+against it:
+
+    python -m enhydris_aggregator.benchmarks.simulator --stations 100000
+
+The dataset is deterministic: the same parameters produce the same
+objects.
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import random
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+# Size of the chunks in which the response is sent
+CHUNK_SIZE = 64 * 1024
+
+LAST_MODIFIED = '2017-01-01T00:00:00Z'
+
+
+class Dataset:
+    """The parameters of a synthetic source database.
+
+    stations
+        The number of stations. The numbers of the objects that belong to
+        stations (alternative codes, overseers, instruments, events, files
+        and time series) are proportional to it.
+
+    political_depth, political_fanout
+        The political divisions form a tree with the specified depth, in
+        which each division has political_fanout children. The divisions
+        are served children first, so that the aggregator must reorder
+        them.
+
+    links
+        The number of station types of each station, and of variables of
+        each unit of measurement (many-to-many links).
+
+    timeseries_per_station
+        The number of time series of each station.
+    """
+
+    def __init__(self, stations=1000, political_depth=4, political_fanout=4,
+                 links=2, timeseries_per_station=2, seed=42):
+        self.stations = stations
+        self.political_depth = political_depth
+        self.political_fanout = political_fanout
+        self.links = links
+        self.timeseries_per_station = timeseries_per_station
+        self.seed = seed
+        self.lookups = {
+            'GentityAltCodeType': 3, 'FileType': 3, 'EventType': 5,
+            'IntervalType': 5, 'StationType': max(links, 5),
+            'InstrumentType': 10, 'Variable': max(links, 20), 'TimeZone': 3,
+            'TimeStep': 5, 'UnitOfMeasurement': 20, 'Person': 100,
+            'Organization': 50, 'WaterDivision': 10, 'WaterBasin': 100,
+        }
+        self.political_divisions = sum(
+            political_fanout ** i for i in range(political_depth))
+
+        # The models that inherit Gentity or Lentity share the ids of their
+        # ancestor, so each of them gets its own range of ids.
+        self.first_ids = {}
+        for family in (('Person', 'Organization'),
+                       ('PoliticalDivision', 'WaterDivision', 'WaterBasin',
+                        'Station')):
+            first_id = 1
+            for model_name in family:
+                self.first_ids[model_name] = first_id
+                first_id += self.get_count(model_name)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in (
+            'stations', 'political_depth', 'political_fanout', 'links',
+            'timeseries_per_station', 'seed')}
+
+    def id(self, model_name, n):
+        """Return the id of the nth (starting from 1) object of a model."""
+        return self.first_ids.get(model_name, 1) + n - 1
+
+    def random_id(self, model_name, rnd):
+        return self.id(model_name, rnd.randint(1, self.get_count(model_name)))
+
+    def get_count(self, model_name):
+        """Return the number of objects of a model."""
+        if model_name in self.lookups:
+            return self.lookups[model_name]
+        if model_name == 'PoliticalDivision':
+            return self.political_divisions
+        if model_name == 'Timeseries':
+            return self.stations * self.timeseries_per_station
+        if model_name in ('GentityEvent', 'GentityFile'):
+            return self.stations // 10
+        # Station, GentityAltCode, Overseer and Instrument
+        return self.stations
+
+    def iter_objects(self, model_name):
+        """Yield the objects of a model, as the API serves them.
+
+        Raises KeyError if the model is unknown.
+        """
+        make_object = _makers[model_name]
+        rnd = random.Random('{}-{}'.format(self.seed, model_name))
+        numbers = range(1, self.get_count(model_name) + 1)
+        if model_name == 'PoliticalDivision':
+            numbers = reversed(numbers)
+        for n in numbers:
+            obj = make_object(self, n, rnd)
+            obj['id'] = self.id(model_name, n)
+            yield obj
+
+    def political_leaf(self, rnd):
+        leaves = self.political_fanout ** (self.political_depth - 1)
+        return self.id('PoliticalDivision',
+                       self.political_divisions - rnd.randrange(leaves))
+
+
+def _descr(dataset, id, rnd):
+    return {'id': id, 'last_modified': LAST_MODIFIED,
+            'descr': 'Item {}'.format(id), 'descr_alt': 'Αντικείμενο'}
+
+
+def _gentity(name, id):
+    return {'id': id, 'last_modified': LAST_MODIFIED,
+            'name': '{} {}'.format(name, id), 'short_name': '',
+            'remarks': '', 'name_alt': '', 'short_name_alt': '',
+            'remarks_alt': '', 'water_basin': None, 'water_division': None,
+            'political_division': None}
+
+
+def _garea(name, id):
+    return dict(_gentity(name, id), area=None, mpoly=None)
+
+
+def _political_division(dataset, id, rnd):
+    # Breadth-first numbering: the children of n are n * f - f + 2 ... n * f
+    # + 1, so the parent of n is (n + f - 2) // f.
+    f = dataset.political_fanout
+    parent = dataset.id('PoliticalDivision', (id + f - 2) // f)
+    return dict(_garea('Political division', id), code='',
+                parent=parent if id > 1 else None)
+
+
+def _water_division(dataset, id, rnd):
+    return _garea('Water division', id)
+
+
+def _water_basin(dataset, id, rnd):
+    return dict(_garea('Water basin', id), parent=None,
+                water_division=dataset.random_id('WaterDivision', rnd),
+                political_division=dataset.political_leaf(rnd))
+
+
+def _station(dataset, id, rnd):
+    return dict(
+        _gentity('Station', id),
+        srid=4326, approximate=False, altitude=rnd.uniform(0, 2000),
+        asrid=None, point='SRID=4326;POINT ({:.5f} {:.5f})'.format(
+            rnd.uniform(19, 28), rnd.uniform(34, 42)),
+        is_automatic=rnd.random() < 0.5, start_date='2012-02-01',
+        end_date=None, copyright_holder='Someone', copyright_years='2017',
+        water_basin=dataset.random_id('WaterBasin', rnd),
+        water_division=dataset.random_id('WaterDivision', rnd),
+        political_division=dataset.political_leaf(rnd),
+        owner=dataset.random_id('Organization', rnd),
+        stype=rnd.sample(range(1, dataset.lookups['StationType'] + 1),
+                         dataset.links),
+        overseers=[], maintainers=[])
+
+
+def _person(dataset, id, rnd):
+    return {'id': id, 'last_name': 'Person {}'.format(id),
+            'first_name': 'First', 'middle_names': '', 'initials': '',
+            'last_name_alt': '', 'first_name_alt': '',
+            'middle_names_alt': '', 'initials_alt': ''}
+
+
+def _organization(dataset, id, rnd):
+    name = 'Organization {}'.format(id)
+    return {'id': id, 'last_modified': LAST_MODIFIED, 'remarks': '',
+            'remarks_alt': '', 'ordering_string': name, 'name': name,
+            'acronym': '', 'name_alt': '', 'acronym_alt': ''}
+
+
+def _gentity_alt_code(dataset, id, rnd):
+    return {'id': id, 'gentity': dataset.id('Station', id),
+            'type': rnd.randint(1, dataset.lookups['GentityAltCodeType']),
+            'value': 'A{}'.format(id)}
+
+
+def _overseer(dataset, id, rnd):
+    return {'id': id, 'station': dataset.id('Station', id),
+            'person': dataset.random_id('Person', rnd),
+            'is_current': True}
+
+
+def _time_zone(dataset, id, rnd):
+    return {'id': id, 'last_modified': None, 'code': 'TZ{}'.format(id),
+            'utc_offset': 60 * id}
+
+
+def _time_step(dataset, id, rnd):
+    return dict(_descr(dataset, id, rnd), length_minutes=10 * id,
+                length_months=0)
+
+
+def _interval_type(dataset, id, rnd):
+    return dict(_descr(dataset, id, rnd), value='TYPE{}'.format(id))
+
+
+def _unit_of_measurement(dataset, id, rnd):
+    return dict(_descr(dataset, id, rnd), symbol='u{}'.format(id),
+                variables=rnd.sample(
+                    range(1, dataset.lookups['Variable'] + 1),
+                    dataset.links))
+
+
+def _file_type(dataset, id, rnd):
+    return dict(_descr(dataset, id, rnd), mime_type='image/jpeg')
+
+
+def _instrument(dataset, id, rnd):
+    return {'id': id, 'last_modified': LAST_MODIFIED, 'manufacturer': '',
+            'model': '', 'start_date': '2001-04-10', 'end_date': None,
+            'name': 'Instrument {}'.format(id), 'remarks': '',
+            'name_alt': '', 'remarks_alt': '',
+            'station': dataset.id('Station', id),
+            'type': rnd.randint(1, dataset.lookups['InstrumentType'])}
+
+
+def _gentity_event(dataset, id, rnd):
+    return {'id': id, 'last_modified': LAST_MODIFIED, 'date': '2012-04-28',
+            'user': 'someone', 'report': 'Malfunction', 'report_alt': '',
+            'gentity': dataset.random_id('Station', rnd),
+            'type': rnd.randint(1, dataset.lookups['EventType'])}
+
+
+def _gentity_file(dataset, id, rnd):
+    return {'id': id, 'last_modified': LAST_MODIFIED, 'date': None,
+            'content': 'http://example.com/{}.jpg'.format(id),
+            'descr': 'Photo', 'remarks': '', 'descr_alt': '',
+            'remarks_alt': '', 'gentity': dataset.random_id('Station', rnd),
+            'file_type': rnd.randint(1, dataset.lookups['FileType'])}
+
+
+def _timeseries(dataset, id, rnd):
+    station = (id - 1) // dataset.timeseries_per_station + 1
+    return {'id': id, 'last_modified': LAST_MODIFIED,
+            'name': 'Time series {}'.format(id), 'name_alt': '',
+            'hidden': False, 'precision': 1, 'remarks': '', 'remarks_alt': '',
+            'timestamp_rounding_minutes': None,
+            'timestamp_rounding_months': None, 'timestamp_offset_minutes': 0,
+            'timestamp_offset_months': 0,
+            'datafile': 'http://example.com/{}'.format(id),
+            'start_date_utc': '2012-02-01T14:00:00Z',
+            'end_date_utc': '2013-07-06T17:15:00Z',
+            'gentity': dataset.id('Station', station),
+            'variable': rnd.randint(1, dataset.lookups['Variable']),
+            'unit_of_measurement': rnd.randint(
+                1, dataset.lookups['UnitOfMeasurement']),
+            'time_zone': rnd.randint(1, dataset.lookups['TimeZone']),
+            'instrument': station,
+            'time_step': rnd.randint(1, dataset.lookups['TimeStep']),
+            'interval_type': rnd.randint(1, dataset.lookups['IntervalType'])}
+
+
+_makers = {
+    'GentityAltCodeType': _descr, 'FileType': _file_type,
+    'EventType': _descr, 'IntervalType': _interval_type,
+    'StationType': _descr, 'InstrumentType': _descr, 'Variable': _descr,
+    'TimeZone': _time_zone, 'TimeStep': _time_step,
+    'UnitOfMeasurement': _unit_of_measurement, 'Person': _person,
+    'Organization': _organization, 'PoliticalDivision': _political_division,
+    'WaterDivision': _water_division, 'WaterBasin': _water_basin,
+    'Station': _station, 'GentityAltCode': _gentity_alt_code,
+    'GentityFile': _gentity_file, 'GentityEvent': _gentity_event,
+    'Overseer': _overseer, 'Instrument': _instrument,
+    'Timeseries': _timeseries,
+}
+
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        # The list views are /api/ModelName/
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'api' or \
+                parts[1] not in _makers:
+            self.send_error(404)
+            return
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.end_headers()
+        self.send_chunks(self.iter_chunks(parts[1]))
+
+    def iter_chunks(self, model_name):
+        chunk = ['[']
+        size = 1
+        separator = ''
+        for item in self.server.dataset.iter_objects(model_name):
+            s = separator + json.dumps(item)
+            separator = ','
+            chunk.append(s)
+            size += len(s)
+            if size >= CHUNK_SIZE:
+                yield ''.join(chunk).encode('utf-8')
+                chunk = []
+                size = 0
+        chunk.append(']')
+        yield ''.join(chunk).encode('utf-8')
+
+    def send_chunks(self, chunks):
+        bandwidth = self.server.bandwidth
+        start_time = time.perf_counter()
+        sent = 0
+        for chunk in chunks:
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                delay = sent / bandwidth - (time.perf_counter() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Simulator(ThreadingMixIn, HTTPServer):
+    """A multi-threaded HTTP server that serves a Dataset.
+
+    latency is the delay before each response in seconds, and bandwidth
+    the maximum rate of each response in bytes per second (None for no
+    limit).
+    """
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, dataset, latency=0, bandwidth=None, port=0):
+        super().__init__(('localhost', port), SimulatorRequestHandler)
+        self.dataset = dataset
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    @property
+    def url(self):
+        return 'http://localhost:{}/'.format(self.server_address[1])
+
+    def start(self):
+        """Start serving in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+
+def add_dataset_arguments(parser):
+    parser.add_argument('--stations', type=int, default=1000)
+    parser.add_argument('--political-depth', type=int, default=4)
+    parser.add_argument('--political-fanout', type=int, default=4)
+    parser.add_argument('--links', type=int, default=2,
+                        help='Station types per station and variables per '
+                        'unit of measurement')
+    parser.add_argument('--timeseries-per-station', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay before each response, in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Maximum rate of each response, in bytes per '
+                        'second')
+
+
+def get_dataset(args):
+    return Dataset(stations=args.stations,
+                   political_depth=args.political_depth,
+                   political_fanout=args.political_fanout, links=args.links,
+                   timeseries_per_station=args.timeseries_per_station)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_dataset_arguments(parser)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    simulator = Simulator(get_dataset(args), args.latency, args.bandwidth,
+                          args.port)
+    print('Serving on {}'.format(simulator.url))
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Compare the speed of the writers of enhydris_aggregator.writers."""
+
+import argparse
+
+from django.db import transaction
+
+from . import best_time, setup, test_database
+
+
+def make_rows(n):
+    from enhydris.hcore import models
+
+    owner = models.Organization.objects.create(id=1, name='Owner')
+    station_type = models.StationType.objects.create(id=1, descr='Type')
+    stations = [
+        ({
+            'id': i + 2,
+            'name': 'Station {}'.format(i),
+            'name_alt': 'Σταθμός {}'.format(i),
+            'remarks': 'A station\twith\nspecial characters\\',
+            'srid': 4326,
+            'altitude': 100.0 + i,
+            'point': 'SRID=4326;POINT ({} {})'.format(20 + i / n, 38),
+            'start_date': '2012-02-01',
+            'copyright_holder': 'Someone',
+            'copyright_years': '2017',
+            'owner_id': owner.id,
+        }, {'stype': [station_type.id]})
+        for i in range(n)
+    ]
+    return models.Station, stations
+
+
+def run_writer(writer, model, rows):
+    with transaction.atomic():
+        writer.write(model, [(dict(item), m2m) for item, m2m in rows])
+        transaction.set_rollback(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+    from ..writers import get_writer, writers
+
+    with test_database():
+        with transaction.atomic():
+            model, rows = make_rows(args.rows)
+            for name in sorted(writers):
+                writer = get_writer(args.batch_size, name)
+                if writer.name != name:
+                    print('{:5} not available on this database'.format(name))
+                    continue
+                duration = best_time(
+                    lambda: run_writer(writer, model, rows), args.repeat)
+                print('{:5} {:8.3f} s {:10.0f} rows/s'.format(
+                    name, duration, args.rows / duration))
+            transaction.set_rollback(True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Keep the downloads and the progress of a run, so that it can be resumed.
+
+With --checkpoint, each source database gets a directory, in which every
+response of its API is saved as soon as it has been downloaded, together
+with the models that have been written so far and, if the run fails, the
+model that failed and the error. The directory is deleted when the source
+database has been copied successfully. If the run fails or is killed, the
+next run finds the directory and resumes: it reuses the saved responses
+instead of downloading them again, and only downloads the rest, including
+the model that failed.
+
+Each source database is still copied in a single transaction, so that the
+published data never contains half a copy; the rows written before the
+failure are rolled back, and they are written again from the saved
+responses.
+
+If a resumed run fails again in a way that cannot be attributed to a model
+(e.g. when the transaction is committed), the directory is deleted, so
+that the next run starts afresh instead of repeating the same failure.
+"""
+
+import json
+import os
+import shutil
+import threading
+
+from .fetch import Fetcher, FetchResult
+from .sources import get_source_name
+
+PROGRESS_FILE = 'progress.json'
+
+
+class NullCheckpoint:
+    """A checkpoint that keeps nothing, for when --checkpoint is not used."""
+
+    resuming = False
+
+    def complete(self, model_name):
+        pass
+
+    def fail(self, error, model_name=None):
+        pass
+
+    def remove(self):
+        pass
+
+
+class Checkpoint:
+    """The checkpoint of a source database, in a subdirectory of directory.
+
+    The subdirectory contains MODEL.json, the saved response for each
+    model, and progress.json, which has the following keys:
+
+    url, id_offset
+        Those of the source database.
+
+    downloads
+        A dictionary that maps the names of the models whose response has
+        been saved to a dictionary with the etag, last_modified,
+        content_hash and size of the response (see fetch.FetchResult).
+
+    completed
+        The names of the models that have been written.
+
+    failed, error
+        The name of the model that was being copied when the last run
+        failed (or None), and the error message.
+
+    The methods may be called from many threads.
+    """
+
+    def __init__(self, directory, source_db):
+        self.path = os.path.join(directory, get_source_name(source_db))
+        self.lock = threading.Lock()
+        try:
+            with open(os.path.join(self.path, PROGRESS_FILE)) as f:
+                self.progress = json.load(f)
+            self.resuming = True
+        except FileNotFoundError:
+            self.progress = {
+                'url': source_db['URL'],
+                'id_offset': source_db['ID_OFFSET'],
+                'downloads': {},
+                'completed': [],
+                'failed': None,
+                'error': None,
+            }
+            self.resuming = False
+
+    def get_filename(self, model_name):
+        return os.path.join(self.path, model_name + '.json')
+
+    def get_download(self, model_name):
+        """Return the saved response for a model as a FetchResult.
+
+        Returns None if there is no saved response.
+        """
+        with self.lock:
+            download = self.progress['downloads'].get(model_name)
+        if download is None:
+            return None
+        return FetchResult(open(self.get_filename(model_name), 'rb'),
+                           **download)
+
+    def save_download(self, model_name, fetch_result):
+        """Save the response of a model, which must not have been read."""
+        if fetch_result.not_modified:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        filename = self.get_filename(model_name)
+        with open(filename + '.tmp', 'wb') as f:
+            if fetch_result.f is None:
+                f.write(json.dumps(fetch_result.objects).encode())
+            else:
+                shutil.copyfileobj(fetch_result.f, f)
+                fetch_result.f.seek(0)
+        os.replace(filename + '.tmp', filename)
+        with self.lock:
+            self.progress['downloads'][model_name] = {
+                'etag': fetch_result.etag,
+                'last_modified': fetch_result.last_modified,
+                'content_hash': fetch_result.content_hash,
+                'size': os.path.getsize(filename),
+            }
+            self.save()
+
+    def complete(self, model_name):
+        """Record that a model has been written."""
+        with self.lock:
+            if model_name not in self.progress['completed']:
+                self.progress['completed'].append(model_name)
+            self.save()
+
+    def fail(self, error, model_name=None):
+        """Record that copying the source database failed.
+
+        model_name is the model that was being copied, if any; its saved
+        response is deleted, so that the next run downloads it again.
+        """
+        if model_name is None and self.resuming:
+            self.remove()
+            return
+        with self.lock:
+            if self.progress['downloads'].pop(model_name, None) is not None:
+                os.remove(self.get_filename(model_name))
+            if model_name in self.progress['completed']:
+                self.progress['completed'].remove(model_name)
+            self.progress['failed'] = model_name
+            self.progress['error'] = error
+            self.save()
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        filename = os.path.join(self.path, PROGRESS_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.progress, f, indent=2, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+    def remove(self):
+        """Delete the checkpoint; call it when the source has been copied."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class CheckpointFetcher(Fetcher):
+    """A Fetcher that saves the responses in the checkpoints in directory.
+
+    If a checkpoint has a saved response for a model, it is used instead of
+    downloading it again.
+    """
+
+    def __init__(self, max_workers, directory):
+        super().__init__(max_workers)
+        self.directory = directory
+        self.checkpoints = {}
+        self.lock = threading.Lock()
+
+    def get_checkpoint(self, source_db):
+        key = self._key(source_db, None)
+        with self.lock:
+            if key not in self.checkpoints:
+                self.checkpoints[key] = Checkpoint(self.directory, source_db)
+            return self.checkpoints[key]
+
+    def fetch(self, source_db, model_name, session, etag='',
+              last_modified=''):
+        checkpoint = self.get_checkpoint(source_db)
+        result = checkpoint.get_download(model_name)
+        if result is None:
+            result = super().fetch(source_db, model_name, session, etag,
+                                   last_modified)
+            checkpoint.save_download(model_name, result)
+        return result
+
+    def discard(self, source_db):
+        # The checkpoint may have been deleted or changed; the next run
+        # reads it again.
+        super().discard(source_db)
+        with self.lock:
+            self.checkpoints.pop(self._key(source_db, None), None)
@@ -0,0 +1,133 @@
+"""Find out how the copied models depend on one another."""
+
+from enhydris.hcore import models
+
+# The models of Enhydris that are copied; these are the models that the API
+# of Enhydris serves, except for the ancestors (such as Gentity) whose rows
+# are copied together with those of their descendants (such as Station).
+# Their load order is computed from their foreign keys (see
+# get_schedule()).
+COPIED_MODELS = ('GentityAltCodeType', 'FileType', 'EventType',
+                 'IntervalType', 'StationType', 'InstrumentType', 'Variable',
+                 'TimeZone', 'UnitOfMeasurement', 'Person', 'Organization',
+                 'PoliticalDivision', 'WaterDivision', 'WaterBasin',
+                 'Station', 'GentityAltCode', 'GentityFile', 'GentityEvent',
+                 'Overseer', 'Instrument', 'TimeStep', 'Timeseries')
+
+
+def get_copied_models():
+    """Return the names of the models of Enhydris that are copied."""
+    return list(COPIED_MODELS)
+
+
+def get_dependencies(model_names):
+    """Return the models each model refers to.
+
+    The result is a dictionary mapping each of model_names to the set of
+    model_names that it refers to with a foreign key (including the foreign
+    keys of its ancestors) or with an auto-created many-to-many
+    relationship. A foreign key to an ancestor such as Gentity is a
+    reference to all model_names that inherit it. Self references are
+    omitted.
+    """
+    result = {}
+    for name in model_names:
+        model = getattr(models, name)
+        result[name] = set()
+        for field in model._meta.fields:
+            if field.is_relation and not field.rel.parent_link:
+                result[name].update(get_referred_models(field.related_model,
+                                                        model_names))
+        for field in model._meta.many_to_many:
+            if field.rel.through._meta.auto_created:
+                result[name].update(get_referred_models(field.related_model,
+                                                        model_names))
+        result[name].discard(name)
+    return result
+
+
+def get_referred_models(related_model, model_names):
+    """Return the model_names whose objects a foreign key may refer to.
+
+    related_model is the model the foreign key points to; the result is
+    the set of its name and the names of the models that inherit it, such
+    as all Gentity models for a foreign key to Gentity, that are in
+    model_names.
+    """
+    return set(
+        name for name in model_names
+        if getattr(models, name) is related_model or
+        related_model in getattr(models, name)._meta.get_parent_list())
+
+
+def get_affected(model_names, dependencies):
+    """Return the models that need to be copied when model_names are copied.
+
+    Copying a model means deleting its rows first, and deleting a row also
+    deletes the rows that refer to it, so the models that refer to a copied
+    model must be copied as well, and so on. The result includes
+    model_names.
+    """
+    result = set(model_names)
+    while True:
+        affected = set(name for name, referred in dependencies.items()
+                       if referred & result)
+        if affected <= result:
+            return result
+        result |= affected
+
+
+def get_self_references(model):
+    """Return the names of the foreign keys of a model to itself.
+
+    These include the foreign keys of its ancestors; for example, a
+    PoliticalDivision refers to other political divisions through "parent"
+    and through "political_division", which it inherits from Gentity.
+    """
+    return [field.name for field in model._meta.fields
+            if field.is_relation and not field.rel.parent_link and
+            field.related_model is model]
+
+
+def get_schedule(model_names, dependencies):
+    """Return the order in which model_names can be loaded.
+
+    The result is a list of levels, each of which is a sorted list of
+    model names. The models of a level only refer to models of the
+    previous levels, so they can be loaded in any order, except for models
+    that refer to one another in a cycle; these are put in the same level
+    after the models they refer to. For example, a political division has
+    a water basin and a water basin has a political division, which works
+    because these foreign keys are nullable and the constraints are
+    checked at the end of the transaction.
+    """
+    result = []
+    loaded = set()
+    remaining = set(model_names)
+    while remaining:
+        level = [name for name in remaining if dependencies[name] <= loaded]
+        if not level:
+            level = _get_ready_cycles(remaining, dependencies)
+        result.append(sorted(level))
+        loaded.update(level)
+        remaining.difference_update(level)
+    return result
+
+
+def _get_ready_cycles(remaining, dependencies):
+    """Return the models of the cycles that wait for nothing else.
+
+    These are the models which refer only to loaded models and to models
+    that refer back to them.
+    """
+    reachable = {}
+    for name in remaining:
+        reachable[name] = set()
+        stack = [name]
+        while stack:
+            for referred in dependencies[stack.pop()] & remaining:
+                if referred not in reachable[name]:
+                    reachable[name].add(referred)
+                    stack.append(referred)
+    return [name for name in remaining
+            if all(name in reachable[x] for x in reachable[name])]
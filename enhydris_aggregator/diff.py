@@ -0,0 +1,128 @@
+"""Compare transformed rows with the rows that exist in the database."""
+
+
+class ModelDiff:
+    """The changes needed to make the database match some rows of a model.
+
+    rows is a list of (item, many_to_many) tuples, as returned by
+    Command.transform_object(); it should not be too long, because all the
+    corresponding rows of the database are loaded. After initialization,
+    the following attributes are available:
+
+    new_rows
+        The rows whose id does not exist in the database.
+
+    changed_rows
+        A list of (item, changed_fields) tuples, for the rows whose id
+        exists in the database but whose other fields differ;
+        changed_fields is a list of the names of the fields that differ.
+
+    links_to_add, links_to_delete
+        Dictionaries mapping auto-created many-to-many through models to
+        lists of instances to be created and of ids to be deleted,
+        respectively.
+
+    updated, unchanged
+        The number of existing rows that need to be updated (including
+        rows where only the many-to-many relationships are different), and
+        of those that are identical.
+
+    apply() performs all the changes except for the insertion of the new
+    rows, which is left to the caller (so that it can use a writer).
+    """
+
+    def __init__(self, model, rows, batch_size=1000):
+        self.model = model
+        self.batch_size = batch_size
+        self.new_rows = []
+        self.changed_rows = []
+        self.links_to_add = {}
+        self.links_to_delete = {}
+        self.updated = 0
+        self.unchanged = 0
+
+        items = {item['id']: item for item, many_to_many in rows}
+        field_names = set()
+        for item in items.values():
+            field_names.update(item)
+        fields = [model._meta.get_field(name) for name in field_names
+                  if name != 'id']
+        existing = {
+            row['id']: row
+            for row in model.objects.filter(id__in=list(items)).values(
+                'id', *[f.name for f in fields])
+        }
+        links_changed = self._diff_links(rows, existing)
+
+        for item, many_to_many in rows:
+            if item['id'] not in existing:
+                self.new_rows.append((item, many_to_many))
+                continue
+
+            # Let the model convert the values (e.g. strings to dates or
+            # geometries) before comparing them with those of the database
+            instance = model(**item)
+            changed_fields = [
+                f.attname for f in fields
+                if f.attname in item and
+                f.to_python(getattr(instance, f.attname)) !=
+                existing[item['id']][f.name]
+            ]
+            if changed_fields:
+                self.changed_rows.append((item, changed_fields))
+            if changed_fields or item['id'] in links_changed:
+                self.updated += 1
+            else:
+                self.unchanged += 1
+
+    def _diff_links(self, rows, existing):
+        """Compare the many-to-many relationships of the existing rows.
+
+        Returns the set of ids of the rows whose relationships differ. The
+        relationships of new rows are left to the writer.
+        """
+        result = set()
+        many_to_many_by_id = {item['id']: many_to_many
+                              for item, many_to_many in rows
+                              if item['id'] in existing}
+        m2m_names = set()
+        for many_to_many in many_to_many_by_id.values():
+            m2m_names.update(many_to_many)
+        for m2m in m2m_names:
+            field = self.model._meta.get_field(m2m)
+            through = field.rel.through
+            if not through._meta.auto_created:
+                continue
+            source_attname = field.m2m_field_name() + '_id'
+            target_attname = field.m2m_reverse_field_name() + '_id'
+            ids = [id for id, many_to_many in many_to_many_by_id.items()
+                   if m2m in many_to_many]
+            old_links = {
+                (source_id, target_id): pk
+                for pk, source_id, target_id in through.objects.filter(
+                    **{source_attname + '__in': ids}
+                ).values_list('pk', source_attname, target_attname)
+            }
+            new_links = set(
+                (id, target_id)
+                for id in ids
+                for target_id in many_to_many_by_id[id][m2m]
+            )
+            for link in new_links - set(old_links):
+                self.links_to_add.setdefault(through, []).append(
+                    through(**{source_attname: link[0],
+                               target_attname: link[1]}))
+                result.add(link[0])
+            for link in set(old_links) - new_links:
+                self.links_to_delete.setdefault(through, []).append(
+                    old_links[link])
+                result.add(link[0])
+        return result
+
+    def apply(self):
+        for item, changed_fields in self.changed_rows:
+            self.model(**item).save(update_fields=changed_fields)
+        for through, ids in self.links_to_delete.items():
+            through.objects.filter(id__in=ids).delete()
+        for through, objs in self.links_to_add.items():
+            through.objects.bulk_create(objs, batch_size=self.batch_size)
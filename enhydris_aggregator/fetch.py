@@ -0,0 +1,326 @@
+"""Download the objects of the source databases through their API.
+
+The list endpoints of the API may be very large, so they are not loaded in
+memory as a whole. Each response is downloaded to a temporary file (which
+stays in memory if it is small), and the objects are parsed one by one
+from that file when they are needed.
+"""
+
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import hashlib
+import json
+import re
+from tempfile import SpooledTemporaryFile
+import time
+
+import requests
+
+from .transport import Session
+
+# Responses larger than this are spooled to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+def urljoin(*args):
+    result = '/'.join([s.strip('/') for s in args])
+    if args[-1].endswith('/'):
+        result += '/'
+    return result
+
+
+# This is Enhydris 0.2 compatibility stuff. Delete it when this compatibility
+# is broken.
+_interval_types = [
+    {
+        "id": 2,
+        "last_modified": "2013-12-03T18:16:21.546470+02:00",
+        "descr": "Average value",
+        "descr_alt": "Average value",
+        "value": "AVERAGE"
+    },
+    {
+        "id": 4,
+        "last_modified": "2013-12-03T18:16:21.546470+02:00",
+        "descr": "Maximum",
+        "descr_alt": "Maximum",
+        "value": "MAXIMUM"
+    },
+    {
+        "id": 3,
+        "last_modified": "2013-12-03T18:16:21.546470+02:00",
+        "descr": "Minimum",
+        "descr_alt": "Minimum",
+        "value": "MINIMUM"
+    },
+    {
+        "id": 1,
+        "last_modified": "2013-12-03T18:16:21.546470+02:00",
+        "descr": "Sum",
+        "descr_alt": "Sum",
+        "value": "SUM"
+    },
+    {
+        "id": 5,
+        "last_modified": "2013-12-03T18:16:21.546470+02:00",
+        "descr": "Vector average",
+        "descr_alt": "Vector average",
+        "value": "VECTOR_AVERAGE"
+    },
+]
+
+
+class FetchResult:
+    """The response of the API for the objects of a model.
+
+    Iterating over it parses and yields the objects; this can only be done
+    once. It also has the following attributes:
+
+    not_modified
+        True if the server responded "304 Not Modified" to a conditional
+        request; in that case there are no objects.
+
+    etag, last_modified
+        The ETag and Last-Modified headers of the response, or empty
+        strings if the server did not send them.
+
+    content_hash
+        The SHA-256 of the body of the response, in hexadecimal.
+
+    download_time, size
+        How many seconds the download took, and the size of the body of
+        the response in bytes.
+    """
+
+    def __init__(self, f=None, objects=None, etag='', last_modified='',
+                 content_hash='', not_modified=False, download_time=0,
+                 size=0):
+        self.f = f
+        self.objects = objects
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.not_modified = not_modified
+        self.download_time = download_time
+        self.size = size
+
+    def __iter__(self):
+        if self.f is not None:
+            return iter_json_file(self.f)
+        return iter(self.objects or [])
+
+    def close(self):
+        """Release the downloaded data without iterating over it."""
+        if self.f is not None:
+            self.f.close()
+
+
+def fetch_objects(source_db, model_name, session=None, etag='',
+                  last_modified=''):
+    """Download the objects of a model of a source database.
+
+    The response is downloaded before this function returns; the result is
+    a FetchResult, which parses the objects one by one. session is a
+    transport.Session for the source database; if unspecified, a new one
+    is created. If etag or last_modified are specified, the request is
+    conditional.
+    """
+    if session is None:
+        session = Session(source_db)
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    f = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    start_time = time.perf_counter()
+    try:
+        r = session.download(urljoin(source_db['URL'], 'api', model_name, ''),
+                             f, CHUNK_SIZE, headers)
+    except (requests.HTTPError, requests.exceptions.RetryError):
+        # RetryError is raised instead of HTTPError when a 5xx status
+        # persists after the retries (see transport.Session).
+        f.close()
+        # Quick hack: Enhydris 0.2 has a bug; it does not serve
+        # IntervalType through the API (this was fixed in 1af68be). If we
+        # come across such a problem, we pretend that the API responded
+        # with the contents of IntervalType, which are the same in all
+        # known installations.
+        if model_name != 'IntervalType':
+            raise
+        content = json.dumps(_interval_types, sort_keys=True)
+        return FetchResult(
+            objects=deepcopy(_interval_types),
+            content_hash=hashlib.sha256(content.encode()).hexdigest())
+    except Exception:
+        f.close()
+        raise
+    download_time = time.perf_counter() - start_time
+    if r.status_code == requests.codes.not_modified:
+        f.close()
+        return FetchResult(not_modified=True, download_time=download_time)
+    size = f.tell()
+    f.seek(0)
+    content_hash = hashlib.sha256()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        content_hash.update(chunk)
+    f.seek(0)
+    return FetchResult(f, etag=r.headers.get('ETag', ''),
+                       last_modified=r.headers.get('Last-Modified', ''),
+                       content_hash=content_hash.hexdigest(),
+                       download_time=download_time, size=size)
+
+
+def iter_json_file(f):
+    """Yield the elements of the JSON array stored in binary file f.
+
+    The file is closed when finished.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = (decoder.decode(chunk)
+              for chunk in iter(lambda: f.read(CHUNK_SIZE), b''))
+    try:
+        for item in iter_json_array(chunks):
+            yield item
+    finally:
+        f.close()
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(chunks):
+    """Parse a JSON array incrementally and yield its elements.
+
+    chunks is an iterable of strings whose concatenation is a JSON array.
+    Only the current chunk and the current element are kept in memory.
+    Raises ValueError if the JSON is invalid or is not an array.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    state = 'start'
+    while True:
+        pos = _whitespace.match(buffer, pos).end()
+        if pos == len(buffer):
+            buffer = next(chunks, None)
+            if buffer is None:
+                raise ValueError('Unexpected end of JSON array')
+            pos = 0
+            continue
+        if state == 'start':
+            if buffer[pos] != '[':
+                raise ValueError('Expected a JSON array')
+            pos += 1
+            state = 'first'
+        elif state in ('first', 'next') and buffer[pos] == ']':
+            return
+        elif state == 'next':
+            if buffer[pos] != ',':
+                raise ValueError('Expected "," or "]" in JSON array')
+            pos += 1
+            state = 'element'
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                if end == len(buffer):
+                    # The element might continue in the next chunk (e.g. a
+                    # number), so we need to see more before deciding.
+                    raise ValueError('Incomplete element')
+            except ValueError:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+            state = 'next'
+
+
+class Fetcher:
+    """Download the objects of many models and sources concurrently.
+
+    start() submits the downloads to a pool of max_workers threads, and
+    get() waits for a download to finish and returns its result (a
+    FetchResult, see fetch_objects()) or raises its exception. Downloads
+    that have not been started with start() are started by get(). The
+    downloads are made by fetch(), which subclasses may override.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.futures = {}
+        self.sessions = {}
+
+    def get_session(self, source_db):
+        """Return the session of a source database, creating it if needed."""
+        if source_db['URL'] not in self.sessions:
+            self.sessions[source_db['URL']] = Session(
+                source_db, pool_size=self.max_workers)
+        return self.sessions[source_db['URL']]
+
+    def _key(self, source_db, model_name):
+        # The same URL may be used with different offsets (e.g. in the unit
+        # tests), so we also use the offset to identify the source.
+        return (source_db['URL'], source_db['ID_OFFSET'], model_name)
+
+    def fetch(self, source_db, model_name, session, etag='',
+              last_modified=''):
+        """Download the objects of a model; runs in a worker thread."""
+        return fetch_objects(source_db, model_name, session, etag,
+                             last_modified)
+
+    def start(self, source_db, model_name, etag='', last_modified=''):
+        key = self._key(source_db, model_name)
+        self.futures[key] = self.executor.submit(
+            self.fetch, source_db, model_name, self.get_session(source_db),
+            etag, last_modified)
+
+    def get(self, source_db, model_name):
+        """Return the result of a download.
+
+        The result is kept until discard() is called, so get() may be
+        called many times for the same download.
+        """
+        key = self._key(source_db, model_name)
+        if key not in self.futures:
+            self.futures[key] = self.executor.submit(
+                self.fetch, source_db, model_name,
+                self.get_session(source_db))
+        return self.futures[key].result()
+
+    def ready(self, source_db, model_name):
+        """Return False if a download has been started and is in progress.
+
+        In that case get() would wait for it to finish.
+        """
+        key = self._key(source_db, model_name)
+        return key not in self.futures or self.futures[key].done()
+
+    def discard(self, source_db):
+        """Cancel or forget the remaining downloads of a source."""
+        for key in list(self.futures):
+            if key[:2] == self._key(source_db, None)[:2]:
+                self._discard(self.futures.pop(key))
+
+    def _discard(self, future):
+        if not future.cancel() and future.done() and \
+                future.exception() is None:
+            future.result().close()
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown()
+        for future in self.futures.values():
+            self._discard(future)
+        self.futures = {}
+        for session in self.sessions.values():
+            session.close()
@@ -0,0 +1,193 @@
+"""Check the references of the transformed rows before they are written.
+
+A single row with a foreign key to an object that does not exist would
+make the database reject the whole source database at the end of the
+transaction. Instead, the rows of each model are checked before they are
+written, against the ids of the objects of the source database that have
+already been loaded, which SourceIds keeps in memory. A row with a foreign
+key to an object that does not exist is quarantined: it is not written,
+and neither are the rows that refer to it, since they are checked later.
+A many-to-many link to an object that does not exist is dropped.
+"""
+
+from enhydris.hcore import models
+
+from .dependencies import get_referred_models
+
+
+class SourceIds:
+    """The ids of the objects of a source database in the target database.
+
+    model_names are the copied models, and min_id and max_id the id range of
+    the source database. The ids of a model are loaded from the database
+    with a single query the first time they are needed, unless the model
+    has been expected with expect(); then it is being copied, and its ids
+    are unknown until they are set with loaded().
+    """
+
+    def __init__(self, model_names, min_id, max_id):
+        self.model_names = model_names
+        self.min_id = min_id
+        self.max_id = max_id
+        self.ids = {}
+        self.pending = set()
+
+    def expect(self, model_names):
+        """Mark model_names as being copied."""
+        self.pending.update(model_names)
+
+    def loaded(self, model_name, ids):
+        """Set the ids of a model that has been copied."""
+        self.pending.discard(model_name)
+        self.ids[model_name] = ids
+
+    def get(self, model_name):
+        """Return the set of the ids of a model, or None if it is pending."""
+        if model_name in self.pending:
+            return None
+        if model_name not in self.ids:
+            model = getattr(models, model_name)
+            self.ids[model_name] = set(model._base_manager.filter(
+                pk__gte=self.min_id, pk__lte=self.max_id
+            ).values_list('pk', flat=True))
+        return self.ids[model_name]
+
+
+class LinkValidator:
+    """Quarantine the rows of a model that refer to nonexistent objects.
+
+    validate() is a generator that takes (row, many_to_many) tuples, as
+    returned by Command.transform_object(), and yields those whose foreign
+    keys refer to existing objects, with the ids of nonexistent objects
+    removed from many_to_many. The ids are looked up in source_ids (a
+    SourceIds); the foreign keys to models that are pending, which happens
+    when models refer to one another in a cycle, cannot be checked, and are
+    left to the database. Foreign keys to the model itself are checked
+    against the rows that have been yielded; a row that refers to a row
+    that has not appeared yet is held back until the end, and yielded then
+    if the row it refers to has appeared. References to models that are
+    not copied, such as User, are checked against all their objects.
+
+    ids is the set of the ids of the model that exist already; the ids of
+    the yielded rows are added to it. The rows that have been quarantined
+    are appended to "quarantined" as (row, many_to_many, reason) tuples,
+    and the links that have been dropped to "dangling" as (id, field name,
+    target id) tuples.
+    """
+
+    def __init__(self, model, source_ids, ids=None):
+        self.model = model
+        self.source_ids = source_ids
+        self.ids = set() if ids is None else ids
+        self.quarantined = []
+        self.dangling = []
+        self.other_ids = {}
+        self.foreign_keys = []
+        for field in model._meta.fields:
+            if field.is_relation and not field.rel.parent_link:
+                self.foreign_keys.append(
+                    (field.attname, field.related_model,
+                     get_referred_models(field.related_model,
+                                         source_ids.model_names)))
+        self.many_to_many = {}
+        for field in model._meta.many_to_many:
+            if field.rel.through._meta.auto_created and \
+                    field.related_model is not model:
+                self.many_to_many[field.name] = (
+                    field.related_model, get_referred_models(
+                        field.related_model, source_ids.model_names))
+
+    def get_other_ids(self, related_model):
+        """Return all ids of a model that is not copied."""
+        if related_model not in self.other_ids:
+            self.other_ids[related_model] = set(
+                related_model._base_manager.values_list('pk', flat=True))
+        return self.other_ids[related_model]
+
+    def exists(self, id, related_model, model_names):
+        """Return whether id exists in model_names, or None if unknown."""
+        if not model_names:
+            return id in self.get_other_ids(related_model)
+        unknown = False
+        for model_name in model_names:
+            ids = self.source_ids.get(model_name)
+            if ids is None:
+                unknown = True
+            elif id in ids:
+                return True
+        return None if unknown else False
+
+    def check(self, row):
+        """Check the foreign keys of a row.
+
+        Returns a tuple (reason, self_references); reason is None if the
+        row is valid, and self_references is a list of (field name, id)
+        tuples of the foreign keys to the model itself that refer to rows
+        that have not appeared yet, provided that they refer to nothing
+        else.
+        """
+        self_references = []
+        for attname, related_model, model_names in self.foreign_keys:
+            id = row.get(attname)
+            if id is None:
+                continue
+            if related_model is self.model:
+                if id not in self.ids:
+                    self_references.append((attname, id))
+                continue
+            if self.exists(id, related_model, model_names) is False:
+                return _reason(attname, id), []
+        return None, self_references
+
+    def validate(self, rows):
+        held = {}
+        for row, many_to_many in rows:
+            reason, self_references = self.check(row)
+            if reason is not None:
+                self.quarantined.append((row, many_to_many, reason))
+                continue
+            self.check_links(row, many_to_many)
+            if self_references:
+                held[row['id']] = (row, many_to_many, self_references)
+                continue
+            self.ids.add(row['id'])
+            yield row, many_to_many
+
+        # The held rows refer to rows that have appeared since, or to one
+        # another in cycles, or to nothing; drop the latter until only the
+        # rows whose references can be satisfied remain.
+        while True:
+            dropped = [id for id, (row, m, references) in held.items()
+                       if any(x not in self.ids and x not in held
+                              for attname, x in references)]
+            if not dropped:
+                break
+            for id in dropped:
+                row, many_to_many, references = held.pop(id)
+                attname, target_id = next(
+                    (a, x) for a, x in references
+                    if x not in self.ids and x not in held)
+                self.quarantined.append(
+                    (row, many_to_many, _reason(attname, target_id)))
+        for row, many_to_many, references in held.values():
+            self.ids.add(row['id'])
+            yield row, many_to_many
+
+    def check_links(self, row, many_to_many):
+        """Drop the many-to-many links of a row to nonexistent objects."""
+        for m2m, target_ids in many_to_many.items():
+            if m2m not in self.many_to_many:
+                continue
+            related_model, model_names = self.many_to_many[m2m]
+            missing = [id for id in target_ids
+                       if self.exists(id, related_model, model_names) is
+                       False]
+            if not missing:
+                continue
+            many_to_many[m2m] = [id for id in target_ids if id not in missing]
+            self.dangling.extend((row['id'], m2m, id) for id in missing)
+
+
+def _reason(attname, id):
+    return '{} refers to nonexistent object {}'.format(
+        attname[:-len('_id')], id)
@@ -0,0 +1,214 @@
+"""Share identical lookup objects among the source databases.
+
+Normally each source database gets its own copy of the lookup models, such
+as Variable and TimeZone, with its ID_OFFSET added to their ids, although
+they are usually the same in all source databases. If the SHARED_LOOKUPS
+setting is True, the lookup objects are shared instead: each lookup object
+of a source database is mapped, by the hash of its content, to a shared
+object, which is created the first time it is seen, and the foreign keys
+and many-to-many links of the copied objects are changed to point to the
+shared objects. The shared objects take the ids below the lowest
+ID_OFFSET, which belong to no source database; the mapping is kept in the
+SharedLookup table, and the shared objects to which nothing is mapped any
+more are deleted at the end of each run (see collect_garbage()).
+
+When a lookup object changes, it is mapped to another shared object, so
+the rows that refer to it must be written again, even if they have not
+changed themselves; the lookup models for which this happened are listed
+in SharedLookups.remapped.
+"""
+
+import hashlib
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max
+
+from enhydris.hcore import models
+
+from .models import SharedLookup
+
+LOOKUP_MODELS = ('EventType', 'FileType', 'GentityAltCodeType',
+                 'InstrumentType', 'IntervalType', 'StationType', 'TimeStep',
+                 'TimeZone', 'UnitOfMeasurement', 'Variable')
+
+
+def get_content_hash(row, many_to_many):
+    """Return the SHA-256 of the content of a row, excluding its id."""
+    content = {key: value for key, value in row.items() if key != 'id'}
+    content.update((key, sorted(ids)) for key, ids in many_to_many.items())
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str)
+                          .encode()).hexdigest()
+
+
+class SharedLookups:
+    """The shared lookup objects and their mapping to the source databases.
+
+    max_shared_id is the largest id a shared object may have (the lowest
+    ID_OFFSET minus one). The mapping of the source database being copied,
+    whose id range is specified with start_source(), is kept in memory, as
+    is the index of the shared objects by content hash. remapped is the
+    set of the lookup models of the source database whose mapping has been
+    changed by share().
+    """
+
+    def __init__(self, max_shared_id):
+        if max_shared_id < 1:
+            raise ImproperlyConfigured(
+                'SHARED_LOOKUPS requires the lowest ID_OFFSET to be larger '
+                'than 1, so that the shared lookups have ids below it')
+        self.max_shared_id = max_shared_id
+        self.shared_ids = {name: {} for name in LOOKUP_MODELS}
+        for x in SharedLookup.objects.all():
+            self.shared_ids[x.model_name][x.content_hash] = x.shared_id
+        self.next_ids = {}
+        self.fields = {}
+        self.remapped = set()
+
+    def is_shared(self, model_name):
+        return model_name in LOOKUP_MODELS
+
+    def start_source(self, min_id, max_id, source_ids):
+        """Load the mapping of the source database of an id range.
+
+        The ids of the shared objects that the source database uses are
+        set in source_ids (a links.SourceIds).
+        """
+        self.saved = ({name: dict(x) for name, x in self.shared_ids.items()},
+                      dict(self.next_ids))
+        self.min_id = min_id
+        self.max_id = max_id
+        self.remapped = set()
+        self.mappings = {name: {} for name in LOOKUP_MODELS}
+        for x in SharedLookup.objects.filter(object_id__gte=min_id,
+                                             object_id__lte=max_id):
+            self.mappings[x.model_name][x.object_id] = x.shared_id
+        for model_name in LOOKUP_MODELS:
+            source_ids.loaded(model_name, self.get_ids(model_name))
+
+    def rollback(self):
+        """Forget the shared objects created since start_source().
+
+        Call it when the transaction of the source database is rolled
+        back.
+        """
+        self.shared_ids, self.next_ids = self.saved
+
+    def get_ids(self, model_name):
+        """Return the ids of the shared objects of the source database."""
+        return set(self.mappings[model_name].values())
+
+    def get_fields(self, model):
+        """Return the references of a model to the lookup models.
+
+        The result is a list of (key, model name, is many to many) tuples,
+        where key is that of the transformed rows.
+        """
+        if model not in self.fields:
+            self.fields[model] = [
+                (field.attname, field.related_model.__name__, False)
+                for field in model._meta.fields
+                if field.is_relation and
+                field.related_model.__name__ in LOOKUP_MODELS
+            ] + [
+                (field.name, field.related_model.__name__, True)
+                for field in model._meta.many_to_many
+                if field.related_model.__name__ in LOOKUP_MODELS
+            ]
+        return self.fields[model]
+
+    def rewrite(self, model, rows):
+        """Change the references of (row, many_to_many) tuples.
+
+        This is a generator that yields the tuples with the ids of the
+        lookup objects replaced by those of the shared objects. Ids that
+        are not mapped to a shared object are left as they are.
+        """
+        fields = self.get_fields(model)
+        for row, many_to_many in rows:
+            for key, model_name, is_many_to_many in fields:
+                mapping = self.mappings[model_name]
+                if is_many_to_many:
+                    if key in many_to_many:
+                        many_to_many[key] = [mapping.get(id, id)
+                                             for id in many_to_many[key]]
+                elif row.get(key) is not None:
+                    row[key] = mapping.get(row[key], row[key])
+            yield row, many_to_many
+
+    def share(self, model_name, rows):
+        """Map the rows of a lookup model to shared objects.
+
+        This is a generator that yields the rows of the shared objects
+        that do not exist yet, which must be written. The previous mapping
+        of the model is replaced; save() must be called afterwards.
+        """
+        mapping = {}
+        shared_ids = self.shared_ids[model_name]
+        for row, many_to_many in rows:
+            content_hash = get_content_hash(row, many_to_many)
+            if content_hash not in shared_ids:
+                shared_ids[content_hash] = self.get_next_id(model_name)
+                yield dict(row, id=shared_ids[content_hash]), many_to_many
+            mapping[row['id']] = (shared_ids[content_hash], content_hash)
+        new_mapping = {
+            id: shared_id for id, (shared_id, content_hash) in mapping.items()}
+        if new_mapping != self.mappings[model_name]:
+            self.remapped.add(model_name)
+        self.mappings[model_name] = new_mapping
+        self.pending = [SharedLookup(model_name=model_name, object_id=id,
+                                     shared_id=shared_id,
+                                     content_hash=content_hash)
+                        for id, (shared_id, content_hash) in mapping.items()]
+
+    def save(self, model_name, batch_size):
+        """Replace the mapping of a model in the database."""
+        SharedLookup.objects.filter(
+            model_name=model_name, object_id__gte=self.min_id,
+            object_id__lte=self.max_id).delete()
+        SharedLookup.objects.bulk_create(self.pending, batch_size=batch_size)
+        self.pending = []
+
+    def get_next_id(self, model_name):
+        if model_name not in self.next_ids:
+            model = getattr(models, model_name)
+            self.next_ids[model_name] = (model._base_manager.filter(
+                pk__lte=self.max_shared_id).aggregate(Max('pk'))['pk__max']
+                or 0) + 1
+        result = self.next_ids[model_name]
+        if result > self.max_shared_id:
+            raise ValueError('There are too many shared {} objects for the '
+                             'ids below the lowest ID_OFFSET'
+                             .format(model_name))
+        self.next_ids[model_name] += 1
+        return result
+
+    def collect_garbage(self):
+        """Delete the shared objects to which nothing is mapped.
+
+        Shared objects that rows still refer to are kept, so that deleting
+        them never cascades to the rows that refer to them; they are
+        deleted by a later run, once nothing refers to them any more.
+        """
+        for model_name in LOOKUP_MODELS:
+            model = getattr(models, model_name)
+            used = SharedLookup.objects.filter(
+                model_name=model_name).values('shared_id')
+            unused = model._base_manager.filter(
+                pk__lte=self.max_shared_id).exclude(pk__in=used)
+            for relation in _get_references(model):
+                referred = relation.related_model._base_manager.filter(
+                    **{relation.field.name + '__isnull': False}
+                ).values(relation.field.name)
+                unused = unused.exclude(pk__in=referred)
+            unused.delete()
+
+
+def _get_references(model):
+    """Return the relations of the foreign keys that point to model.
+
+    These include the foreign keys of the auto-created many-to-many tables.
+    """
+    return [f for f in model._meta.get_fields(include_hidden=True)
+            if f.auto_created and not f.concrete and
+            (f.one_to_many or f.one_to_one)]
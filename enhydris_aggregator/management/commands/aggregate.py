@@ -1,231 +1,931 @@
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import StringIO
+import json
 import sys
+import time
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.db.models import FileField
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from enhydris.hcore import models
 
-import requests
+from ... import staging
+from ...checkpoint import CheckpointFetcher, NullCheckpoint
+from ...dependencies import (get_affected, get_copied_models,
+                             get_dependencies, get_schedule,
+                             get_self_references)
+from ...diff import ModelDiff
+from ...fetch import Fetcher
+from ...links import LinkValidator, SourceIds
+from ...lookups import SharedLookups
+from ...metrics import Metrics
+from ...models import QuarantinedObject, SharedLookup, SyncState
+from ...ordering import Reorderer
+from ...pipeline import Pipeline
+from ...plans import get_plan
+from ...profiling import NullProfiler, Profiler
+from ...purge import purge_and_verify
+from ...sources import (delete_originating_urls, SourceRanges,
+                        store_originating_urls)
+from ...writers import batches, get_writer
+
+
+def parse_last_modified(item):
+    """Return the last_modified of an object as an aware datetime, or None."""
+    value = item.get('last_modified')
+    if not value:
+        return None
+    result = parse_datetime(value)
+    if timezone.is_naive(result):
+        result = timezone.make_aware(result, timezone.utc)
+    return result
 
 
-def urljoin(*args):
-    result = '/'.join([s.strip('/') for s in args])
-    if args[-1].endswith('/'):
-        result += '/'
-    return result
+class HighWaterMark:
+    """Keep track of the largest last_modified of a stream of objects."""
 
+    def __init__(self):
+        self.value = None
 
-# This is Enhydris 0.2 compatibility stuff. Delete it when this compatibility
-# is broken.
-_interval_types = [
-    {
-        "id": 2,
-        "last_modified": "2013-12-03T18:16:21.546470+02:00",
-        "descr": "Average value",
-        "descr_alt": "Average value",
-        "value": "AVERAGE"
-    },
-    {
-        "id": 4,
-        "last_modified": "2013-12-03T18:16:21.546470+02:00",
-        "descr": "Maximum",
-        "descr_alt": "Maximum",
-        "value": "MAXIMUM"
-    },
-    {
-        "id": 3,
-        "last_modified": "2013-12-03T18:16:21.546470+02:00",
-        "descr": "Minimum",
-        "descr_alt": "Minimum",
-        "value": "MINIMUM"
-    },
-    {
-        "id": 1,
-        "last_modified": "2013-12-03T18:16:21.546470+02:00",
-        "descr": "Sum",
-        "descr_alt": "Sum",
-        "value": "SUM"
-    },
-    {
-        "id": 5,
-        "last_modified": "2013-12-03T18:16:21.546470+02:00",
-        "descr": "Vector average",
-        "descr_alt": "Vector average",
-        "value": "VECTOR_AVERAGE"
-    },
-]
+    def track(self, objects):
+        for item in objects:
+            last_modified = parse_last_modified(item)
+            if last_modified is not None and (
+                    self.value is None or last_modified > self.value):
+                self.value = last_modified
+            yield item
+
+
+class ModelReader:
+    """The objects of a model of a source database, ready to be written.
+
+    Iterating over it waits for the download, and yields the objects
+    reordered and transformed to (row, many_to_many) tuples (see
+    Command.transform_object()). None of this uses the database, so it may
+    run in another thread (see pipeline.Pipeline). After the iteration
+    has finished, the reorderer and the high water mark may be examined.
+    """
+
+    def __init__(self, command, source_db, model_name):
+        self.command = command
+        self.source_db = source_db
+        self.model_name = model_name
+        self.model = getattr(models, model_name)
+        self.fetch_result = None
+        self.high_water_mark = HighWaterMark()
+        self.reorderer = Reorderer(get_self_references(self.model))
+
+    def ready(self):
+        return self.command.fetcher.ready(self.source_db, self.model_name)
+
+    def __iter__(self):
+        self.fetch_result = self.command.fetcher.get(self.source_db,
+                                                     self.model_name)
+        self.command.record_fetch(self.source_db, self.model_name,
+                                  self.fetch_result)
+        return self.command.metrics.timed(
+            self.transform(), self.source_db, self.model_name,
+            'transform_time')
+
+    def transform(self):
+        objects = self.reorderer.reorder(
+            self.high_water_mark.track(self.fetch_result))
+        id_offset = self.source_db['ID_OFFSET']
+        count = 0
+        try:
+            with self.command.profiler.stage(self.source_db, self.model_name,
+                                             'transform'):
+                for item in objects:
+                    count += 1
+                    yield self.command.transform_object(self.model, item,
+                                                        id_offset)
+        finally:
+            self.command.metrics.add(self.source_db, self.model_name,
+                                     objects=count)
+
+
+_schedule = None
+
+
+class Schedule:
+    """The load order of the copied models.
+
+    This is a descriptor, which computes the order from the metadata of the
+    models (see dependencies.get_schedule()) the first time it is needed.
+    Command.schedule is the list of levels, and Command.model_names is the
+    tuple of all model names in load order.
+    """
+
+    def __init__(self, flat):
+        self.flat = flat
+
+    def __get__(self, instance, owner):
+        global _schedule
+        if _schedule is None:
+            model_names = get_copied_models()
+            levels = get_schedule(model_names, get_dependencies(model_names))
+            _schedule = (levels,
+                         tuple(name for level in levels for name in level))
+        return _schedule[1] if self.flat else _schedule[0]
+
+
+def aggregate_source_in_process(options, source_db, min_id, max_id):
+    """Copy a source database in a worker process of --jobs.
+
+    options is the result of Command.get_options(). Returns a tuple (stdout,
+    stderr, error, metrics), where stdout and stderr are the output of the
+    command, error is the result of Command.aggregate_source(), and metrics
+    are the metrics of the source database (see Metrics.merge_source()).
+    """
+    stdout = StringIO()
+    stderr = StringIO()
+    command = Command(stdout=stdout, stderr=stderr)
+    try:
+        command.configure(options)
+        command.profiler.start(connection)
+        command.prepare()
+        command.start_fetching([source_db])
+        try:
+            error = command.aggregate_source(source_db, min_id, max_id)
+        finally:
+            command.fetcher.shutdown()
+            command.profiler.stop()
+    finally:
+        connection.close()
+    return (stdout.getvalue(), stderr.getvalue(), error,
+            command.metrics.get_source(source_db))
 
 
 class Command(BaseCommand):
     help = "Deletes database content and re-creates it by copying " \
         "from the source databases"
-    model_names = ('GentityAltCodeType', 'FileType', 'EventType',
-                   'IntervalType', 'StationType', 'InstrumentType', 'Variable',
-                   'TimeZone', 'UnitOfMeasurement', 'Person', 'Organization',
-                   'PoliticalDivision', 'WaterDivision', 'WaterBasin',
-                   'Station', 'GentityAltCode', 'GentityFile', 'GentityEvent',
-                   'Overseer', 'Instrument', 'TimeStep', 'Timeseries')
+    schedule = Schedule(flat=False)
+    model_names = Schedule(flat=True)
+    batch_size = 1000
+    fetch_workers = 8
+    incremental = False
+    diff = False
+    force = False
+    staging = False
+    jobs = 1
+    pipeline_depth = 4
+    checkpoint_dir = None
+    verbosity = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = Metrics()
+        self.profiler = NullProfiler()
+        self.current_model = None
+        self.lookups = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=self.batch_size,
+            help='Maximum number of rows written with a single query '
+            '(default: %(default)s)')
+        parser.add_argument(
+            '--fetch-workers', type=int, default=self.fetch_workers,
+            help='Maximum number of concurrent downloads from the source '
+            'databases (default: %(default)s)')
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Instead of deleting and re-copying everything, only copy '
+            'the objects that have been added or modified since the last '
+            'run, and delete the objects that have been deleted')
+        parser.add_argument(
+            '--diff', action='store_true',
+            help='Instead of deleting and re-copying everything, compare '
+            'the source objects with the target database and only insert, '
+            'update and delete what is different (may be combined with '
+            '--incremental)')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Copy all models, even those whose source has not changed '
+            'since the last run')
+        parser.add_argument(
+            '--staging', action='store_true',
+            help='Load each source database into temporary tables, and '
+            'only replace its objects in the live tables at the end, so '
+            'that they are locked for a short time only')
+        parser.add_argument(
+            '--jobs', type=int, default=self.jobs,
+            help='Number of source databases to copy in parallel, each in '
+            'its own process (default: %(default)s)')
+        parser.add_argument(
+            '--pipeline-depth', type=int, default=self.pipeline_depth,
+            help='Maximum number of batches of rows that are prepared '
+            'while the previous ones are being written; 0 prepares each '
+            'model only when it is written (default: %(default)s)')
+        parser.add_argument(
+            '--checkpoint', metavar='DIR',
+            help='Keep the downloads and the progress of each source '
+            'database in DIR, so that if copying it fails, the next run '
+            'with the same DIR resumes it without downloading again what '
+            'has already been downloaded')
+        parser.add_argument(
+            '--metrics', metavar='FILE',
+            help='Write the time spent and the amount of data copied, for '
+            'each source database and model, to FILE, in JSON')
+        parser.add_argument(
+            '--prometheus', metavar='FILE',
+            help='Write the same metrics as --metrics to FILE, in the text '
+            'format of Prometheus')
+        parser.add_argument(
+            '--profile', metavar='DIR',
+            help='Profile each stage of the copying of each model with '
+            'cProfile, count its SQL queries, and write the results to DIR')
+        parser.add_argument(
+            '--trace-memory', action='store_true',
+            help='With --profile, also trace the memory allocations of each '
+            'stage with tracemalloc (this is slow)')
+        parser.add_argument(
+            '--show-plan', action='store_true',
+            help='Show the order in which the models are loaded, and exit')
 
     def handle(self, *args, **options):
-        # Sort SOURCE_DATABASES by ID_OFFSET
-        source_databases = deepcopy(
-            settings.ENHYDRIS_AGGREGATOR['SOURCE_DATABASES'])
-        source_databases.sort(key=lambda x: x['ID_OFFSET'])
-
-        for i, source_db in enumerate(source_databases):
-            min_id = source_db['ID_OFFSET']
-            try:
-                max_id = source_databases[i + 1]['ID_OFFSET']
-            except IndexError:
-                max_id = sys.maxsize
-            try:
-                with transaction.atomic():
-                    self.delete_from_database(min_id, max_id)
-                    self.copy_source_db(source_db)
-            except Exception as e:
-                # We have already rolled back; log the problem and continue
-                # to the next source database
-                print(
-                    'Error while copying database {}'.format(source_db['URL']),
-                    file=sys.stderr)
-                print(str(e), file=sys.stderr)
-
-    def copy_source_db(self, source_db):
+        if options['show_plan']:
+            self.show_plan()
+            return
+        self.configure(options)
+        self.profiler.start(connection)
+        try:
+            self.aggregate()
+        finally:
+            self.profiler.stop()
+            self.write_metrics()
+
+    def aggregate(self):
+        source_ranges = self.get_source_ranges()
+        if self.jobs > 1:
+            self.aggregate_in_processes(source_ranges)
+            return
+
+        self.prepare()
+        self.start_fetching([source_db for source_db, min_id, max_id
+                             in source_ranges])
+        try:
+            for source_db, min_id, max_id in source_ranges:
+                error = self.aggregate_source(source_db, min_id, max_id)
+                if error:
+                    self.report_error(source_db, error)
+        finally:
+            self.fetcher.shutdown()
+        self.collect_garbage()
+
+    def collect_garbage(self):
+        """Delete the shared lookups that are not used any more."""
+        if self.lookups is not None:
+            with transaction.atomic():
+                self.lookups.collect_garbage()
+
+    def write_metrics(self):
+        self.metrics.finish()
+        self.save_metrics()
+
+    def save_metrics(self):
+        if self.metrics_file:
+            self.metrics.write_json(self.metrics_file)
+        if self.prometheus_file:
+            self.metrics.write_prometheus(self.prometheus_file)
+
+    def show_plan(self):
+        """Print the levels of the schedule.
+
+        The models of each level refer only to the models of the previous
+        levels.
+        """
+        for i, level in enumerate(self.schedule, start=1):
+            self.stdout.write('{}: {}'.format(i, ', '.join(level)))
+
+    def configure(self, options):
+        """Set the attributes of the command from its options."""
+        self.batch_size = options['batch_size']
+        self.fetch_workers = options['fetch_workers']
+        self.incremental = options['incremental']
+        self.diff = options['diff']
+        self.force = options['force']
+        self.staging = options['staging']
+        self.jobs = options['jobs']
+        self.pipeline_depth = options['pipeline_depth']
+        self.checkpoint_dir = options['checkpoint']
+        self.metrics_file = options['metrics']
+        self.prometheus_file = options['prometheus']
+        self.profile_dir = options['profile']
+        self.trace_memory = options['trace_memory']
+        self.verbosity = options['verbosity']
+        if self.batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        if self.fetch_workers < 1:
+            raise CommandError('--fetch-workers must be a positive integer')
+        if self.jobs < 1:
+            raise CommandError('--jobs must be a positive integer')
+        if self.pipeline_depth < 0:
+            raise CommandError('--pipeline-depth must not be negative')
+        if self.trace_memory and not self.profile_dir:
+            raise CommandError('--trace-memory requires --profile')
+        if self.staging and (self.incremental or self.diff):
+            raise CommandError('--staging cannot be combined with '
+                               '--incremental or --diff')
+        if self.staging and connection.vendor not in staging.vendors:
+            raise CommandError('--staging is not supported on {}'.format(
+                connection.vendor))
+        if self.jobs > 1 and connection.vendor == 'sqlite':
+            raise CommandError('--jobs requires a database that supports '
+                               'concurrent transactions, such as PostgreSQL')
+        self.shared_lookups = settings.ENHYDRIS_AGGREGATOR.get(
+            'SHARED_LOOKUPS', False)
+        if self.shared_lookups and (self.staging or self.jobs > 1):
+            raise CommandError('--staging and --jobs cannot be used with '
+                               'the SHARED_LOOKUPS setting')
+        self.writer = get_writer(self.batch_size)
+        if self.profile_dir:
+            self.profiler = Profiler(self.profile_dir, self.trace_memory)
+        self.get_purge_mode()  # Check the setting before we start
+
+    def get_options(self):
+        """Return the options that configure() needs to recreate self."""
+        result = {name: getattr(self, name) for name in (
+            'batch_size', 'fetch_workers', 'incremental', 'diff', 'force',
+            'staging', 'jobs', 'pipeline_depth', 'trace_memory',
+            'verbosity')}
+        result.update(checkpoint=self.checkpoint_dir,
+                      metrics=self.metrics_file,
+                      prometheus=self.prometheus_file,
+                      profile=self.profile_dir)
+        return result
+
+    def get_source_ranges(self):
+        """Return a list of (source_db, min_id, max_id) tuples.
+
+        See sources.SourceRanges.ranges().
+        """
+        return SourceRanges(
+            settings.ENHYDRIS_AGGREGATOR['SOURCE_DATABASES']).ranges()
+
+    def prepare(self):
+        """Load what is needed from the database before aggregating."""
+        self.dependencies = get_dependencies(self.model_names)
+        self.sync_states = {
+            (s.source_url, s.id_offset, s.model_name): s
+            for s in SyncState.objects.all()
+        }
+        if self.shared_lookups:
+            self.lookups = SharedLookups(
+                self.get_source_ranges()[0][1] - 1)
+
+    def start_fetching(self, source_databases):
+        """Start downloading everything from source_databases.
+
+        The downloads continue in the background while we write to the
+        database. Unless --force is specified, the requests are
+        conditional. With --checkpoint, the responses saved by a failed
+        run are used instead.
+        """
+        self.fetcher = self.create_fetcher()
+        for source_db in source_databases:
+            self.start_fetching_source(source_db)
+
+    def create_fetcher(self):
+        if self.checkpoint_dir:
+            return CheckpointFetcher(self.fetch_workers, self.checkpoint_dir)
+        return Fetcher(self.fetch_workers)
+
+    def start_fetching_source(self, source_db):
+        checkpoint = self.get_checkpoint(source_db)
+        if checkpoint.resuming:
+            self.report_resume(source_db, checkpoint)
+        for model_name in self.model_names:
+            sync_state = self.get_sync_state(source_db, model_name)
+            if self.force or sync_state is None:
+                self.fetcher.start(source_db, model_name)
+            else:
+                self.fetcher.start(source_db, model_name, sync_state.etag,
+                                   sync_state.last_modified)
+
+    def aggregate_source(self, source_db, min_id, max_id):
+        """Copy a source database in a transaction.
+
+        Returns None on success; otherwise the transaction is rolled back,
+        and the error message is returned.
+        """
+        start_time = time.perf_counter()
+        checkpoint = self.get_checkpoint(source_db)
+        self.current_model = None
+        self.source_ids = SourceIds(self.model_names, min_id, max_id)
+        try:
+            with transaction.atomic():
+                if self.lookups is not None:
+                    self.lookups.start_source(min_id, max_id, self.source_ids)
+                unchanged = self.get_unchanged_models(source_db)
+                if self.incremental or self.diff:
+                    self.update_source_db(source_db, min_id, max_id,
+                                          unchanged)
+                elif self.staging:
+                    self.stage_source_db(source_db, min_id, max_id,
+                                         unchanged)
+                else:
+                    changed = self.get_changed_models(source_db, unchanged)
+                    with self.metrics.timer(source_db, None, 'delete_time'), \
+                            self.profiler.stage(source_db, None, 'delete',
+                                                connection) as profile:
+                        self.delete_from_database(min_id, max_id, changed)
+                    self.report_queries(source_db, 'delete', profile)
+                    self.copy_source_db(source_db, changed)
+                store_originating_urls(source_db, min_id, max_id,
+                                       self.batch_size)
+            checkpoint.remove()
+        except Exception as e:
+            checkpoint.fail(str(e), self.current_model)
+            if self.lookups is not None:
+                self.lookups.rollback()
+            self.metrics.set(source_db, error=str(e))
+            return str(e)
+        finally:
+            self.fetcher.discard(source_db)
+            self.metrics.add(source_db,
+                             duration=time.perf_counter() - start_time)
+
+    def get_checkpoint(self, source_db):
+        """Return the checkpoint of a source database (see checkpoint.py)."""
+        if self.checkpoint_dir:
+            return self.fetcher.get_checkpoint(source_db)
+        return NullCheckpoint()
+
+    def report_resume(self, source_db, checkpoint):
+        progress = checkpoint.progress
+        if self.verbosity >= 1:
+            self.stdout.write(
+                '{}: resuming{}; {} models had been written, and {} '
+                'downloads are reused'.format(
+                    source_db['URL'],
+                    ' at ' + progress['failed'] if progress['failed'] else '',
+                    len(progress['completed']), len(progress['downloads'])))
+
+    def report_error(self, source_db, error):
+        print('Error while copying database {}'.format(source_db['URL']),
+              file=sys.stderr)
+        print(error, file=sys.stderr)
+
+    def aggregate_in_processes(self, source_ranges):
+        """Copy the source databases in parallel, in --jobs processes.
+
+        Each source database is copied in its own process, with its own
+        database connection and transaction. The output and the errors are
+        reported here, in the order of the source databases.
+        """
+        # The worker processes must not share the database connections of
+        # this process, so we close them; each worker opens its own.
+        for conn in connections.all():
+            conn.close()
+        options = self.get_options()
+        with ProcessPoolExecutor(self.jobs) as executor:
+            futures = [
+                executor.submit(aggregate_source_in_process, options,
+                                source_db, min_id, max_id)
+                for source_db, min_id, max_id in source_ranges
+            ]
+            for (source_db, min_id, max_id), future in zip(source_ranges,
+                                                           futures):
+                try:
+                    stdout, stderr, error, metrics = future.result()
+                    self.metrics.merge_source(metrics)
+                except Exception as e:
+                    # The worker process has died
+                    stdout, stderr, error = '', '', str(e)
+                    self.metrics.set(source_db, error=error)
+                self.stdout.write(stdout, ending='')
+                self.stderr.write(stderr, ending='')
+                if error:
+                    self.report_error(source_db, error)
+
+    def get_sync_state(self, source_db, model_name):
+        return self.sync_states.get(
+            (source_db['URL'], source_db['ID_OFFSET'], model_name))
+
+    def get_unchanged_models(self, source_db):
+        """Return the names of the models that have not changed.
+
+        A model has not changed if the server responded "304 Not Modified"
+        or with the same content as in the last run. This waits for all
+        the downloads of the source database to finish.
+        """
+        result = set()
+        if self.force:
+            return result
         for model_name in self.model_names:
-            self.copy_model(source_db, model_name)
-
-    def delete_from_database(self, min_id, max_id):
-        for model_name in reversed(self.model_names):
-            model = getattr(models, model_name)
-            model.objects.filter(id__gte=min_id, id__lte=max_id).delete()
-
-    def copy_model(self, source_db, model_name):
-        # Quick hack for a very special case: deh.hydroscope.gr currently
-        # (2017-10-19) appears to have integrity errors. Don't copy its
-        # GentityAltCode table.
-        if ('deh.hydroscope.gr' in source_db['URL']) and (
-                model_name == 'GentityAltCode'):
+            self.current_model = model_name
+            fetch_result = self.fetcher.get(source_db, model_name)
+            self.current_model = None
+            sync_state = self.get_sync_state(source_db, model_name)
+            if fetch_result.not_modified or (
+                    sync_state is not None and sync_state.content_hash and
+                    sync_state.content_hash == fetch_result.content_hash):
+                result.add(model_name)
+                self.record_fetch(source_db, model_name, fetch_result)
+                self.metrics.set(source_db, model_name, unchanged=True)
+                if self.verbosity >= 2:
+                    self.stdout.write('{} {}: not modified'.format(
+                        source_db['URL'], model_name))
+        return result
+
+    def get_changed_models(self, source_db, unchanged):
+        """Return the names of the models that must be deleted and copied.
+
+        These are the models that have changed, plus those that refer to
+        them (because deleting the rows of a model also deletes the rows
+        that refer to them). The unchanged models among them are prepared
+        for copying with refetch().
+        """
+        result = get_affected(set(self.model_names) - unchanged,
+                              self.dependencies)
+        for model_name in result & unchanged:
+            self.refetch(source_db, model_name)
+        return result
+
+    def copy_source_db(self, source_db, model_names=None):
+        if model_names is None:
+            model_names = self.model_names
+        self.source_ids.expect(model_names)
+        with self.read_models(source_db, model_names) as pipeline:
+            for reader, rows in pipeline:
+                self.write_model(reader, rows)
+
+    def read_models(self, source_db, model_names):
+        """Return a Pipeline that prepares the rows of model_names.
+
+        The models are read level by level (see self.schedule); within a
+        level, those whose download has finished come first.
+        """
+        levels = [[ModelReader(self, source_db, model_name)
+                   for model_name in level if model_name in model_names]
+                  for level in self.schedule]
+        return Pipeline(levels, self.pipeline_depth, self.batch_size)
+
+    def stage_source_db(self, source_db, min_id, max_id, unchanged):
+        """Copy a source database through staging tables.
+
+        The models that have not changed are copied to the staging tables
+        from the live tables instead of the source database.
+        """
+        copied = set(self.model_names) - unchanged
+        if not copied:
             return
+        staging_tables = staging.Staging(self.model_names, min_id, max_id)
+        staging_tables.create()
 
-        model = getattr(models, model_name)
+        # The staging tables have no constraints, so the unchanged models
+        # can be copied first, whatever the order.
+        for model_name in self.model_names:
+            if model_name in unchanged:
+                staging_tables.copy_live(model_name)
+        self.source_ids.expect(copied)
+        with self.read_models(source_db, copied) as pipeline:
+            for reader, rows in pipeline:
+                self.write_model(reader, rows)
+        staging_tables.validate()
+
+        def purge():
+            with self.metrics.timer(source_db, None, 'delete_time'):
+                self.purge(min_id, max_id, self.model_names)
+
+        with self.profiler.stage(source_db, None, 'publish',
+                                 connection) as profile:
+            staging_tables.publish(purge)
+        self.report_queries(source_db, 'publish', profile)
+
+    def update_source_db(self, source_db, min_id, max_id, unchanged=()):
+        self.source_ids.expect(set(self.model_names) - set(unchanged))
+        deleted_ids = {}
+        for model_name in self.model_names:
+            rewrite = model_name in self.get_remapped_referrers()
+            if model_name in unchanged and not rewrite:
+                deleted_ids[model_name] = set()
+                continue
+            if model_name in unchanged:
+                self.refetch(source_db, model_name)
+            deleted_ids[model_name] = self.update_model(
+                source_db, model_name, min_id, max_id, rewrite)
+
+        # Objects are deleted at the end, in reverse order, so that the
+        # objects that refer to them have already been deleted.
+        with self.metrics.timer(source_db, None, 'delete_time'):
+            for model_name in reversed(self.model_names):
+                if deleted_ids[model_name]:
+                    model = getattr(models, model_name)
+                    model.objects.filter(
+                        id__in=deleted_ids[model_name]).delete()
+
+    def get_remapped_referrers(self):
+        """Return the models that refer to remapped shared lookups.
+
+        All their rows must be written, even if they have not changed,
+        because the shared objects to which they refer have changed (see
+        lookups.SharedLookups.remapped).
+        """
+        if self.lookups is None:
+            return set()
+        return set(name for name, referred in self.dependencies.items()
+                   if referred & self.lookups.remapped)
+
+    def refetch(self, source_db, model_name):
+        """Prepare to write a model that has been found unchanged.
+
+        If the server responded "304 Not Modified", the model is downloaded
+        again. The metrics recorded by get_unchanged_models() are reset, so
+        that the download is not counted twice.
+        """
+        if self.fetcher.get(source_db, model_name).not_modified:
+            self.fetcher.start(source_db, model_name)
+        self.metrics.set(source_db, model_name, unchanged=False,
+                         download_time=0, response_bytes=0)
+
+    def get_purge_mode(self):
+        result = settings.ENHYDRIS_AGGREGATOR.get('PURGE', 'orm')
+        if result not in ('orm', 'sql'):
+            raise ImproperlyConfigured(
+                'ENHYDRIS_AGGREGATOR["PURGE"] must be "orm" or "sql"; got '
+                '"{}"'.format(result))
+        return result
+
+    def purge(self, min_id, max_id, model_names):
+        """Delete the objects of model_names in an id range."""
+        model_names = [x for x in self.model_names if x in model_names]
+        if self.get_purge_mode() == 'sql':
+            purge_and_verify(model_names, min_id, max_id)
+        else:
+            for model_name in reversed(model_names):
+                model = getattr(models, model_name)
+                model.objects.filter(id__gte=min_id, id__lte=max_id).delete()
+
+    def delete_from_database(self, min_id, max_id, model_names=None):
+        if model_names is None:
+            model_names = self.model_names
+        self.purge(min_id, max_id, model_names)
+        if 'Timeseries' in model_names:
+            delete_originating_urls(min_id, max_id)
+
+        # What we remember about the deleted models is not valid any more
+        for model in (SyncState, QuarantinedObject):
+            model.objects.filter(id_offset__gte=min_id, id_offset__lte=max_id,
+                                 model_name__in=model_names).delete()
+        SharedLookup.objects.filter(object_id__gte=min_id,
+                                    object_id__lte=max_id,
+                                    model_name__in=model_names).delete()
+
+    def write_model(self, reader, rows):
+        """Write the rows of a ModelReader, which are iterated by rows."""
+        source_db = reader.source_db
+        model_name = reader.model_name
+        link_validator = LinkValidator(reader.model, self.source_ids)
+        rows = self.metrics.timed(rows, source_db, model_name, 'wait_time')
+        shared = self.lookups is not None and \
+            self.lookups.is_shared(model_name)
+        self.current_model = model_name
+        with self.write_timer(source_db, model_name), \
+                self.profiler.stage(source_db, model_name, 'write',
+                                    connection) as profile:
+            if self.lookups is not None:
+                rows = self.lookups.rewrite(reader.model, rows)
+            rows = link_validator.validate(rows)
+            if shared:
+                rows = self.lookups.share(model_name, rows)
+            count = self.writer.write(reader.model, rows)
+            if shared:
+                self.lookups.save(model_name, self.batch_size)
+        self.metrics.add(source_db, model_name, rows_written=count)
+        self.source_ids.loaded(model_name, self.lookups.get_ids(model_name)
+                               if shared else link_validator.ids)
+        self.report_queries(source_db, model_name, profile)
+        self.report_unordered(source_db, model_name, reader.reorderer)
+        self.report_dangling(source_db, model_name, link_validator)
+        self.quarantine(source_db, model_name, link_validator)
+        self.save_sync_state(source_db, model_name,
+                             reader.high_water_mark.value, reader.fetch_result)
+        self.get_checkpoint(source_db).complete(model_name)
+        self.current_model = None
+        if self.verbosity >= 2:
+            self.stdout.write('{} {}: {} rows written'.format(
+                source_db['URL'], model_name, count))
+
+    def update_model(self, source_db, model_name, min_id, max_id,
+                     rewrite=False):
+        """Copy the objects that have changed since the last run.
+
+        In incremental mode, objects that have been modified since the last
+        run (or that have no last_modified) are updated, and objects that
+        do not exist in the target database are inserted. Otherwise, or if
+        rewrite is True, all objects are upserted. In diff mode, objects
+        are compared with the target database, and only the different ones
+        are written. Returns
+        the set of target ids that do not exist in the source database any
+        more; the caller must delete them.
+        """
+        if self.lookups is not None and self.lookups.is_shared(model_name):
+            reader = ModelReader(self, source_db, model_name)
+            self.write_model(reader, iter(reader))
+            return set()
 
+        model = getattr(models, model_name)
+        id_offset = source_db['ID_OFFSET']
+        self.current_model = model_name
+        fetch_result = self.fetcher.get(source_db, model_name)
+        self.record_fetch(source_db, model_name, fetch_result)
         try:
-            r = requests.get(urljoin(source_db['URL'], 'api', model_name, ''))
-            r.raise_for_status()
-            objects = r.json()
-        except requests.HTTPError:
-            # Quick hack: Enhydris 0.2 has a bug; it does not serve
-            # IntervalType through the API (this was fixed in 1af68be). If we
-            # come across such a problem, we pretend that the API responded
-            # with the contents of IntervalType, which are the same in all
-            # known installations.
-            if model_name != 'IntervalType':
-                raise
-            objects = _interval_types
-        self.reorder(objects)
+            old_high_water_mark = SyncState.objects.get(
+                source_url=source_db['URL'], id_offset=id_offset,
+                model_name=model_name).high_water_mark
+        except SyncState.DoesNotExist:
+            old_high_water_mark = None
+        existing_ids = set(model.objects.filter(
+            id__gte=min_id, id__lte=max_id).values_list('id', flat=True))
+        source_ids = set()
+
+        # Reordering must be done on the complete stream, because a changed
+        # object may refer to an unchanged one.
+        high_water_mark = HighWaterMark()
+        reorderer = Reorderer(get_self_references(model))
+        objects = reorderer.reorder(high_water_mark.track(fetch_result))
+        objects = self.iter_changed(objects, id_offset, existing_ids,
+                                    None if rewrite else old_high_water_mark,
+                                    source_ids)
+        rows = (self.transform_object(model, item, id_offset)
+                for item in objects)
+        rows = self.metrics.timed(rows, source_db, model_name,
+                                  'transform_time')
+        rows = self.metrics.timed(rows, source_db, model_name, 'wait_time')
+        if self.lookups is not None:
+            rows = self.lookups.rewrite(model, rows)
+        link_validator = LinkValidator(model, self.source_ids,
+                                       set(existing_ids))
+        rows = link_validator.validate(rows)
+
+        inserted = updated = 0
+        with self.write_timer(source_db, model_name), \
+                self.profiler.stage(source_db, model_name, 'write',
+                                    connection) as profile:
+            for batch in batches(rows, self.batch_size):
+                if self.diff:
+                    diff = ModelDiff(model, batch, self.batch_size)
+                    inserted += self.writer.write(model, diff.new_rows)
+                    diff.apply()
+                    updated += diff.updated
+                else:
+                    new_rows = [r for r in batch
+                                if r[0]['id'] not in existing_ids]
+                    updated_rows = [r for r in batch
+                                    if r[0]['id'] in existing_ids]
+                    inserted += self.writer.write(model, new_rows)
+                    self.writer.update(model, updated_rows)
+                    updated += len(updated_rows)
+        self.metrics.add(source_db, model_name, objects=len(source_ids),
+                         rows_written=inserted + updated)
+        self.report_queries(source_db, model_name, profile)
+        self.report_unordered(source_db, model_name, reorderer)
+        self.report_dangling(source_db, model_name, link_validator)
+        self.quarantine(source_db, model_name, link_validator)
+        self.save_sync_state(source_db, model_name, high_water_mark.value,
+                             fetch_result)
+        self.get_checkpoint(source_db).complete(model_name)
+        self.current_model = None
+
+        deleted_ids = existing_ids - source_ids
+        self.source_ids.loaded(model_name, link_validator.ids - deleted_ids)
+        if self.verbosity >= 2:
+            self.stdout.write(
+                '{} {}: {} rows unchanged, {} updated, {} inserted, '
+                '{} deleted'.format(source_db['URL'], model_name,
+                                    len(source_ids) - inserted - updated,
+                                    updated, inserted, len(deleted_ids)))
+        return deleted_ids
+
+    def iter_changed(self, objects, id_offset, existing_ids,
+                     old_high_water_mark, source_ids):
+        """Yield the objects that need to be written by update_model().
+
+        The target ids of all objects (changed or not) are added to
+        source_ids.
+        """
         for item in objects:
-            self.copy_object(model, item, source_db['ID_OFFSET'])
-
-    def __rename_field(self, old_prefix, new_prefix, item, key):
-        if not key.startswith(old_prefix):
-            return key
-        new_key = new_prefix + key[len(old_prefix):]
-        item[new_key] = item[key]
-        del item[key]
-        return new_key
-
-    def copy_object(self, model, item, id_offset):
-        many_to_many = {}
-        fields = list(item.keys())
-
-        for key in fields:
-            # Ignore obsolete fields from source databases with older
-            # Enhydris versions. Also ignore last_modified because it causes
-            # too many warnings and is most probably useless anyway (and may
-            # be removed in the future).
-            if key in ('original_id', 'original_db', 'is_active',
-                       'last_modified'):
-                del item[key]
+            target_id = item['id'] + id_offset
+            source_ids.add(target_id)
+            if not self.incremental or target_id not in existing_ids or \
+                    old_high_water_mark is None:
+                yield item
                 continue
+            last_modified = parse_last_modified(item)
+            if last_modified is None or last_modified >= old_high_water_mark:
+                yield item
 
-            # Take care about fields that have been renamed from older Enhydris
-            # versions
-            key = self.__rename_field('nominal_offset_', 'timestamp_rounding_',
-                                      item, key)
-            key = self.__rename_field('actual_offset_', 'timestamp_offset_',
-                                      item, key)
-
-            field = model._meta.get_field(key)
-
-            # Append _id to foreign key field names
-            if field.many_to_one or field.one_to_one:
-                item[key + '_id'] = item[key]
-                del item[key]
-
-            # Save ManyToMany fields for later
-            if field.many_to_many:
-                many_to_many[key] = item[key]
-                del item[key]
-
-            # Ignore file fields (these are in the original database only)
-            field = model._meta.get_field(key)
-            if isinstance(field, FileField):
-                del item[key]
-
-        # Add offset to id and all fields ending in _id
-        for key in item.keys():
-            if key != 'id' and not key.endswith('_id'):
-                continue
-            if item[key] is None:
-                continue
-            item[key] += id_offset
+    def record_fetch(self, source_db, model_name, fetch_result):
+        self.metrics.add(source_db, model_name,
+                         download_time=fetch_result.download_time,
+                         response_bytes=fetch_result.size)
 
-        # Save to database
-        new_model_instance = model(**item)
-        new_model_instance.save()
+    @contextmanager
+    def write_timer(self, source_db, model_name):
+        """Add the time spent writing in the with block to write_time.
 
-        # Add many-to-many relationships
-        for m2m in many_to_many:
-            many_to_many[m2m] = [x + id_offset for x in many_to_many[m2m]]
-            field = model._meta.get_field(m2m)
+        This is the duration of the block minus the time the writer waited
+        for the rows (wait_time).
+        """
+        start_time = time.perf_counter()
+        wait_time = self.metrics.get(source_db, model_name, 'wait_time')
+        try:
+            yield
+        finally:
+            wait_time = self.metrics.get(source_db, model_name,
+                                         'wait_time') - wait_time
+            self.metrics.add(
+                source_db, model_name,
+                write_time=time.perf_counter() - start_time - wait_time)
+
+    def save_sync_state(self, source_db, model_name, high_water_mark,
+                        fetch_result):
+        SyncState.objects.update_or_create(
+            source_url=source_db['URL'], id_offset=source_db['ID_OFFSET'],
+            model_name=model_name,
+            defaults={'high_water_mark': high_water_mark,
+                      'etag': fetch_result.etag,
+                      'last_modified': fetch_result.last_modified,
+                      'content_hash': fetch_result.content_hash})
+
+    def transform_object(self, model, item, id_offset):
+        """Convert an object fetched from the API to a row of the target.
+
+        item is a dictionary, as served by the API of the source database.
+        Returns a tuple (row, many_to_many); see plans.TransformPlan.apply().
+        """
+        return get_plan(model, item).apply(item, id_offset)
 
-            # Skip relationships with "through", they are taken care of
-            # elsewhere
-            if not field.rel.through._meta.auto_created:
-                continue
+    def warn(self, source_db, model_name, message, items):
+        """Write a warning about some objects to stderr.
+
+        message describes the problem, and items is a list of the affected
+        objects; only the first few are shown.
+        """
+        self.stderr.write('Warning: {} {}: {} {}: {}'.format(
+            source_db['URL'], model_name, len(items), message,
+            ', '.join(str(x) for x in items[:10]) +
+            (', ...' if len(items) > 10 else '')))
 
-            for m2m_item in many_to_many[m2m]:
-                o = field.related_model.objects.get(pk=m2m_item)
-                getattr(new_model_instance, m2m).add(o)
+    def report_unordered(self, source_db, model_name, reorderer):
+        """Warn about the objects that refer to one another in cycles.
 
-    def reorder(self, objects):
-        """Re-order so that foreign keys do not refer to nonexistent objects.
-        objects is a list of dictionaries. If these objects contain a "parent"
-        key, it is assumed to be a self reference. The list is reordered
-        in place so that such references refer to preceding objects.
+        The objects that the reorderer could not order because they refer
+        to nonexistent objects are quarantined, and reported by
+        quarantine().
         """
-        if (len(objects) <= 1) or ('parent' not in objects[0]):
-            return
-        seen_ids = set()
-        i = 0
-        while i < len(objects):
-            obj = objects[i]
-
-            # If no problem, then no problem
-            if obj['parent'] is None or obj['parent'] in seen_ids:
-                i += 1
-                seen_ids.add(obj['id'])
-                continue
+        if reorderer.cycles:
+            self.warn(source_db, model_name, 'objects refer to a cycle',
+                      reorderer.cycles)
 
-            # Find the referent
-            j = i + 1
-            while j < len(objects):
-                if objects[j]['id'] == obj['parent']:
-                    break
-                j += 1
+    def report_queries(self, source_db, model_name, profile):
+        """Show the number of queries counted by --profile.
 
-            # Swap them
-            objects[i], objects[j] = objects[j], objects[i]
+        model_name may also be the name of a stage that concerns the whole
+        source database, such as "delete".
+        """
+        if 'queries' in profile and self.verbosity >= 1:
+            self.stdout.write('{} {}: {} queries in {:.3f} s'.format(
+                source_db['URL'], model_name, profile['queries'],
+                profile['query_time']))
+
+    def report_dangling(self, source_db, model_name, link_validator):
+        """Warn about the many-to-many links that have been dropped."""
+        if link_validator.dangling:
+            self.warn(source_db, model_name,
+                      'links to nonexistent objects have been dropped',
+                      ['{}.{} -> {}'.format(*x)
+                       for x in link_validator.dangling])
+
+    def quarantine(self, source_db, model_name, link_validator):
+        """Replace the quarantined objects of a model, and warn about them.
+
+        These are the objects that the link validator did not let through.
+        """
+        QuarantinedObject.objects.filter(
+            source_url=source_db['URL'], id_offset=source_db['ID_OFFSET'],
+            model_name=model_name).delete()
+        quarantined = link_validator.quarantined
+        self.metrics.add(source_db, model_name, quarantined=len(quarantined))
+        if not quarantined:
+            return
+        QuarantinedObject.objects.bulk_create([
+            QuarantinedObject(
+                source_url=source_db['URL'], id_offset=source_db['ID_OFFSET'],
+                model_name=model_name, object_id=row['id'], reason=reason,
+                data=json.dumps(dict(row, **many_to_many), sort_keys=True,
+                                default=str))
+            for row, many_to_many, reason in quarantined
+        ], batch_size=self.batch_size)
+        self.warn(source_db, model_name,
+                  'objects refer to nonexistent objects and have been '
+                  'quarantined',
+                  ['{} ({})'.format(row['id'], reason)
+                   for row, many_to_many, reason in quarantined])
@@ -0,0 +1,151 @@
+import random
+import signal
+import threading
+import time
+
+from django.core.management.base import CommandError
+from django.db import connection
+
+from ...metrics import Metrics
+from . import aggregate
+
+
+class Command(aggregate.Command):
+    """Keep running, and copy each source database on its own schedule.
+
+    Unlike running "aggregate" from cron, the process is started once, so
+    Django, the models, the load plans (see plans.py) and the HTTP sessions
+    of the source databases (see fetch.Fetcher) are set up only once and
+    reused by all syncs. The source databases are copied one at a time, in
+    the order in which they become due; a source database becomes due
+    again INTERVAL seconds (plus a random jitter) after its previous sync
+    has finished, so two syncs of the same source database never overlap,
+    and a slow sync postpones the next one instead of piling up. Since
+    there is a single loop, a slow or hanging source database also delays
+    the others past their INTERVAL; the timeouts of the source databases
+    (see transport.py) limit how long it can hang.
+    """
+
+    help = "Keeps running and copies each source database periodically. " \
+        "The source databases are copied one at a time (--jobs is not " \
+        "supported), so a slow or hanging source database delays the " \
+        "syncs of the others, possibly past their INTERVAL; set its " \
+        "CONNECT_TIMEOUT and READ_TIMEOUT to limit how long it can hang."
+    interval = 86400
+    jitter = 300
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--interval', type=float, default=self.interval,
+            help='Seconds between the end of a sync of a source database '
+            'and the start of the next one, for the source databases that '
+            'do not specify INTERVAL (default: %(default)s)')
+        parser.add_argument(
+            '--jitter', type=float, default=self.jitter,
+            help='Maximum number of seconds by which each sync is randomly '
+            'delayed, so that syncs scheduled for the same time are spread '
+            '(default: %(default)s)')
+        parser.add_argument(
+            '--max-syncs', type=int,
+            help='Exit after this many syncs (default: run until '
+            'terminated)')
+
+    def handle(self, *args, **options):
+        if options['show_plan']:
+            self.show_plan()
+            return
+        self.configure(options)
+        self.interval = options['interval']
+        self.jitter = options['jitter']
+        self.max_syncs = options['max_syncs']
+        if self.jobs > 1:
+            raise CommandError('aggregate_daemon copies one source database '
+                               'at a time; --jobs is not supported')
+        if self.interval <= 0:
+            raise CommandError('--interval must be positive')
+        if self.jitter < 0:
+            raise CommandError('--jitter must not be negative')
+        if self.max_syncs is not None and self.max_syncs < 1:
+            raise CommandError('--max-syncs must be a positive integer')
+        for source_db, min_id, max_id in self.get_source_ranges():
+            if self.get_interval(source_db) <= 0:
+                raise CommandError('The INTERVAL of {} must be positive'
+                                   .format(source_db['URL']))
+
+        self.stopping = threading.Event()
+        handlers = {signum: signal.signal(signum, self.stop)
+                    for signum in (signal.SIGTERM, signal.SIGINT)}
+        self.fetcher = self.create_fetcher()
+        self.profiler.start(connection)
+        try:
+            self.run()
+        finally:
+            self.fetcher.shutdown()
+            self.profiler.stop()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def stop(self, signum=None, frame=None):
+        """Exit after the current sync; the signal handler."""
+        self.stopping.set()
+
+    def get_interval(self, source_db):
+        return source_db.get('INTERVAL', self.interval)
+
+    def get_delay(self, source_db):
+        """Return the seconds from now until the next sync of source_db."""
+        return self.get_interval(source_db) + random.uniform(0, self.jitter)
+
+    def run(self):
+        """Sync the source databases as they become due, until stopped."""
+        source_ranges = self.get_source_ranges()
+        now = time.monotonic()
+        due = [now + random.uniform(0, self.jitter) for x in source_ranges]
+        syncs = 0
+        while not self.stopping.is_set():
+            i = min(range(len(source_ranges)), key=lambda i: due[i])
+            delay = due[i] - time.monotonic()
+            if delay > 0:
+                # Wakes up early if stop() is called
+                self.stopping.wait(delay)
+                continue
+            self.sync(*source_ranges[i])
+            due[i] = time.monotonic() + self.get_delay(source_ranges[i][0])
+            syncs += 1
+            if self.max_syncs is not None and syncs >= self.max_syncs:
+                break
+
+    def sync(self, source_db, min_id, max_id):
+        """Copy a source database, and write the metrics.
+
+        Errors are reported and do not stop the daemon.
+        """
+        all_metrics, self.metrics = self.metrics, Metrics()
+        try:
+            self.prepare()
+            self.start_fetching_source(source_db)
+            error = self.aggregate_source(source_db, min_id, max_id)
+            self.collect_garbage()
+        except Exception as e:
+            error = str(e)
+            self.metrics.set(source_db, error=error)
+        finally:
+            # The connection may be idle for hours until the next sync, so
+            # we reconnect then (unless we are inside a transaction, as in
+            # the unit tests).
+            if not connection.in_atomic_block:
+                connection.close()
+        if error:
+            self.report_error(source_db, error)
+        self.metrics.finish()
+        all_metrics.merge_source(self.metrics.get_source(source_db))
+        all_metrics.data.update(started=self.metrics.data['started'],
+                                duration=self.metrics.data['duration'])
+        self.metrics = all_metrics
+        self.save_metrics()
+        if self.verbosity >= 1:
+            self.stdout.write('{} ({}): {} in {:.1f} s'.format(
+                source_db['URL'], source_db['ID_OFFSET'],
+                'failed' if error else 'synced',
+                self.metrics.data['duration']))
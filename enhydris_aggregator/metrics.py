@@ -0,0 +1,238 @@
+"""Measure where the time of a run of the aggregator goes.
+
+A Metrics object collects, for each source database, how long copying it
+took and how long deleting its old objects took, and, for each model of
+the source database, how long the download took, how large the response
+was, how many objects were read, written and quarantined, and how much
+time was spent preparing (parsing, reordering and transforming) and
+writing them, and how long the writing waited for the preparation (see
+pipeline.py). The
+result can be written as JSON (write_json()) or in the text format of
+Prometheus (write_prometheus()), which is meant for the textfile collector
+of the Prometheus node exporter.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.utils import timezone
+
+# The numeric metrics of a model, with their Prometheus help texts
+MODEL_METRICS = (
+    ('download_time', 'Seconds spent downloading the objects'),
+    ('response_bytes', 'Size of the API response in bytes'),
+    ('objects', 'Number of objects read'),
+    ('rows_written', 'Number of rows written'),
+    ('quarantined', 'Number of objects not written because they refer to '
+     'nonexistent objects'),
+    ('transform_time', 'Seconds spent parsing and transforming the objects'),
+    ('wait_time', 'Seconds the writer waited for the objects to be '
+     'transformed'),
+    ('write_time', 'Seconds spent writing the objects'),
+)
+
+# The numeric metrics of a source database
+SOURCE_METRICS = (
+    ('duration', 'Seconds spent copying the source database'),
+    ('delete_time', 'Seconds spent deleting the old objects'),
+)
+
+
+class Metrics:
+    """The measurements of a run.
+
+    The measurements are kept in "data", a dictionary that can be
+    serialized as JSON; see as_dict() for its structure. The methods may be
+    called from many threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.data = {
+            'started': timezone.now().isoformat(),
+            'duration': 0,
+            'sources': [],
+        }
+
+    def get_source(self, source_db):
+        for source in self.data['sources']:
+            if (source['url'], source['id_offset']) == (
+                    source_db['URL'], source_db['ID_OFFSET']):
+                return source
+        source = {'url': source_db['URL'],
+                  'id_offset': source_db['ID_OFFSET'],
+                  'error': None,
+                  'models': {}}
+        source.update((name, 0) for name, help in SOURCE_METRICS)
+        self.data['sources'].append(source)
+        return source
+
+    def get_model(self, source_db, model_name):
+        models = self.get_source(source_db)['models']
+        if model_name not in models:
+            models[model_name] = {'unchanged': False}
+            models[model_name].update((name, 0)
+                                      for name, help in MODEL_METRICS)
+        return models[model_name]
+
+    def add(self, source_db, model_name=None, **values):
+        """Add values to the metrics of a source database or of a model.
+
+        The keyword arguments are metric names and the amounts to add. If
+        model_name is None, the metrics are those of the source database.
+        """
+        with self.lock:
+            if model_name is None:
+                metrics = self.get_source(source_db)
+            else:
+                metrics = self.get_model(source_db, model_name)
+            for name, value in values.items():
+                metrics[name] += value
+
+    def get(self, source_db, model_name, name):
+        """Return the value of a metric of a model."""
+        with self.lock:
+            return self.get_model(source_db, model_name)[name]
+
+    def set(self, source_db, model_name=None, **values):
+        """Like add(), but replace the values instead of adding to them."""
+        with self.lock:
+            if model_name is None:
+                metrics = self.get_source(source_db)
+            else:
+                metrics = self.get_model(source_db, model_name)
+            metrics.update(values)
+
+    @contextmanager
+    def timer(self, source_db, model_name, name):
+        """Add the duration of the with block to a metric."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(source_db, model_name,
+                     **{name: time.perf_counter() - start_time})
+
+    def timed(self, iterable, source_db, model_name, name):
+        """Iterate over iterable, adding the time taken to a metric.
+
+        Only the time spent in the iterable is measured, not the time
+        spent by the consumer between the items.
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(source_db, model_name,
+                         **{name: time.perf_counter() - start_time})
+            yield item
+
+    def merge_source(self, source):
+        """Add the metrics of a source database measured elsewhere.
+
+        source is an element of the "sources" list of the data of another
+        Metrics object, e.g. of a worker process.
+        """
+        with self.lock:
+            self.data['sources'] = [
+                x for x in self.data['sources']
+                if (x['url'], x['id_offset']) !=
+                (source['url'], source['id_offset'])
+            ] + [source]
+
+    def finish(self):
+        """Set the duration of the run; call it at the end."""
+        self.data['duration'] = time.perf_counter() - self.start_time
+
+    def as_dict(self):
+        """Return the measurements.
+
+        The result is a dictionary with the keys "started" (the start time
+        of the run in ISO 8601 format), "duration" (in seconds) and
+        "sources". The latter is a list with one dictionary for each source
+        database, with the keys "url", "id_offset", "error" (the error
+        message if copying the source database failed), those of
+        SOURCE_METRICS, and "models". The latter is a dictionary mapping
+        each model name to a dictionary with the keys of MODEL_METRICS and
+        "unchanged", which is true if the model has not changed since the
+        last run.
+        """
+        return self.data
+
+    def write_json(self, filename):
+        _write_atomically(filename, json.dumps(self.as_dict(), indent=2,
+                                               sort_keys=True) + '\n')
+
+    def write_prometheus(self, filename):
+        """Write the metrics in the Prometheus text format.
+
+        The file is replaced atomically, so that the textfile collector
+        never reads a partially written file.
+        """
+        lines = []
+
+        def add_metric(name, help, samples):
+            name = 'enhydris_aggregator_' + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                              float(value)))
+
+        def source_labels(source, **labels):
+            labels.update(source=source['url'],
+                          id_offset=str(source['id_offset']))
+            return labels
+
+        sources = self.data['sources']
+        add_metric('duration_seconds', 'Seconds spent in the last run',
+                   [({}, self.data['duration'])])
+        add_metric('source_errors', 'Whether copying the source database '
+                   'failed in the last run',
+                   [(source_labels(x), int(x['error'] is not None))
+                    for x in sources])
+        for name, help in SOURCE_METRICS:
+            add_metric('source_' + _prometheus_name(name), help,
+                       [(source_labels(x), x[name]) for x in sources])
+        for name, help in MODEL_METRICS:
+            add_metric('model_' + _prometheus_name(name), help,
+                       [(source_labels(x, model=model_name), model[name])
+                        for x in sources
+                        for model_name, model in sorted(x['models'].items())])
+        _write_atomically(filename, '\n'.join(lines) + '\n')
+
+
+def _prometheus_name(name):
+    if name.endswith('_time') or name == 'duration':
+        return name.replace('_time', '') + '_seconds'
+    return name
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())) + '}'
+
+
+def _write_atomically(filename, content):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, filename)
+    except Exception:
+        os.unlink(tmpname)
+        raise
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False,
+                                        auto_created=True, primary_key=True)),
+                ('source_url', models.CharField(max_length=255)),
+                ('id_offset', models.IntegerField()),
+                ('model_name', models.CharField(max_length=50)),
+                ('high_water_mark', models.DateTimeField(null=True,
+                                                         blank=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='syncstate',
+            unique_together=set([('source_url', 'id_offset', 'model_name')]),
+        ),
+    ]
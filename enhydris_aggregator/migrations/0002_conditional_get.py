@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('enhydris_aggregator', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='etag',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='last_modified',
+            field=models.CharField(max_length=255, blank=True),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='content_hash',
+            field=models.CharField(max_length=64, blank=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('enhydris_aggregator', '0002_conditional_get'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OriginatingUrl',
+            fields=[
+                ('timeseries_id', models.IntegerField(serialize=False,
+                                                      primary_key=True)),
+                ('url', models.CharField(max_length=255)),
+            ],
+        ),
+    ]
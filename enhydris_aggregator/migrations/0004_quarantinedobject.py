@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('enhydris_aggregator', '0003_originatingurl'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuarantinedObject',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False,
+                                        auto_created=True, primary_key=True)),
+                ('source_url', models.CharField(max_length=255)),
+                ('id_offset', models.IntegerField()),
+                ('model_name', models.CharField(max_length=50)),
+                ('object_id', models.IntegerField()),
+                ('reason', models.CharField(max_length=255)),
+                ('data', models.TextField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('enhydris_aggregator', '0004_quarantinedobject'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedLookup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False,
+                                        auto_created=True, primary_key=True)),
+                ('model_name', models.CharField(max_length=50)),
+                ('object_id', models.IntegerField()),
+                ('shared_id', models.IntegerField()),
+                ('content_hash', models.CharField(max_length=64)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='sharedlookup',
+            unique_together=set([('model_name', 'object_id')]),
+        ),
+    ]
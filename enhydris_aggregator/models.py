@@ -0,0 +1,85 @@
+from django.db import models
+
+
+class SyncState(models.Model):
+    """What the aggregator remembers about a model of a source database.
+
+    high_water_mark is the largest last_modified of the objects copied in
+    the last successful run; objects that have not been modified since
+    then need not be copied again by "./manage.py aggregate --incremental".
+
+    etag and last_modified are the validators of the HTTP response of the
+    last successful run, and content_hash is the SHA-256 of its body; if
+    the response has not changed since then, the model is not copied.
+    """
+    source_url = models.CharField(max_length=255)
+    id_offset = models.IntegerField()
+    model_name = models.CharField(max_length=50)
+    high_water_mark = models.DateTimeField(null=True, blank=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=255, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        unique_together = ('source_url', 'id_offset', 'model_name')
+
+    def __str__(self):
+        return '{} ({}) {}'.format(self.source_url, self.id_offset,
+                                   self.model_name)
+
+
+class OriginatingUrl(models.Model):
+    """The URL of a copied time series in its originating database.
+
+    These are only stored if the STORE_ORIGINATING_URLS setting is True;
+    see sources.store_originating_urls().
+    """
+    timeseries_id = models.IntegerField(primary_key=True)
+    url = models.CharField(max_length=255)
+
+    def __str__(self):
+        return '{} {}'.format(self.timeseries_id, self.url)
+
+
+class QuarantinedObject(models.Model):
+    """An object of a source database that has not been copied.
+
+    The aggregator does not copy the objects that refer to objects that do
+    not exist (see links.LinkValidator); it keeps them here instead, so
+    that they can be examined and fixed in the source database. object_id
+    is the id in the target database, data is the row that would have been
+    written, in JSON, and reason explains what is wrong with it. Each time
+    a model of a source database is copied, its quarantined objects are
+    replaced.
+    """
+    source_url = models.CharField(max_length=255)
+    id_offset = models.IntegerField()
+    model_name = models.CharField(max_length=50)
+    object_id = models.IntegerField()
+    reason = models.CharField(max_length=255)
+    data = models.TextField()
+
+    def __str__(self):
+        return '{} ({}) {} {}'.format(self.source_url, self.id_offset,
+                                      self.model_name, self.object_id)
+
+
+class SharedLookup(models.Model):
+    """The shared object to which a lookup object of a source is mapped.
+
+    object_id is the id the lookup object would have in the target database
+    (i.e. with the ID_OFFSET of its source database), and shared_id is the
+    id of the shared object with the same content, whose hash is
+    content_hash. See lookups.py.
+    """
+    model_name = models.CharField(max_length=50)
+    object_id = models.IntegerField()
+    shared_id = models.IntegerField()
+    content_hash = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('model_name', 'object_id')
+
+    def __str__(self):
+        return '{} {} -> {}'.format(self.model_name, self.object_id,
+                                    self.shared_id)
@@ -0,0 +1,100 @@
+"""Order objects so that their self references refer to preceding objects.
+
+Some models, such as PoliticalDivision and WaterBasin, have foreign keys to
+themselves, and the source database may serve the children before their
+parents. Reorderer fixes the order in a single pass over the objects.
+"""
+
+
+class Reorderer:
+    """Re-order objects so that self references refer to preceding objects.
+
+    keys is a sequence of the keys of the objects (dictionaries with an "id")
+    that are self references (see dependencies.get_self_references()).
+    reorder() is a generator that yields the objects in a suitable order.
+    Objects whose parents have not appeared yet are held back until they
+    do, so only these are kept in memory, and the whole operation takes
+    linear time.
+
+    Objects that cannot be ordered are yielded at the end, and their ids
+    are appended to the following attributes:
+
+    orphans
+        The objects that refer to an id that does not exist.
+
+    cycles
+        The objects that are part of a cycle of references, or that refer
+        to such an object. Each cycle is broken at an arbitrary object;
+        on databases that check foreign keys at the end of the transaction
+        (e.g. PostgreSQL) the objects can still be written.
+    """
+
+    def __init__(self, keys=('parent',)):
+        self.keys = tuple(keys)
+        self.orphans = []
+        self.cycles = []
+
+    def reorder(self, objects):
+        seen_ids = set()
+        held = {}  # Objects held back, by id
+        waiting = {}  # Objects held back, by the id they wait for
+        missing = {}  # Number of parents each held object waits for
+
+        def release(obj):
+            # Yield obj and the objects that have been waiting for it
+            stack = [obj]
+            while stack:
+                obj = stack.pop()
+                # The consumer may modify obj (e.g. add an offset to the id),
+                # so we must not look at it after yielding it.
+                id = obj['id']
+                held.pop(id, None)
+                missing.pop(id, None)
+                seen_ids.add(id)
+                yield obj
+                for child in waiting.pop(id, ()):
+                    if child['id'] not in missing:
+                        continue  # Already released
+                    missing[child['id']] -= 1
+                    if not missing[child['id']]:
+                        stack.append(child)
+
+        for obj in objects:
+            parents = set(obj.get(key) for key in self.keys) - seen_ids
+            parents.discard(None)
+            if not parents:
+                for x in release(obj):
+                    yield x
+                continue
+            held[obj['id']] = obj
+            missing[obj['id']] = len(parents)
+            for parent in parents:
+                waiting.setdefault(parent, []).append(obj)
+
+        # Objects whose parents do not exist; links.LinkValidator will
+        # quarantine them.
+        orphan_ids = set()
+        for parent in [p for p in waiting if p not in held]:
+            for child in waiting.pop(parent, ()):
+                if child['id'] not in missing:
+                    continue
+                if child['id'] not in orphan_ids:
+                    orphan_ids.add(child['id'])
+                    self.orphans.append(child['id'])
+                missing[child['id']] -= 1
+                if not missing[child['id']]:
+                    for x in release(child):
+                        yield x
+
+        # Whatever remains depends on a cycle; we break each cycle at an
+        # object that is on it, found by following the references.
+        while held:
+            obj = held[next(iter(held))]
+            visited = set()
+            while obj['id'] not in visited:
+                visited.add(obj['id'])
+                obj = next(held[obj[key]] for key in self.keys
+                           if obj.get(key) in held)
+            for x in release(obj):
+                self.cycles.append(x['id'])
+                yield x
@@ -0,0 +1,150 @@
+"""Prepare the rows of the next models while the current one is written.
+
+Copying a model has stages that do not use the database (waiting for the
+download, parsing, reordering and transforming the objects) and stages
+that do (checking the links and writing). The database stages must run in
+the thread that owns the connection and the transaction, and in the order
+of the models, but nothing prevents the other stages of the next models
+from running at the same time in another thread. A Pipeline does this: a
+producer thread iterates over the streams of rows, one stream after the
+other, and puts the rows in batches into a bounded queue, from which the
+consumer takes them. The queue holds at most "depth" batches, which limits
+how far ahead of the consumer, and how much memory, the producer may get.
+
+The streams are grouped in levels (see dependencies.get_schedule()); the
+streams of a level do not depend on one another, so the producer takes
+them in the order in which they become ready (e.g. the model whose
+download finishes first), and the consumer receives them in that order.
+"""
+
+from queue import Empty, Full, Queue
+import threading
+
+from .writers import batches
+
+# Mark the start and the end of a stream in the queue
+_START = object()
+_END = object()
+
+
+class Pipeline:
+    """Iterate over streams of rows in a background thread.
+
+    levels is a list of lists of iterables (the streams). A stream may have
+    a ready() method, which tells whether iterating over it can start
+    without waiting. Iterating over the pipeline yields (stream, rows)
+    tuples, one for each stream, level after level, where rows is an
+    iterator over the rows of the stream; it must be exhausted before the
+    next tuple is requested. Within a level, ready streams come first. If
+    iterating over a stream raises an exception, rows raises it. Rows are
+    produced ahead in batches of batch_size, and at most depth batches wait
+    to be consumed; if depth is zero, there is no background thread and
+    each stream is iterated over when it is consumed.
+
+    Use the pipeline as a context manager, so that the producer stops if
+    the consumer does not finish.
+    """
+
+    def __init__(self, levels, depth, batch_size):
+        self.levels = levels
+        self.depth = depth
+        self.batch_size = batch_size
+        self.queue = Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if self.depth:
+            self.thread = threading.Thread(target=self.produce, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the producer and wait for it to finish."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def iter_streams(self):
+        """Yield the streams in the order in which they are produced."""
+        for level in self.levels:
+            remaining = list(level)
+            while remaining:
+                stream = self.choose(remaining)
+                if stream is None:
+                    return
+                remaining.remove(stream)
+                yield stream
+
+    def choose(self, streams):
+        """Return the first ready stream, waiting until there is one.
+
+        Returns None if the pipeline is closed while waiting.
+        """
+        while not self.stopped.is_set():
+            for stream in streams:
+                if not hasattr(stream, 'ready') or stream.ready():
+                    return stream
+            self.stopped.wait(0.05)
+        return None
+
+    def produce(self):
+        try:
+            for stream in self.iter_streams():
+                if not self.put((stream, _START)):
+                    return
+                for batch in batches(stream, self.batch_size):
+                    if not self.put((stream, batch)):
+                        return
+                if not self.put((stream, _END)):
+                    return
+        except Exception as e:
+            self.put((None, e))
+
+    def put(self, item):
+        """Put an item in the queue, unless the pipeline is closed.
+
+        Returns False if the pipeline has been closed.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def __iter__(self):
+        if not self.depth:
+            for stream in self.iter_streams():
+                yield stream, iter(stream)
+            return
+        for i in range(sum(len(level) for level in self.levels)):
+            stream, marker = self.get()
+            assert marker is _START, \
+                'The previous stream has not been consumed'
+            yield stream, self.iter_stream()
+
+    def get(self):
+        while True:
+            try:
+                stream, batch = self.queue.get(timeout=0.1)
+            except Empty:
+                if not self.thread.is_alive():
+                    raise RuntimeError('The pipeline has stopped')
+                continue
+            if stream is None:
+                raise batch
+            return stream, batch
+
+    def iter_stream(self):
+        while True:
+            stream, batch = self.get()
+            if batch is _END:
+                return
+            for row in batch:
+                yield row
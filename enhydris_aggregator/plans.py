@@ -0,0 +1,98 @@
+"""Convert the objects fetched from the API to rows of the target database.
+
+The objects served for a model usually all have the same keys, so the work
+of finding out what to do with each key (which involves looking at the
+fields of the model) is done once, by compiling a TransformPlan, and the
+plan is then applied to each object.
+"""
+
+from django.db.models import FileField
+
+# Fields of source databases with older Enhydris versions that we ignore.
+# We also ignore last_modified because it causes too many warnings and is
+# most probably useless anyway (and may be removed in the future).
+IGNORED_KEYS = ('original_id', 'original_db', 'is_active', 'last_modified')
+
+# Fields that have been renamed since older Enhydris versions
+RENAMED_PREFIXES = (('nominal_offset_', 'timestamp_rounding_'),
+                    ('actual_offset_', 'timestamp_offset_'))
+
+
+class TransformPlan:
+    """What to do with each key of the objects of a model.
+
+    The plan is compiled for a model and a sequence of keys, and has the
+    following attributes, which are lists of (source key, target key)
+    tuples (the target key is the name of the keyword argument of the
+    model's constructor):
+
+    copied
+        The keys whose values are copied unchanged.
+
+    offset
+        The keys whose values are ids, to which the id offset is added:
+        the id and the foreign keys.
+
+    many_to_many
+        The many-to-many fields; their values are lists of ids.
+
+    The remaining keys (obsolete fields and file fields, which are in the
+    original database only) are dropped.
+    """
+
+    def __init__(self, model, keys):
+        self.model = model
+        self.copied = []
+        self.offset = []
+        self.many_to_many = []
+        for key in keys:
+            if key in IGNORED_KEYS:
+                continue
+            target_key = key
+            for old_prefix, new_prefix in RENAMED_PREFIXES:
+                if target_key.startswith(old_prefix):
+                    target_key = new_prefix + target_key[len(old_prefix):]
+            field = model._meta.get_field(target_key)
+            if isinstance(field, FileField):
+                continue
+            if field.many_to_many:
+                self.many_to_many.append((key, target_key))
+                continue
+            if field.many_to_one or field.one_to_one:
+                target_key += '_id'
+            if target_key == 'id' or target_key.endswith('_id'):
+                self.offset.append((key, target_key))
+            else:
+                self.copied.append((key, target_key))
+
+    def apply(self, item, id_offset):
+        """Convert an object to a row of the target.
+
+        item is a dictionary, as served by the API of the source database.
+        Returns a tuple (row, many_to_many), where row is a dictionary that
+        can be used as the keyword arguments of the model's constructor,
+        and many_to_many is a dictionary mapping the names of the
+        many-to-many fields to lists of target ids.
+        """
+        row = {target_key: item[key] for key, target_key in self.copied}
+        for key, target_key in self.offset:
+            value = item[key]
+            row[target_key] = value if value is None else value + id_offset
+        many_to_many = {
+            target_key: [id + id_offset for id in item[key]]
+            for key, target_key in self.many_to_many
+        }
+        return row, many_to_many
+
+
+_plans = {}
+
+
+def get_plan(model, item):
+    """Return the plan for an object of a model, compiling it if needed."""
+    key = (model, tuple(item))
+    try:
+        return _plans[key]
+    except KeyError:
+        plan = _plans[key] = TransformPlan(model, key[1])
+        return plan
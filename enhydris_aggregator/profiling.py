@@ -0,0 +1,172 @@
+"""Profile the stages of a run of the aggregator.
+
+A Profiler wraps each stage of a run (e.g. the transformation or the
+writing of a model of a source database) in cProfile, and, if memory
+tracing is enabled, in tracemalloc. For each stage it writes the following
+files to a directory, whose names start with the source database, the
+model and the stage:
+
+NAME.prof
+    The cProfile statistics, which can be examined with pstats or with
+    tools such as snakeviz.
+
+NAME.txt
+    The number of SQL queries made during the stage and the time they
+    took, and, if memory tracing is enabled, the size of the memory
+    allocated during the stage and the lines that allocated most of it.
+
+The stages that run in the same thread at the same time (e.g. the
+transformation of a model, which runs in the thread that writes it if
+--pipeline-depth is 0) are included in the outer stage. Memory is traced
+for all threads, so the allocation sites of a stage may include those of
+a stage that runs at the same time in another thread.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import os
+import threading
+import time
+import tracemalloc
+
+from .sources import get_source_name
+
+# Number of allocation sites listed for each stage
+TOP_ALLOCATIONS = 25
+
+
+class QueryLog:
+    """Count the queries that Django's debug cursor logs.
+
+    Django's debug cursor appends each query it executes to the queries_log
+    of the connection. Replacing the queries_log with a QueryLog counts the
+    queries without keeping them in memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+
+    def append(self, query):
+        self.count += 1
+        self.time += float(query['time'] or 0)
+
+    def clear(self):
+        pass
+
+    def __iter__(self):
+        return iter([])
+
+    def __len__(self):
+        return 0
+
+
+class NullProfiler:
+    """A profiler that does nothing, for when profiling is disabled."""
+
+    def start(self, connection=None):
+        pass
+
+    def stop(self):
+        pass
+
+    @contextmanager
+    def stage(self, source_db, model_name, stage, connection=None):
+        yield {}
+
+
+class Profiler:
+    """Profile the stages of a run, writing the results to directory.
+
+    start() must be called before the first stage and stop() after the
+    last one. If connection (a Django database connection) is given to
+    start(), the queries it makes are counted.
+    """
+
+    def __init__(self, directory, trace_memory=False):
+        self.directory = directory
+        self.trace_memory = trace_memory
+        self.active = threading.local()
+        self.connection = None
+
+    def start(self, connection=None):
+        os.makedirs(self.directory, exist_ok=True)
+        self.started_tracing = self.trace_memory and \
+            not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        if connection is not None:
+            self.connection = connection
+            self.saved_queries_log = connection.queries_log
+            self.saved_force_debug_cursor = connection.force_debug_cursor
+            connection.queries_log = QueryLog()
+            connection.force_debug_cursor = True
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+        if self.connection is not None:
+            self.connection.queries_log = self.saved_queries_log
+            self.connection.force_debug_cursor = \
+                self.saved_force_debug_cursor
+            self.connection = None
+
+    def get_name(self, source_db, model_name, stage):
+        return '{}-{}-{}'.format(get_source_name(source_db),
+                                 model_name or 'all', stage)
+
+    @contextmanager
+    def stage(self, source_db, model_name, stage, connection=None):
+        """Profile the with block.
+
+        The with statement gets a dictionary, which is filled in with the
+        results when the block finishes: "queries" and "query_time" (if
+        connection is specified; it must be the connection given to
+        start()) and "allocated" (if memory is traced).
+        """
+        result = {}
+        if getattr(self.active, 'stage', None) is not None:
+            # Another stage is being profiled in this thread
+            yield result
+            return
+        name = self.get_name(source_db, model_name, stage)
+        self.active.stage = name
+        if connection is not None:
+            queries_log = connection.queries_log
+            queries, query_time = queries_log.count, queries_log.time
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        start_time = time.perf_counter()
+        profile.enable()
+        try:
+            yield result
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - start_time
+            self.active.stage = None
+            lines = ['{}: {:.3f} s'.format(name, duration)]
+            if connection is not None:
+                result['queries'] = queries_log.count - queries
+                result['query_time'] = queries_log.time - query_time
+                lines.append('{} queries, {:.3f} s'.format(
+                    result['queries'], result['query_time']))
+            if self.trace_memory:
+                lines.extend(self.get_allocations(snapshot, result))
+            profile.dump_stats(os.path.join(self.directory, name + '.prof'))
+            with open(os.path.join(self.directory, name + '.txt'), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+    def get_allocations(self, old_snapshot, result):
+        """Return the lines that describe the memory allocated in a stage."""
+        filters = [tracemalloc.Filter(False, x) for x in (
+            tracemalloc.__file__, cProfile.__file__, __file__)]
+        old_snapshot = old_snapshot.filter_traces(filters)
+        snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+        statistics = snapshot.compare_to(old_snapshot, 'lineno')
+        result['allocated'] = sum(x.size_diff for x in statistics)
+        lines = ['{:.1f} KiB allocated, peak traced memory {:.1f} KiB'.format(
+            result['allocated'] / 1024,
+            tracemalloc.get_traced_memory()[1] / 1024)]
+        lines.extend(str(x) for x in statistics[:TOP_ALLOCATIONS])
+        return lines
@@ -0,0 +1,116 @@
+"""Delete the objects of a range of ids with plain SQL.
+
+Django's QuerySet.delete() collects the objects to be deleted, and the
+objects that refer to them, in Python, which takes a long time for large
+tables. purge() instead deletes each range with a few DELETE statements.
+It does not send signals and it does not cascade; the models must be
+specified in dependency order, and afterwards find_dangling() is used to
+make certain that nothing refers to the deleted rows.
+"""
+
+from django.apps import apps
+from django.db import connections, IntegrityError
+
+from enhydris.hcore import models
+
+
+def _get_through_references(model):
+    """Return the (through model, column) tuples that refer to a model.
+
+    These are the columns of the auto-created many-to-many tables that are
+    foreign keys to model.
+    """
+    return [
+        (m, field.column)
+        for m in apps.get_models(include_auto_created=True)
+        if m._meta.auto_created
+        for field in m._meta.local_fields
+        if field.is_relation and field.related_model is model
+    ]
+
+
+def purge(model_names, min_id, max_id, using='default'):
+    """Delete the objects of model_names whose id is in [min_id, max_id].
+
+    model_names must be in dependency order (i.e. models must come after
+    the models they refer to); they are deleted in reverse order. The rows
+    of the ancestor tables of multi-table inherited models, and the rows of
+    the auto-created many-to-many tables that refer to the deleted rows,
+    are also deleted.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    params = [min_id, max_id]
+    with connection.cursor() as cursor:
+        for model_name in reversed(model_names):
+            model = getattr(models, model_name)
+            table = qn(model._meta.db_table)
+            pk = qn(model._meta.pk.column)
+            ids_in_range = 'SELECT {pk} FROM {table} ' \
+                'WHERE {pk} >= %s AND {pk} <= %s'.format(pk=pk, table=table)
+            concrete_models = [model] + model._meta.get_parent_list()
+            for m in concrete_models:
+                for through, column in _get_through_references(m):
+                    cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                        qn(through._meta.db_table), qn(column), ids_in_range),
+                        params)
+            for m in concrete_models[1:]:
+                cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                    qn(m._meta.db_table), qn(m._meta.pk.column),
+                    ids_in_range), params)
+            cursor.execute(
+                'DELETE FROM {table} WHERE {pk} >= %s AND {pk} <= %s'.format(
+                    table=table, pk=pk), params)
+
+
+def find_dangling(model_names, min_id, max_id, using='default',
+                  referring_models=None):
+    """Find rows that refer to nonexistent objects of model_names.
+
+    Only references to ids in [min_id, max_id] are checked. References to
+    the ancestors of model_names (e.g. to Gentity) are also checked. The
+    rows of all models are checked, unless referring_models, a list of
+    model classes, is specified. Returns a list of (table, column, number
+    of rows) tuples.
+    """
+    if referring_models is None:
+        referring_models = apps.get_models(include_auto_created=True)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    targets = set()
+    for model_name in model_names:
+        model = getattr(models, model_name)
+        targets.update([model] + model._meta.get_parent_list())
+    result = []
+    with connection.cursor() as cursor:
+        for m in referring_models:
+            for field in m._meta.local_fields:
+                if not field.is_relation or field.related_model not in targets:
+                    continue
+                target_field = field.rel.get_related_field()
+                cursor.execute(
+                    'SELECT COUNT(*) FROM {table} '
+                    'LEFT JOIN {target_table} target '
+                    'ON {table}.{column} = target.{target_column} '
+                    'WHERE {table}.{column} >= %s AND {table}.{column} <= %s '
+                    'AND target.{target_column} IS NULL'.format(
+                        table=qn(m._meta.db_table), column=qn(field.column),
+                        target_table=qn(field.related_model._meta.db_table),
+                        target_column=qn(target_field.column)),
+                    [min_id, max_id])
+                count = cursor.fetchone()[0]
+                if count:
+                    result.append((m._meta.db_table, field.column, count))
+    return result
+
+
+def purge_and_verify(model_names, min_id, max_id, using='default'):
+    """Run purge() and raise IntegrityError if it leaves dangling rows."""
+    purge(model_names, min_id, max_id, using)
+    dangling = find_dangling(model_names, min_id, max_id, using)
+    if dangling:
+        raise IntegrityError(
+            'Purging ids {}-{} would leave rows that refer to nonexistent '
+            'objects: {}'.format(min_id, max_id, ', '.join(
+                '{} rows of {}.{}'.format(count, table, column)
+                for table, column, count in dangling)))
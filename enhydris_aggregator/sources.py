@@ -0,0 +1,172 @@
+"""Find the source database from which an object has been copied.
+
+get_originating_url() finds the URL of one time series in its originating
+database; get_originating_urls() finds those of many time series at once,
+e.g. for a list of time series. If the STORE_ORIGINATING_URLS setting is
+True, the aggregate command also stores the URLs of all copied time series
+in the database (see store_originating_urls()), and get_originating_urls()
+reads them from there.
+"""
+
+from bisect import bisect_right
+import re
+import sys
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from enhydris.hcore import models
+
+from .fetch import urljoin
+from .models import OriginatingUrl
+from .writers import batches
+
+# Maximum number of ids in a single query; SQLite limits the number of
+# parameters.
+QUERY_BATCH_SIZE = 500
+
+
+def get_source_name(source_db):
+    """Return a name for a source database that is usable in file names.
+
+    The name consists of the URL, without the scheme and with the
+    characters other than letters and digits replaced with dashes, and of
+    the ID_OFFSET, e.g. "example-com-enhydris-10000".
+    """
+    source = re.sub(r'[^A-Za-z0-9]+', '-',
+                    source_db['URL'].split('//')[-1]).strip('-')
+    return '{}-{}'.format(source, source_db['ID_OFFSET'])
+
+
+class SourceRanges:
+    """The id ranges of the source databases.
+
+    source_databases is like the SOURCE_DATABASES setting. Each source
+    database owns the ids from its ID_OFFSET up to, but not including, the
+    ID_OFFSET of the next one; the last one owns all ids from its ID_OFFSET
+    onwards.
+    """
+
+    def __init__(self, source_databases):
+        self.source_databases = sorted(source_databases,
+                                       key=lambda x: x['ID_OFFSET'])
+        self.offsets = [x['ID_OFFSET'] for x in self.source_databases]
+
+    def find(self, id):
+        """Return the source database that owns id, or None if none does."""
+        i = bisect_right(self.offsets, id) - 1
+        if i < 0:
+            return None
+        return self.source_databases[i]
+
+    def find_all(self, ids):
+        """Find the source databases that own many ids in one pass.
+
+        Returns a list of (id, source_db) tuples sorted by id, where
+        source_db is None if no source database owns the id.
+        """
+        result = []
+        i = -1
+        for id in sorted(ids):
+            while i + 1 < len(self.offsets) and self.offsets[i + 1] <= id:
+                i += 1
+            result.append((id, self.source_databases[i] if i >= 0 else None))
+        return result
+
+    def ranges(self):
+        """Return a list of (source_db, min_id, max_id) tuples.
+
+        The list is sorted by ID_OFFSET, and the ranges are inclusive.
+        """
+        max_ids = [x - 1 for x in self.offsets[1:]] + [sys.maxsize]
+        return list(zip(self.source_databases, self.offsets, max_ids))
+
+
+_source_ranges = None
+
+
+def get_source_ranges():
+    """Return the SourceRanges of the SOURCE_DATABASES setting.
+
+    The result is cached until the setting changes.
+    """
+    global _source_ranges
+    if _source_ranges is None:
+        _source_ranges = SourceRanges(
+            settings.ENHYDRIS_AGGREGATOR['SOURCE_DATABASES'])
+    return _source_ranges
+
+
+@receiver(setting_changed)
+def _reset_source_ranges(setting, **kwargs):
+    global _source_ranges
+    if setting == 'ENHYDRIS_AGGREGATOR':
+        _source_ranges = None
+
+
+def get_originating_url(timeseries_id):
+    """Return the URL of a time series in its originating database.
+
+    Returns None if the id does not belong to any source database. If the
+    STORE_ORIGINATING_URLS setting is True, the stored URL is returned.
+    """
+    if _store_enabled():
+        return get_originating_urls([timeseries_id])[timeseries_id]
+    source_db = get_source_ranges().find(timeseries_id)
+    if source_db is None:
+        return None
+    return _make_url(source_db, timeseries_id)
+
+
+def _make_url(source_db, timeseries_id):
+    original_id = timeseries_id - source_db['ID_OFFSET']
+    return urljoin(source_db['URL'], 'timeseries', 'd',
+                   str(original_id) + '/')
+
+
+def _store_enabled():
+    return settings.ENHYDRIS_AGGREGATOR.get('STORE_ORIGINATING_URLS', False)
+
+
+def get_originating_urls(timeseries_ids):
+    """Return the URLs of many time series in their originating databases.
+
+    timeseries_ids is an iterable of ids or a queryset of time series.
+    Returns a dictionary mapping each id to its URL, or to None if the id
+    does not belong to any source database.
+    """
+    if hasattr(timeseries_ids, 'values_list'):
+        timeseries_ids = timeseries_ids.values_list('pk', flat=True)
+    ids = set(timeseries_ids)
+    result = {}
+    if _store_enabled():
+        for batch in batches(sorted(ids), QUERY_BATCH_SIZE):
+            result.update(OriginatingUrl.objects.filter(
+                timeseries_id__in=batch).values_list('timeseries_id', 'url'))
+        ids -= set(result)
+    for id, source_db in get_source_ranges().find_all(ids):
+        result[id] = None if source_db is None else _make_url(source_db, id)
+    return result
+
+
+def store_originating_urls(source_db, min_id, max_id, batch_size=1000):
+    """Store the URLs of the time series of a source database.
+
+    The stored URLs of the ids in [min_id, max_id] are replaced with those
+    of the time series that currently exist in that range. This does
+    nothing unless the STORE_ORIGINATING_URLS setting is True.
+    """
+    if not _store_enabled():
+        return
+    delete_originating_urls(min_id, max_id)
+    ids = models.Timeseries.objects.filter(
+        id__gte=min_id, id__lte=max_id).values_list('id', flat=True)
+    OriginatingUrl.objects.bulk_create(
+        (OriginatingUrl(timeseries_id=id, url=_make_url(source_db, id))
+         for id in ids.iterator()), batch_size)
+
+
+def delete_originating_urls(min_id, max_id):
+    OriginatingUrl.objects.filter(timeseries_id__gte=min_id,
+                                  timeseries_id__lte=max_id).delete()
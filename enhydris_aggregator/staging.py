@@ -0,0 +1,152 @@
+"""Load a source database into staging tables and then publish it.
+
+Staging creates a temporary table for each table of the copied models,
+with the same name as the live table. Both PostgreSQL and SQLite look up
+temporary tables before the others, so while the staging tables exist the
+writers, which use the normal table names, write to them without touching
+the live tables. When everything has been loaded and checked, publish()
+replaces the objects of the source database in the live tables with those
+of the staging tables, which only takes a few statements; so the live
+tables are locked for a short time only.
+
+All this must run in a transaction; if it fails, rolling back the
+transaction also removes the staging tables.
+"""
+
+from django.db import connections
+
+from enhydris.hcore import models
+
+from .purge import find_dangling
+
+vendors = ('postgresql', 'sqlite')
+
+
+class Staging:
+    """The staging tables for the objects of model_names in an id range.
+
+    model_names must be in dependency order. The tables are those of the
+    models, of their ancestors and of their auto-created many-to-many
+    relationships.
+    """
+
+    def __init__(self, model_names, min_id, max_id, using='default'):
+        self.model_names = model_names
+        self.min_id = min_id
+        self.max_id = max_id
+        self.connection = connections[using]
+        self.qn = self.connection.ops.quote_name
+        self.concrete_models = []
+        for model_name in model_names:
+            model = getattr(models, model_name)
+            for m in list(reversed(model._meta.get_parent_list())) + [model]:
+                if m not in self.concrete_models:
+                    self.concrete_models.append(m)
+            for field in model._meta.local_many_to_many:
+                if field.rel.through._meta.auto_created:
+                    self.concrete_models.append(field.rel.through)
+
+    def execute(self, sql, params=()):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def live_table(self, model):
+        """Return the qualified name of the live table of a model."""
+        return '{}.{}'.format(self.qn(self.live_schema),
+                              self.qn(model._meta.db_table))
+
+    def columns(self, model):
+        """Return the quoted column names that are copied between tables.
+
+        The ids of the auto-created many-to-many tables are left to the
+        live table.
+        """
+        return ', '.join(
+            self.qn(f.column) for f in model._meta.local_concrete_fields
+            if not (model._meta.auto_created and f.primary_key))
+
+    def create(self):
+        if self.connection.vendor == 'postgresql':
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT current_schema()')
+                self.live_schema = cursor.fetchone()[0]
+            template = 'CREATE TEMPORARY TABLE {table} ' \
+                '(LIKE {live_table} INCLUDING DEFAULTS)'
+        else:
+            self.live_schema = 'main'
+            template = 'CREATE TEMPORARY TABLE {table} ' \
+                'AS SELECT * FROM {live_table} WHERE 0'
+        for m in self.concrete_models:
+            self.execute(template.format(table=self.qn(m._meta.db_table),
+                                         live_table=self.live_table(m)))
+
+    def copy_live(self, model_name):
+        """Copy the objects of a model in the id range from the live tables.
+
+        This is for models that have not changed since the last run.
+        """
+        model = getattr(models, model_name)
+        pk = self.qn(model._meta.pk.column)
+        ids_in_range = 'SELECT {pk} FROM {table} ' \
+            'WHERE {pk} >= %s AND {pk} <= %s'.format(
+                pk=pk, table=self.live_table(model))
+        for m in [model] + model._meta.get_parent_list():
+            self.execute('INSERT INTO {table} ({columns}) '
+                         'SELECT {columns} FROM {live_table} '
+                         'WHERE {pk} IN ({ids})'.format(
+                             table=self.qn(m._meta.db_table),
+                             columns=self.columns(m),
+                             live_table=self.live_table(m),
+                             pk=self.qn(m._meta.pk.column), ids=ids_in_range),
+                         [self.min_id, self.max_id])
+        for field in model._meta.local_many_to_many:
+            through = field.rel.through
+            if not through._meta.auto_created:
+                continue
+            column = through._meta.get_field(field.m2m_field_name()).column
+            self.execute('INSERT INTO {table} ({columns}) '
+                         'SELECT {columns} FROM {live_table} '
+                         'WHERE {column} >= %s AND {column} <= %s'.format(
+                             table=self.qn(through._meta.db_table),
+                             columns=self.columns(through),
+                             live_table=self.live_table(through),
+                             column=self.qn(column)),
+                         [self.min_id, self.max_id])
+
+    def validate(self):
+        """Check that the staging tables do not refer to nonexistent objects.
+
+        Raises ValueError if they do.
+        """
+        dangling = find_dangling(self.model_names, self.min_id, self.max_id,
+                                 referring_models=self.concrete_models)
+        if dangling:
+            raise ValueError(
+                'The staging tables have rows that refer to nonexistent '
+                'objects: {}'.format(', '.join(
+                    '{} rows of {}.{}'.format(count, table, column)
+                    for table, column, count in dangling)))
+
+    def publish(self, purge):
+        """Replace the objects of the id range in the live tables.
+
+        purge is a function that deletes the objects of the id range from
+        the live tables; it is called with no arguments, after the staging
+        tables have been renamed, so that the normal table names refer to
+        the live tables again. The staging tables are dropped afterwards.
+        """
+        for m in self.concrete_models:
+            self.execute('ALTER TABLE {} RENAME TO {}'.format(
+                self.qn(m._meta.db_table), self.staged_table(m)))
+        purge()
+        for m in self.concrete_models:
+            self.execute('INSERT INTO {table} ({columns}) '
+                         'SELECT {columns} FROM {staged_table}'.format(
+                             table=self.qn(m._meta.db_table),
+                             columns=self.columns(m),
+                             staged_table=self.staged_table(m)))
+        for m in self.concrete_models:
+            self.execute('DROP TABLE {}'.format(self.staged_table(m)))
+
+    def staged_table(self, model):
+        return self.qn('staged_' + model._meta.db_table)
@@ -1,34 +1,45 @@
-from copy import deepcopy
-import sys
-
 from django import template
-from django.conf import settings
 
-from ..management.commands.aggregate import urljoin
+from .. import sources
 
 register = template.Library()
 
 
 @register.assignment_tag
 def get_originating_url(timeseries_id):
-    # Sort SOURCE_DATABASES by ID_OFFSET
-    source_databases = deepcopy(
-        settings.ENHYDRIS_AGGREGATOR['SOURCE_DATABASES'])
-    source_databases.sort(key=lambda x: x['ID_OFFSET'])
-
-    # Find the originating database for this id
-    originating_db = None
-    for i, source_db in enumerate(source_databases):
-        min_id = source_db['ID_OFFSET']
-        try:
-            max_id = source_databases[i + 1]['ID_OFFSET']
-        except IndexError:
-            max_id = sys.maxsize
-        if timeseries_id > min_id and timeseries_id < max_id:
-            originating_db = source_db
-            break
-
-    # Return the result
-    original_id = timeseries_id - originating_db['ID_OFFSET']
-    return urljoin(originating_db['URL'], 'timeseries', 'd',
-                   str(original_id) + '/')
+    return sources.get_originating_url(timeseries_id)
+
+
+@register.assignment_tag
+def get_originating_urls(timeseries_list):
+    """Return a dictionary mapping time series ids to originating URLs.
+
+    timeseries_list is a list or queryset of time series, or a list of ids.
+    """
+    return sources.get_originating_urls(_get_ids(timeseries_list))
+
+
+@register.filter
+def with_originating_urls(timeseries_list):
+    """Pair each time series with its originating URL.
+
+    Use it like this:
+
+        {% for timeseries, url in timeseries_list|with_originating_urls %}
+
+    timeseries_list is a list or queryset of time series, or a list of ids.
+    The URLs are all found at once.
+    """
+    timeseries_list = list(timeseries_list)
+    urls = sources.get_originating_urls(_get_ids(timeseries_list))
+    return [(x, urls[_get_id(x)]) for x in timeseries_list]
+
+
+def _get_ids(timeseries_list):
+    if hasattr(timeseries_list, 'values_list'):
+        return timeseries_list
+    return [_get_id(x) for x in timeseries_list]
+
+
+def _get_id(timeseries):
+    return getattr(timeseries, 'pk', timeseries)
@@ -1,6 +1,8 @@
+import hashlib
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import socket
+from socketserver import ThreadingMixIn
 from threading import Thread
 
 import requests
@@ -451,17 +453,41 @@ for key in list(mock_responses.keys()):
     mock_responses[list_view].append(mock_responses[key])
 
 
+# Paths that fail with "503 Service Unavailable" the specified number of times
+# before they succeed
+flaky_paths = {}
+
+
 class MockServerRequestHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         path = self.path[5:]  # Strip the "/api/" from the path
+        if flaky_paths.get(path):
+            flaky_paths[path] -= 1
+            self.send_error(requests.codes.service_unavailable)
+            return
         if path not in mock_responses:
             self.send_error(requests.codes.not_found)
             return
+        content = json.dumps(mock_responses[path]).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(requests.codes.not_modified)
+            self.end_headers()
+            return
         self.send_response(requests.codes.ok)
         self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('ETag', etag)
         self.end_headers()
-        self.wfile.write(json.dumps(mock_responses[path]).encode('utf-8'))
+        self.wfile.write(content)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # The aggregator makes many concurrent requests; with the default queue
+    # size of 5 some connections would be retried after a delay.
+    request_queue_size = 64
 
 
 _mock_server_port = None
@@ -481,8 +507,8 @@ def start_mock_server():
     s.close()
 
     # Start server on port
-    mock_server = HTTPServer(('localhost', _mock_server_port),
-                             MockServerRequestHandler)
+    mock_server = ThreadingHTTPServer(('localhost', _mock_server_port),
+                                      MockServerRequestHandler)
     mock_server_thread = Thread(target=mock_server.serve_forever)
     mock_server_thread.setDaemon(True)
     mock_server_thread.start()
@@ -1,13 +1,25 @@
+from io import StringIO
+import json
+import os
+import shutil
 import sys
+import tempfile
+import tracemalloc
 
-from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.db import connection
 from django.test import override_settings, TestCase
 
 from enhydris.hcore import models
 
+from enhydris_aggregator.checkpoint import Checkpoint
 from enhydris_aggregator.management.commands import aggregate
+from enhydris_aggregator.models import QuarantinedObject, SharedLookup
+from enhydris_aggregator.sources import get_originating_url
+from enhydris_aggregator.writers import BulkWriter, CopyWriter, get_writer
 
-from .mocks import start_mock_server
+from .mocks import flaky_paths, mock_responses, start_mock_server
 
 
 class TestAggregate(TestCase):
@@ -129,6 +141,700 @@ class TestAggregate(TestCase):
                          'Sum')
 
 
+class TestWriters(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+
+    def aggregate(self, writer='bulk', **kwargs):
+        config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(self.mock_server_port),
+                'ID_OFFSET': 10000,
+            }],
+            'WRITER': writer,
+        }
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            call_command('aggregate', **kwargs)
+
+    def check_result(self):
+        self.assertEqual(models.Station.objects.count(), 2)
+        self.assertEqual(models.PoliticalDivision.objects.count(), 4)
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+        self.assertEqual(
+            models.Station.objects.get(pk=11403).stype.all()[0].descr,
+            'Meteorological')
+        self.assertEqual(
+            models.PoliticalDivision.objects.get(pk=10306).parent.name,
+            'GREECE')
+
+    def test_batch_size(self):
+        # Inserting one row per query must give the same result as inserting
+        # everything at once
+        self.aggregate(batch_size=1)
+        self.check_result()
+
+    def test_pipeline_depth(self):
+        # Preparing each model only when it is written must give the same
+        # result as preparing the next ones ahead
+        for depth in (0, 1):
+            with self.subTest(depth=depth):
+                self.aggregate(batch_size=1, pipeline_depth=depth)
+                self.check_result()
+                aggregate.Command().delete_from_database(0, sys.maxsize)
+        with self.assertRaises(CommandError):
+            self.aggregate(pipeline_depth=-1)
+
+    def test_writers(self):
+        for writer in ('orm', 'bulk', 'copy'):
+            with self.subTest(writer=writer):
+                self.aggregate(writer)
+                self.check_result()
+                aggregate.Command().delete_from_database(0, sys.maxsize)
+
+    def test_copy_writer(self):
+        # On PostgreSQL, the rows written with COPY must be the same as
+        # those written with INSERT.
+        if connection.vendor != 'postgresql':
+            self.skipTest('The copy writer requires PostgreSQL')
+        self.assertIsInstance(get_writer(1000, 'copy'), CopyWriter)
+        result = {}
+        for writer in ('bulk', 'copy'):
+            self.aggregate(writer)
+            self.check_result()
+            result[writer] = [
+                list(model.objects.order_by('pk').values())
+                for model in (models.Station, models.PoliticalDivision,
+                              models.Timeseries)]
+            aggregate.Command().delete_from_database(0, sys.maxsize)
+        self.assertEqual(result['copy'], result['bulk'])
+
+    def test_copy_writer_fallback(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('The copy writer falls back to bulk on other '
+                          'databases only')
+        self.assertIsInstance(get_writer(1000, 'copy'), BulkWriter)
+
+    def test_dangling_links(self):
+        station = mock_responses['Station/'][0]
+        self.assertEqual(station['id'], 1403)
+        station['stype'] = [1, 99]
+        try:
+            for writer in ('orm', 'bulk', 'copy'):
+                with self.subTest(writer=writer):
+                    err = StringIO()
+                    self.aggregate(writer, stderr=err)
+                    self.assertEqual(
+                        [x.id for x in models.Station.objects.get(
+                            pk=11403).stype.all()],
+                        [10001])
+                    self.assertIn('1 links to nonexistent objects have been '
+                                  'dropped: 11403.stype -> 10099',
+                                  err.getvalue())
+                    aggregate.Command().delete_from_database(0, sys.maxsize)
+        finally:
+            station['stype'] = [1]
+
+    def test_quarantine(self):
+        station = mock_responses['Station/'][0]
+        self.assertEqual(station['id'], 1403)
+        station['political_division'] = 999
+        try:
+            err = StringIO()
+            self.aggregate(stderr=err)
+        finally:
+            station['political_division'] = 306
+
+        # The station is quarantined, and so are the objects that refer to
+        # it; the rest of the source database is copied.
+        self.assertEqual(list(models.Station.objects.values_list(
+            'id', flat=True)), [11360])
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+        self.assertFalse(models.GentityAltCode.objects.exists())
+        self.assertFalse(models.Overseer.objects.exists())
+        quarantined = QuarantinedObject.objects.order_by('model_name')
+        self.assertEqual(
+            [(x.model_name, x.object_id) for x in quarantined],
+            [('GentityAltCode', 10047), ('Overseer', 10037),
+             ('Station', 11403)])
+        self.assertEqual(quarantined[2].reason, 'political_division refers '
+                         'to nonexistent object 10999')
+        self.assertEqual(json.loads(quarantined[2].data)['name'],
+                         'Agios Spiridonas')
+        self.assertIn('Station: 1 objects refer to nonexistent objects and '
+                      'have been quarantined: 11403', err.getvalue())
+
+        # When the source is fixed, the quarantined objects are removed
+        self.aggregate()
+        self.check_result()
+        self.assertFalse(QuarantinedObject.objects.exists())
+
+    def test_unknown_writer(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.aggregate('nonexistent')
+
+
+class TestIncremental(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+        cls.config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 10000,
+            }],
+        }
+
+    def test_incremental(self):
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate')
+
+        # Station 11360 has not been modified since the last run, so
+        # changing it here should not be noticed. Station 11403 has a
+        # last_modified equal to the high water mark, so it will be copied.
+        models.Station.objects.filter(id__in=(11360, 11403)).update(
+            name='Modified')
+
+        # Objects that are missing must be copied, and objects that do not
+        # exist in the source must be deleted
+        models.Timeseries.objects.filter(id=19206).delete()
+        models.Variable.objects.create(id=19999, descr='Nonexistent')
+
+        # The source has not changed, so we need --force
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate', incremental=True, force=True)
+
+        self.assertEqual(models.Station.objects.get(pk=11360).name,
+                         'Modified')
+        self.assertEqual(models.Station.objects.get(pk=11403).name,
+                         'Agios Spiridonas')
+        self.assertEqual(
+            models.Station.objects.get(pk=11403).stype.all()[0].descr,
+            'Meteorological')
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+        self.assertFalse(models.Variable.objects.filter(id=19999).exists())
+        self.assertEqual(models.Variable.objects.count(), 1)
+
+
+class TestDiff(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+        cls.config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 10000,
+            }],
+        }
+
+    def test_diff(self):
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate')
+
+        models.Station.objects.filter(id=11360).update(name='Modified')
+        station = models.Station.objects.get(id=11403)
+        station.stype.clear()
+        station.stype.add(models.StationType.objects.get(id=10002))
+        models.Timeseries.objects.filter(id=19206).delete()
+        models.Variable.objects.create(id=19999, descr='Nonexistent')
+
+        out = StringIO()
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate', diff=True, force=True, verbosity=2,
+                         stdout=out)
+
+        self.assertEqual(models.Station.objects.get(pk=11360).name,
+                         'Alagonia - Rentifis watermill')
+        self.assertEqual(
+            [x.descr for x in models.Station.objects.get(pk=11403)
+             .stype.all()],
+            ['Meteorological'])
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+        self.assertEqual(models.Variable.objects.count(), 1)
+        output = out.getvalue()
+        self.assertIn(
+            'Station: 0 rows unchanged, 2 updated, 0 inserted, 0 deleted',
+            output)
+        self.assertIn(
+            'Timeseries: 1 rows unchanged, 0 updated, 1 inserted, 0 deleted',
+            output)
+        self.assertIn(
+            'Variable: 1 rows unchanged, 0 updated, 0 inserted, 1 deleted',
+            output)
+
+
+class TestConditional(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+        cls.config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 10000,
+            }],
+        }
+
+    def aggregate(self):
+        out = StringIO()
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate', verbosity=2, stdout=out)
+        return out.getvalue()
+
+    def test_not_modified(self):
+        self.aggregate()
+        models.Station.objects.filter(id=11360).update(name='Modified')
+        output = self.aggregate()
+        self.assertIn('Station: not modified', output)
+        self.assertNotIn('rows written', output)
+        self.assertEqual(models.Station.objects.get(pk=11360).name,
+                         'Modified')
+
+    def test_dependencies(self):
+        self.aggregate()
+        models.Station.objects.filter(id=11360).update(name='Modified')
+        models.Variable.objects.filter(id=15683).update(descr='Modified')
+
+        # When StationType changes, the stations must also be copied again,
+        # but variables must not.
+        station_type = mock_responses['StationType/'][0]
+        old_descr = station_type['descr']
+        station_type['descr'] = 'Changed'
+        try:
+            output = self.aggregate()
+        finally:
+            station_type['descr'] = old_descr
+
+        self.assertIn('StationType: 2 rows written', output)
+        self.assertIn('Station: 2 rows written', output)
+        self.assertIn('Timeseries: 2 rows written', output)
+        self.assertIn('Variable: not modified', output)
+        self.assertEqual(models.Station.objects.get(pk=11360).name,
+                         'Alagonia - Rentifis watermill')
+        self.assertEqual(models.Variable.objects.get(pk=15683).descr,
+                         'Modified')
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+
+
+class TestStaging(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+        cls.config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 10000,
+            }, {
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 20000,
+            }],
+        }
+
+    def aggregate(self, **kwargs):
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate', staging=True, **kwargs)
+
+    def check_result(self):
+        self.assertEqual(models.Station.objects.count(), 4)
+        self.assertEqual(models.PoliticalDivision.objects.count(), 8)
+        self.assertEqual(models.Timeseries.objects.count(), 4)
+        self.assertEqual(
+            models.Station.objects.get(pk=21403).stype.all()[0].id, 20001)
+        self.assertEqual(
+            models.PoliticalDivision.objects.get(pk=20306).parent.name,
+            'GREECE')
+
+    def test_staging(self):
+        self.aggregate()
+        self.check_result()
+
+        models.Station.objects.filter(id=21403).update(name='Modified')
+        self.aggregate(force=True)
+        self.check_result()
+        self.assertEqual(models.Station.objects.get(pk=21403).name,
+                         'Agios Spiridonas')
+
+    def test_unchanged_models(self):
+        self.aggregate()
+        models.Station.objects.filter(id=21403).update(name='Modified')
+
+        # Unchanged models are copied from the live tables, so the
+        # modified station remains as it is.
+        station_type = mock_responses['StationType/'][0]
+        old_descr = station_type['descr']
+        station_type['descr'] = 'Changed'
+        try:
+            self.aggregate()
+        finally:
+            station_type['descr'] = old_descr
+
+        self.check_result()
+        self.assertEqual(models.StationType.objects.get(pk=20001).descr,
+                         'Changed')
+        self.assertEqual(models.Station.objects.get(pk=21403).name,
+                         'Modified')
+
+    def test_incompatible_options(self):
+        with self.assertRaises(CommandError):
+            self.aggregate(diff=True)
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_metrics(self):
+        config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(start_mock_server()),
+                'ID_OFFSET': 10000,
+            }],
+        }
+        metrics_file = os.path.join(self.tempdir, 'metrics.json')
+        prometheus_file = os.path.join(self.tempdir, 'metrics.prom')
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            call_command('aggregate', metrics=metrics_file,
+                         prometheus=prometheus_file)
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        self.assertGreater(metrics['duration'], 0)
+        source = metrics['sources'][0]
+        self.assertIsNone(source['error'])
+        self.assertGreater(source['duration'], 0)
+        station = source['models']['Station']
+        self.assertEqual(station['objects'], 2)
+        self.assertEqual(station['rows_written'], 2)
+        self.assertGreater(station['response_bytes'], 0)
+        self.assertGreater(station['write_time'], 0)
+        with open(prometheus_file) as f:
+            self.assertIn('enhydris_aggregator_model_rows_written{', f.read())
+
+    def test_copied_because_of_dependency(self):
+        # A model that has not changed, but refers to one that has, is
+        # copied again, and its metrics are those of a single download.
+        config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(start_mock_server()),
+                'ID_OFFSET': 10000,
+            }],
+        }
+        metrics_file = os.path.join(self.tempdir, 'metrics.json')
+        runs = []
+        variable = mock_responses['Variable/'][0]
+        old_descr = variable['descr']
+        try:
+            for descr in (old_descr, 'Changed'):
+                variable['descr'] = descr
+                with override_settings(ENHYDRIS_AGGREGATOR=config):
+                    call_command('aggregate', metrics=metrics_file)
+                with open(metrics_file) as f:
+                    runs.append(json.load(f)['sources'][0]['models'])
+        finally:
+            variable['descr'] = old_descr
+        timeseries = runs[1]['Timeseries']
+        self.assertFalse(timeseries['unchanged'])
+        self.assertEqual(timeseries['rows_written'], 2)
+        self.assertEqual(timeseries['response_bytes'],
+                         runs[0]['Timeseries']['response_bytes'])
+        self.assertTrue(runs[1]['TimeZone']['unchanged'])
+
+
+class TestProfile(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_profile(self):
+        config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(start_mock_server()),
+                'ID_OFFSET': 10000,
+            }],
+        }
+        out = StringIO()
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            call_command('aggregate', profile=self.tempdir,
+                         trace_memory=True, stdout=out)
+        filenames = os.listdir(self.tempdir)
+        prefix = 'localhost-{}-10000-Station-'.format(
+            config['SOURCE_DATABASES'][0]['URL'].split(':')[-1].strip('/'))
+        for suffix in ('write.prof', 'write.txt', 'transform.prof'):
+            self.assertIn(prefix + suffix, filenames)
+        with open(os.path.join(self.tempdir, prefix + 'write.txt')) as f:
+            content = f.read()
+        self.assertRegex(content, r'\d+ queries')
+        self.assertIn('KiB allocated', content)
+        self.assertRegex(out.getvalue(), r'Station: \d+ queries')
+        with open(os.path.join(self.tempdir, prefix.replace(
+                'Station', 'all') + 'delete.txt')) as f:
+            self.assertRegex(f.read(), r'\d+ queries')
+        self.assertRegex(out.getvalue(), r'delete: \d+ queries')
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_trace_memory_requires_profile(self):
+        with self.assertRaises(CommandError):
+            call_command('aggregate', trace_memory=True)
+
+
+class TestShowPlan(TestCase):
+    def test_show_plan(self):
+        out = StringIO()
+        call_command('aggregate', show_plan=True, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('1: '))
+        self.assertIn('Variable', lines[0])
+        self.assertIn('Timeseries', lines[-1])
+        self.assertFalse(models.Station.objects.exists())
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(start_mock_server()),
+                'ID_OFFSET': 10000,
+                'RETRIES': 0,
+            }],
+        }
+        self.checkpoint = os.path.join(self.tempdir, 'localhost-{}-10000'
+                                       .format(start_mock_server()))
+
+    def tearDown(self):
+        flaky_paths.clear()
+        shutil.rmtree(self.tempdir)
+
+    def aggregate(self):
+        out = StringIO()
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate', checkpoint=self.tempdir, stdout=out,
+                         stderr=StringIO())
+        return out.getvalue()
+
+    def test_resume(self):
+        flaky_paths['Timeseries/'] = 1
+        self.aggregate()
+        self.assertFalse(models.Timeseries.objects.exists())
+        with open(os.path.join(self.checkpoint, 'progress.json')) as f:
+            progress = json.load(f)
+        self.assertEqual(progress['failed'], 'Timeseries')
+        self.assertIn('Station', progress['downloads'])
+        self.assertNotIn('Timeseries', progress['downloads'])
+
+        # The stations are not downloaded again, so the change is not seen
+        station = mock_responses['Station/'][0]
+        old_name = station['name']
+        station['name'] = 'Changed'
+        try:
+            output = self.aggregate()
+        finally:
+            station['name'] = old_name
+        self.assertIn('resuming at Timeseries', output)
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+        self.assertFalse(models.Station.objects.filter(
+            name='Changed').exists())
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_repeated_failure(self):
+        source_db = self.config['SOURCE_DATABASES'][0]
+        checkpoint = Checkpoint(self.tempdir, source_db)
+        checkpoint.fail('Some error')
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        # A resumed run that fails in the same way discards the checkpoint
+        checkpoint = Checkpoint(self.tempdir, source_db)
+        self.assertTrue(checkpoint.resuming)
+        checkpoint.fail('Some error')
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class TestSharedLookups(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+        cls.config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 10000,
+            }, {
+                'URL': 'http://localhost:{}/'.format(cls.mock_server_port),
+                'ID_OFFSET': 20000,
+            }],
+            'SHARED_LOOKUPS': True,
+        }
+
+    def aggregate(self, **kwargs):
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate', **kwargs)
+
+    def check_result(self):
+        self.assertEqual(models.Station.objects.count(), 4)
+        self.assertEqual(models.Timeseries.objects.count(), 4)
+        self.assertEqual(models.Variable.objects.count(), 1)
+        variable = models.Variable.objects.get()
+        self.assertLess(variable.id, 10000)
+        self.assertEqual(set(models.Timeseries.objects.values_list(
+            'variable_id', flat=True)), {variable.id})
+        for station_id in (11403, 21403):
+            stypes = models.Station.objects.get(pk=station_id).stype.all()
+            self.assertEqual(stypes[0].descr, 'Meteorological')
+            self.assertLess(stypes[0].id, 10000)
+        self.assertEqual(
+            models.PoliticalDivision.objects.get(pk=20306).parent.name,
+            'GREECE')
+
+    def test_shared_lookups(self):
+        self.aggregate()
+        self.check_result()
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            self.assertEqual(get_originating_url(29206),
+                             'http://localhost:{}/timeseries/d/9206/'
+                             .format(self.mock_server_port))
+
+        self.aggregate(force=True)
+        self.check_result()
+
+        # A changed lookup gets a new shared object, and the old one, to
+        # which nothing is mapped any more, is deleted.
+        variable = mock_responses['Variable/'][0]
+        old_descr = variable['descr']
+        variable['descr'] = 'Changed'
+        try:
+            self.aggregate()
+        finally:
+            variable['descr'] = old_descr
+        self.check_result()
+        self.assertEqual(models.Variable.objects.get().descr, 'Changed')
+
+    def test_incremental(self):
+        self.aggregate()
+        self.aggregate(incremental=True, force=True)
+        self.check_result()
+
+    def test_changed_lookup(self):
+        # When a lookup changes, the objects that refer to it have not
+        # changed, but they must be made to refer to its new shared object
+        # instead of being deleted with the old one.
+        variable = mock_responses['Variable/'][0]
+        old_descr = variable['descr']
+        for options in ({'diff': True}, {'incremental': True},
+                        {'incremental': True, 'diff': True}):
+            with self.subTest(**options):
+                variable['descr'] = old_descr
+                self.aggregate(force=True)
+                variable['descr'] = 'Changed'
+                try:
+                    self.aggregate(**options)
+                finally:
+                    variable['descr'] = old_descr
+                self.check_result()
+                self.assertEqual(models.Variable.objects.get().descr,
+                                 'Changed')
+
+    def test_referred_lookup_is_kept(self):
+        # A shared object to which nothing is mapped, but which rows still
+        # refer to, is not deleted together with them.
+        self.aggregate()
+        variable = models.Variable.objects.get()
+        SharedLookup.objects.filter(model_name='Variable').delete()
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            command = aggregate.Command()
+            command.shared_lookups = True
+            command.prepare()
+            command.collect_garbage()
+        self.assertTrue(models.Variable.objects.filter(
+            pk=variable.pk).exists())
+        self.assertEqual(models.Timeseries.objects.count(), 4)
+
+    def test_incompatible_options(self):
+        with self.assertRaises(CommandError):
+            self.aggregate(staging=True)
+
+
+class TestJobs(TestCase):
+    # The worker processes need a database that supports concurrent
+    # transactions, so here we only test the checks of the options.
+
+    def test_invalid_jobs(self):
+        with self.assertRaises(CommandError):
+            call_command('aggregate', jobs=0)
+
+    def test_sqlite(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('This test is for SQLite only')
+        with self.assertRaisesRegex(CommandError, 'concurrent'):
+            call_command('aggregate', jobs=2)
+
+
+class TestDaemon(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        url = 'http://localhost:{}/'.format(start_mock_server())
+        self.config = {
+            'SOURCE_DATABASES': [
+                {'URL': url, 'ID_OFFSET': 10000, 'INTERVAL': 0.01},
+                {'URL': url, 'ID_OFFSET': 20000},
+            ],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_schedule(self):
+        # Both sources are due at the start; afterwards only the first one
+        # is due again, since the second one waits for --interval.
+        out = StringIO()
+        metrics_file = os.path.join(self.tempdir, 'metrics.json')
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate_daemon', max_syncs=4, jitter=0,
+                         checkpoint=os.path.join(self.tempdir, 'checkpoint'),
+                         metrics=metrics_file, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(len([x for x in lines if '(10000): synced' in x]),
+                         3)
+        self.assertIn('(20000): synced', lines[1])
+        self.assertEqual(models.Station.objects.count(), 4)
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        self.assertEqual([x['id_offset'] for x in metrics['sources']],
+                         [20000, 10000])
+        self.assertFalse(os.listdir(os.path.join(self.tempdir, 'checkpoint')))
+
+    def test_error(self):
+        self.config['SOURCE_DATABASES'][1].update(
+            URL='http://nonexistent.service.com/', RETRIES=0)
+        out = StringIO()
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            call_command('aggregate_daemon', max_syncs=3, jitter=0,
+                         stdout=out, stderr=StringIO())
+        lines = out.getvalue().splitlines()
+        self.assertIn('(20000): failed', lines[1])
+        self.assertIn('(10000): synced', lines[2])
+        self.assertEqual(models.Station.objects.count(), 2)
+
+    def test_invalid_options(self):
+        with override_settings(ENHYDRIS_AGGREGATOR=self.config):
+            with self.assertRaises(CommandError):
+                call_command('aggregate_daemon', interval=0)
+            with self.assertRaises(CommandError):
+                call_command('aggregate_daemon', jobs=2)
+            self.config['SOURCE_DATABASES'][0]['INTERVAL'] = -1
+            with self.assertRaisesRegex(CommandError, 'INTERVAL'):
+                call_command('aggregate_daemon')
+
+
 class TestMultipleSources(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -189,13 +895,14 @@ class TestMultipleSources(TestCase):
             }, {
                 'URL': 'http://nonexistent.service.com/',
                 'ID_OFFSET': 20000,
+                'RETRIES': 0,
             }, {
                 'URL': 'http://localhost:{}/'.format(self.mock_server_port),
                 'ID_OFFSET': 30000,
             }],
         }
         with override_settings(ENHYDRIS_AGGREGATOR=config):
-            call_command('aggregate')
+            call_command('aggregate', force=True)
         self.assertEqual(models.Station.objects.count(), 6)
         self.assertEqual(models.Station.objects.filter(
             name='This station has not been overwritten').count(), 2)
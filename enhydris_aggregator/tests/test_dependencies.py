@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase
+
+from enhydris_aggregator.dependencies import (get_copied_models,
+                                              get_dependencies, get_schedule)
+
+
+class TestGetSchedule(SimpleTestCase):
+    def test_schedule(self):
+        dependencies = {'A': set(), 'B': {'A'}, 'C': set(), 'D': {'B', 'C'}}
+        self.assertEqual(get_schedule(['D', 'C', 'B', 'A'], dependencies),
+                         [['A', 'C'], ['B'], ['D']])
+
+    def test_cycle(self):
+        dependencies = {'A': set(), 'B': {'A', 'C'}, 'C': {'B'},
+                        'D': {'B'}, 'E': {'D', 'F'}, 'F': {'E'}}
+        self.assertEqual(get_schedule('ABCDEF', dependencies),
+                         [['A'], ['B', 'C'], ['D'], ['E', 'F']])
+
+    def test_hcore(self):
+        model_names = get_copied_models()
+        self.assertEqual(set(model_names), {
+            'EventType', 'FileType', 'GentityAltCode', 'GentityAltCodeType',
+            'GentityEvent', 'GentityFile', 'Instrument', 'InstrumentType',
+            'IntervalType', 'Organization', 'Overseer', 'Person',
+            'PoliticalDivision', 'Station', 'StationType', 'TimeStep',
+            'TimeZone', 'Timeseries', 'UnitOfMeasurement', 'Variable',
+            'WaterBasin', 'WaterDivision'})
+        dependencies = get_dependencies(model_names)
+        levels = get_schedule(model_names, dependencies)
+        self.assertEqual(sorted(x for level in levels for x in level),
+                         sorted(model_names))
+        for i, level in enumerate(levels):
+            earlier = set(x for level in levels[:i + 1] for x in level)
+            for name in level:
+                self.assertLessEqual(dependencies[name], earlier)
+        self.assertIn('FileType', levels[0])
+        self.assertIn('TimeZone', levels[0])
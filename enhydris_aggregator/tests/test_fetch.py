@@ -0,0 +1,45 @@
+import json
+
+from django.test import SimpleTestCase
+
+from enhydris_aggregator.fetch import iter_json_array
+
+
+class TestIterJsonArray(SimpleTestCase):
+    data = [
+        {'id': 1, 'name': 'Agios Spiridonas', 'parent': None},
+        {'id': 2, 'name': 'Αλαγονία', 'altitude': 576.0, 'stype': [1, 2]},
+        12345,
+        'A string with [brackets], "quotes" and {braces}',
+        [],
+        None,
+    ]
+
+    def check(self, text, chunk_size):
+        chunks = [text[i:i + chunk_size]
+                  for i in range(0, len(text), chunk_size)]
+        self.assertEqual(list(iter_json_array(chunks)), self.data)
+
+    def test_chunk_sizes(self):
+        text = json.dumps(self.data, ensure_ascii=False, indent=2)
+        for chunk_size in (1, 2, 3, 10, len(text)):
+            with self.subTest(chunk_size=chunk_size):
+                self.check(text, chunk_size)
+
+    def test_compact(self):
+        self.check(json.dumps(self.data, separators=(',', ':')), 5)
+
+    def test_empty(self):
+        self.assertEqual(list(iter_json_array([' [', ' ] '])), [])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['{"id": 1}']))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[{"id": 1}, {"id"']))
+
+    def test_missing_comma(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[1 2]']))
@@ -0,0 +1,58 @@
+from django.test import TestCase
+
+from enhydris.hcore import models
+
+from enhydris_aggregator.links import LinkValidator, SourceIds
+
+
+class TestLinkValidator(TestCase):
+    def setUp(self):
+        self.source_ids = SourceIds(['PoliticalDivision', 'Station'], 1000,
+                                    1999)
+        self.source_ids.expect(['PoliticalDivision'])
+
+    def validate(self, rows):
+        validator = LinkValidator(models.PoliticalDivision, self.source_ids)
+        result = [row['id'] for row, many_to_many in validator.validate(
+            (row, {}) for row in rows)]
+        return result, [(row['id'], reason)
+                        for row, many_to_many, reason in validator.quarantined]
+
+    def test_parents_first(self):
+        rows = [{'id': 1001, 'parent_id': None},
+                {'id': 1002, 'parent_id': 1001}]
+        self.assertEqual(self.validate(rows), ([1001, 1002], []))
+
+    def test_children_first(self):
+        rows = [{'id': 1002, 'parent_id': 1001},
+                {'id': 1001, 'parent_id': None}]
+        self.assertEqual(self.validate(rows), ([1001, 1002], []))
+
+    def test_cycle(self):
+        rows = [{'id': 1001, 'parent_id': 1002},
+                {'id': 1002, 'parent_id': 1001}]
+        self.assertEqual(self.validate(rows), ([1001, 1002], []))
+
+    def test_orphans(self):
+        rows = [{'id': 1001, 'parent_id': None},
+                {'id': 1003, 'parent_id': 1002},
+                {'id': 1004, 'parent_id': 1003}]
+        self.assertEqual(self.validate(rows), ([1001], [
+            (1003, 'parent refers to nonexistent object 1002'),
+            (1004, 'parent refers to nonexistent object 1003'),
+        ]))
+
+    def test_other_models(self):
+        # The ids of the models that are not being copied are read from the
+        # database, where there are none.
+        source_ids = SourceIds(['PoliticalDivision', 'Station'], 1000, 1999)
+        validator = LinkValidator(models.GentityAltCode, source_ids)
+        rows = [({'id': 1001, 'gentity_id': 1500}, {})]
+        self.assertEqual(list(validator.validate(rows)), [])
+        self.assertEqual(validator.quarantined[0][2],
+                         'gentity refers to nonexistent object 1500')
+
+        # A gentity may be a political division, which is being copied, so
+        # the reference cannot be checked yet.
+        validator = LinkValidator(models.GentityAltCode, self.source_ids)
+        self.assertEqual(len(list(validator.validate(rows))), 1)
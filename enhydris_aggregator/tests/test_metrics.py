@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from enhydris_aggregator.metrics import Metrics
+
+
+class TestMetrics(SimpleTestCase):
+    source_db = {'URL': 'http://example.com/"a"', 'ID_OFFSET': 1000}
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_add(self):
+        metrics = Metrics()
+        metrics.add(self.source_db, 'Station', objects=2)
+        metrics.add(self.source_db, 'Station', objects=3)
+        metrics.add(self.source_db, delete_time=1.5)
+        metrics.set(self.source_db, error='Oops')
+        source = metrics.as_dict()['sources'][0]
+        self.assertEqual(source['models']['Station']['objects'], 5)
+        self.assertEqual(source['models']['Station']['write_time'], 0)
+        self.assertEqual(source['delete_time'], 1.5)
+        self.assertEqual(source['error'], 'Oops')
+
+    def test_timed(self):
+        metrics = Metrics()
+        items = list(metrics.timed(range(3), self.source_db, 'Station',
+                                   'transform_time'))
+        self.assertEqual(items, [0, 1, 2])
+        self.assertGreater(
+            metrics.get(self.source_db, 'Station', 'transform_time'), 0)
+
+    def test_merge_source(self):
+        metrics = Metrics()
+        metrics.add(self.source_db, 'Station', objects=2)
+        other = Metrics()
+        other.add(self.source_db, 'Station', objects=7)
+        metrics.merge_source(other.get_source(self.source_db))
+        self.assertEqual(len(metrics.as_dict()['sources']), 1)
+        self.assertEqual(metrics.get(self.source_db, 'Station', 'objects'), 7)
+
+    def test_write(self):
+        metrics = Metrics()
+        metrics.add(self.source_db, 'Station', objects=2)
+        metrics.finish()
+        json_file = os.path.join(self.tempdir, 'metrics.json')
+        metrics.write_json(json_file)
+        with open(json_file) as f:
+            self.assertEqual(json.load(f), metrics.as_dict())
+
+        prom_file = os.path.join(self.tempdir, 'metrics.prom')
+        metrics.write_prometheus(prom_file)
+        with open(prom_file) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE enhydris_aggregator_model_objects gauge', lines)
+        self.assertIn('enhydris_aggregator_model_objects{id_offset="1000",'
+                      'model="Station",source="http://example.com/\\"a\\""} '
+                      '2.0', lines)
+        self.assertIn('# TYPE enhydris_aggregator_model_write_seconds gauge',
+                      lines)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['metrics.json', 'metrics.prom'])
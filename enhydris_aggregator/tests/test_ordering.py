@@ -0,0 +1,102 @@
+from django.test import SimpleTestCase
+
+from enhydris.hcore import models
+
+from enhydris_aggregator.dependencies import get_self_references
+from enhydris_aggregator.ordering import Reorderer
+
+
+class TestReorderer(SimpleTestCase):
+    def check_order(self, objects, result, keys=('parent',)):
+        for obj in objects:
+            for key in keys:
+                if obj.get(key) is not None:
+                    self.assertLess(result.index(obj[key]),
+                                    result.index(obj['id']))
+
+    def test_reorder(self):
+        objects = [
+            {'id': 4, 'parent': 3},
+            {'id': 5, 'parent': 3},
+            {'id': 3, 'parent': 1},
+            {'id': 2, 'parent': None},
+            {'id': 1, 'parent': None},
+        ]
+        reorderer = Reorderer()
+        result = [x['id'] for x in reorderer.reorder(objects)]
+        self.assertEqual(sorted(result), [1, 2, 3, 4, 5])
+        self.check_order(objects, result)
+        self.assertEqual(reorderer.orphans, [])
+        self.assertEqual(reorderer.cycles, [])
+
+    def test_consumer_modifies_objects(self):
+        # The aggregator adds the offset to the ids of the yielded objects
+        objects = [{'id': 2, 'parent': 1}, {'id': 1, 'parent': None}]
+        reorderer = Reorderer()
+        result = []
+        for obj in reorderer.reorder(objects):
+            result.append(obj['id'])
+            obj['id'] += 1000
+        self.assertEqual(result, [1, 2])
+        self.assertEqual(reorderer.orphans, [])
+
+    def test_no_parent(self):
+        objects = [{'id': 2}, {'id': 1}]
+        self.assertEqual(list(Reorderer().reorder(objects)), objects)
+
+    def test_many_keys(self):
+        objects = [
+            {'id': 3, 'parent': 1, 'political_division': 2},
+            {'id': 2, 'parent': None, 'political_division': 1},
+            {'id': 1, 'parent': None, 'political_division': None},
+        ]
+        keys = ('parent', 'political_division')
+        result = [x['id'] for x in Reorderer(keys).reorder(objects)]
+        self.assertEqual(result, [1, 2, 3])
+        self.check_order(objects, result, keys)
+
+    def test_deep_hierarchy(self):
+        # Children before parents; a recursive implementation would exceed
+        # the maximum recursion depth.
+        objects = [{'id': i, 'parent': i - 1 if i else None}
+                   for i in reversed(range(100000))]
+        result = [x['id'] for x in Reorderer().reorder(objects)]
+        self.assertEqual(result, list(range(100000)))
+
+    def test_orphans(self):
+        objects = [
+            {'id': 3, 'parent': 2},
+            {'id': 2, 'parent': 42},
+            {'id': 1, 'parent': None},
+        ]
+        reorderer = Reorderer()
+        result = [x['id'] for x in reorderer.reorder(objects)]
+        self.assertEqual(result, [1, 2, 3])
+        self.assertEqual(reorderer.orphans, [2])
+        self.assertEqual(reorderer.cycles, [])
+
+    def test_cycles(self):
+        objects = [
+            {'id': 4, 'parent': 3},
+            {'id': 3, 'parent': 2},
+            {'id': 2, 'parent': 3},
+            {'id': 1, 'parent': 1},
+            {'id': 5, 'parent': None},
+        ]
+        reorderer = Reorderer()
+        result = [x['id'] for x in reorderer.reorder(objects)]
+        self.assertEqual(result[0], 5)
+        self.assertEqual(sorted(result), [1, 2, 3, 4, 5])
+        self.assertLess(result.index(3), result.index(4))
+        self.assertEqual(sorted(reorderer.cycles), [1, 2, 3, 4])
+        self.assertEqual(reorderer.orphans, [])
+
+
+class TestGetSelfReferences(SimpleTestCase):
+    def test_get_self_references(self):
+        self.assertEqual(
+            sorted(get_self_references(models.PoliticalDivision)),
+            ['parent', 'political_division'])
+        self.assertEqual(get_self_references(models.WaterDivision),
+                         ['water_division'])
+        self.assertEqual(get_self_references(models.Station), [])
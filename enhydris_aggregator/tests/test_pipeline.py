@@ -0,0 +1,83 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from enhydris_aggregator.pipeline import Pipeline
+
+
+class TestPipeline(SimpleTestCase):
+    def consume(self, pipeline):
+        return [(stream, list(rows)) for stream, rows in pipeline]
+
+    def test_order(self):
+        streams = [range(5), range(0), range(10, 13)]
+        for depth in (0, 1, 4):
+            with self.subTest(depth=depth):
+                with Pipeline([streams[:2], streams[2:]], depth,
+                              2) as pipeline:
+                    self.assertEqual(self.consume(pipeline), [
+                        (streams[0], [0, 1, 2, 3, 4]),
+                        (streams[1], []),
+                        (streams[2], [10, 11, 12]),
+                    ])
+
+    def test_ready_first(self):
+        class Stream(list):
+            def __init__(self, items, ready):
+                super().__init__(items)
+                self.ready = ready
+
+        slow = Stream([1], lambda: done.is_set())
+        fast = Stream([2], lambda: True)
+        last = Stream([3], lambda: True)
+        for depth in (0, 2):
+            with self.subTest(depth=depth):
+                done = threading.Event()
+                with Pipeline([[slow, fast], [last]], depth, 1) as pipeline:
+                    result = []
+                    for stream, rows in pipeline:
+                        result.extend(rows)
+                        done.set()
+                self.assertEqual(result, [2, 1, 3])
+
+    def test_produces_ahead(self):
+        # While the first stream is being consumed, the second one is
+        # produced, up to depth batches
+        produced = []
+        second_started = threading.Event()
+
+        def second():
+            second_started.set()
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        with Pipeline([[range(1)], [second()]], 3, 1) as pipeline:
+            pipeline = iter(pipeline)
+            stream, rows = next(pipeline)
+            self.assertTrue(second_started.wait(5))
+            self.assertEqual(list(rows), [0])
+            self.assertLess(len(produced), 10)
+            stream, rows = next(pipeline)
+            self.assertEqual(list(rows), list(range(100)))
+
+    def test_exception(self):
+        def failing():
+            yield 1
+            raise ValueError('Invalid JSON')
+
+        for depth in (0, 2):
+            with self.subTest(depth=depth):
+                with Pipeline([[range(3)], [failing()]], depth,
+                              1) as pipeline:
+                    pipeline = iter(pipeline)
+                    self.assertEqual(list(next(pipeline)[1]), [0, 1, 2])
+                    rows = next(pipeline)[1]
+                    with self.assertRaisesRegex(ValueError, 'Invalid JSON'):
+                        list(rows)
+
+    def test_consumer_stops(self):
+        with Pipeline([[iter(range(1000000))]], 2, 1) as pipeline:
+            stream, rows = next(iter(pipeline))
+            next(rows)
+        self.assertIsNone(pipeline.thread)
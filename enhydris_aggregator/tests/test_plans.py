@@ -0,0 +1,47 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.test import SimpleTestCase
+
+from enhydris.hcore import models
+
+from enhydris_aggregator.plans import get_plan, TransformPlan
+
+from .mocks import mock_responses
+
+
+class TestTransformPlan(SimpleTestCase):
+    def test_timeseries(self):
+        item = dict(mock_responses['Timeseries/9207/'])
+        row, many_to_many = get_plan(models.Timeseries, item).apply(item,
+                                                                    10000)
+        self.assertEqual(row['id'], 19207)
+        self.assertEqual(row['gentity_id'], 11360)
+        self.assertIsNone(row['instrument_id'])
+        self.assertEqual(row['name'], 'Air temperature')
+        self.assertEqual(row['timestamp_offset_minutes'], 0)
+        self.assertIsNone(row['timestamp_rounding_minutes'])
+        for key in ('datafile', 'last_modified', 'nominal_offset_minutes',
+                    'gentity'):
+            self.assertNotIn(key, row)
+        self.assertEqual(many_to_many, {})
+
+        # The item is not modified
+        self.assertEqual(item, mock_responses['Timeseries/9207/'])
+
+    def test_many_to_many(self):
+        item = mock_responses['Station/1360/']
+        row, many_to_many = get_plan(models.Station, item).apply(item, 10000)
+        self.assertEqual(many_to_many,
+                         {'stype': [10002], 'overseers': [],
+                          'maintainers': []})
+        self.assertEqual(row['owner_id'], 10009)
+        self.assertNotIn('is_active', row)
+
+    def test_cache(self):
+        item = mock_responses['Variable/5683/']
+        plan = get_plan(models.Variable, item)
+        self.assertIs(get_plan(models.Variable, dict(item)), plan)
+        self.assertIsNot(get_plan(models.Variable, {'id': 1}), plan)
+
+    def test_unknown_key(self):
+        with self.assertRaises(FieldDoesNotExist):
+            TransformPlan(models.Variable, ['id', 'nonexistent'])
@@ -0,0 +1,76 @@
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import override_settings, TestCase
+
+from enhydris.hcore import models
+
+from enhydris_aggregator.management.commands.aggregate import Command
+from enhydris_aggregator.purge import find_dangling, purge, purge_and_verify
+
+from .mocks import start_mock_server
+
+
+class TestPurge(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mock_server_port = start_mock_server()
+
+    def setUp(self):
+        config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(self.mock_server_port),
+                'ID_OFFSET': 10000,
+            }, {
+                'URL': 'http://localhost:{}/'.format(self.mock_server_port),
+                'ID_OFFSET': 20000,
+            }],
+        }
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            call_command('aggregate')
+
+    def test_purge(self):
+        purge(Command.model_names, 20000, 29999)
+        self.assertEqual(find_dangling(Command.model_names, 20000, 29999), [])
+        self.assertEqual(models.Station.objects.count(), 2)
+        self.assertEqual(models.Gentity.objects.filter(id__gte=20000).count(),
+                         0)
+        self.assertEqual(models.Lentity.objects.filter(id__gte=20000).count(),
+                         0)
+        self.assertEqual(
+            models.Station.stype.through.objects.filter(
+                station_id__gte=20000).count(), 0)
+        self.assertEqual(models.Timeseries.objects.count(), 2)
+        self.assertEqual(models.Station.objects.get(pk=11403).stype.count(),
+                         1)
+
+    def test_partial_purge(self):
+        model_names = ['Station', 'GentityAltCode', 'GentityFile',
+                       'GentityEvent', 'Overseer', 'Instrument', 'Timeseries']
+        purge_and_verify(model_names, 20000, 29999)
+        self.assertFalse(models.Station.objects.filter(id__gte=20000).exists())
+        self.assertEqual(
+            models.PoliticalDivision.objects.filter(id__gte=20000).count(), 4)
+        self.assertEqual(models.Gentity.objects.filter(id__gte=20000).count(),
+                         7)
+
+    def test_dangling(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                purge_and_verify(['PoliticalDivision'], 20000, 29999)
+
+    def test_aggregate(self):
+        config = {
+            'SOURCE_DATABASES': [{
+                'URL': 'http://localhost:{}/'.format(self.mock_server_port),
+                'ID_OFFSET': 10000,
+            }],
+            'PURGE': 'sql',
+        }
+        models.Station.objects.filter(id=11403).update(name='Modified')
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            call_command('aggregate', force=True)
+        self.assertEqual(models.Station.objects.count(), 2)
+        self.assertEqual(models.Station.objects.get(pk=11403).name,
+                         'Agios Spiridonas')
+        self.assertEqual(models.Timeseries.objects.count(), 2)
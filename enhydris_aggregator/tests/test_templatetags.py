@@ -1,9 +1,15 @@
 import sys
 
 from django.core.management import call_command
-from django.test import override_settings, TestCase
+from django.template import Context, Template
+from django.test import override_settings, SimpleTestCase, TestCase
+
+from enhydris.hcore.models import Timeseries
 
 from enhydris_aggregator.management.commands import aggregate
+from enhydris_aggregator.models import OriginatingUrl
+from enhydris_aggregator.sources import (get_originating_url,
+                                         get_originating_urls, SourceRanges)
 
 from .mocks import start_mock_server
 
@@ -56,3 +62,98 @@ class TestGetOriginatingUrl(TestCase):
             r,
             'http://localhost:{}/timeseries/d/9206/'.format(_mock_server_port),
         )
+
+    def test_with_originating_urls(self):
+        template = Template(
+            '{% load originating %}'
+            '{% for timeseries, url in '
+            'timeseries_list|with_originating_urls %}'
+            '{{ timeseries.id }} {{ url }};{% endfor %}')
+        timeseries_list = Timeseries.objects.filter(
+            id__in=(19206, 29206)).order_by('id')
+        self.assertEqual(
+            template.render(Context({'timeseries_list': timeseries_list})),
+            '19206 http://localhost:{0}/timeseries/d/9206/;'
+            '29206 http://localhost:{0}/timeseries/d/9206/;'.format(
+                _mock_server_port))
+
+    def test_get_originating_urls(self):
+        template = Template(
+            '{% load originating %}'
+            '{% get_originating_urls ids as urls %}{{ urls|length }}')
+        self.assertEqual(
+            template.render(Context({'ids': [19206, 39206, 42]})), '3')
+
+
+@override_settings(ENHYDRIS_AGGREGATOR=dict(_config,
+                                            STORE_ORIGINATING_URLS=True))
+class TestStoreOriginatingUrls(TestCase):
+
+    def test_store_originating_urls(self):
+        call_command('aggregate')
+        self.assertEqual(OriginatingUrl.objects.count(),
+                         Timeseries.objects.count())
+        self.assertEqual(
+            OriginatingUrl.objects.get(timeseries_id=29206).url,
+            'http://localhost:{}/timeseries/d/9206/'.format(_mock_server_port))
+
+        # The stored URLs are used instead of being computed
+        OriginatingUrl.objects.filter(timeseries_id=29206).update(url='x')
+        urls = get_originating_urls(Timeseries.objects.filter(id=29206))
+        self.assertEqual(urls, {29206: 'x'})
+        self.assertEqual(get_originating_url(29206), 'x')
+
+        # Including by the time series page
+        r = self.client.get('/timeseries/d/29206/')
+        self.assertEqual(r.status_code, 200)
+        self.assertContains(r, "<a href='x'>")
+
+        # Deleting the time series also deletes the URLs
+        c = aggregate.Command()
+        c.delete_from_database(0, sys.maxsize)
+        self.assertFalse(OriginatingUrl.objects.exists())
+
+
+class TestSourceRanges(SimpleTestCase):
+    source_databases = [
+        {'URL': 'http://b.com/', 'ID_OFFSET': 2000},
+        {'URL': 'http://a.com/', 'ID_OFFSET': 1000},
+    ]
+
+    def test_find(self):
+        source_ranges = SourceRanges(self.source_databases)
+        self.assertIsNone(source_ranges.find(999))
+        self.assertEqual(source_ranges.find(1000)['URL'], 'http://a.com/')
+        self.assertEqual(source_ranges.find(1999)['URL'], 'http://a.com/')
+        self.assertEqual(source_ranges.find(2000)['URL'], 'http://b.com/')
+        self.assertEqual(source_ranges.find(sys.maxsize)['URL'],
+                         'http://b.com/')
+
+    def test_find_all(self):
+        self.assertEqual(
+            [(id, x and x['URL']) for id, x
+             in SourceRanges(self.source_databases).find_all(
+                 [2500, 5, 1000, 1999])],
+            [(5, None), (1000, 'http://a.com/'), (1999, 'http://a.com/'),
+             (2500, 'http://b.com/')])
+
+    def test_ranges(self):
+        self.assertEqual(
+            [(s['URL'], min_id, max_id) for s, min_id, max_id
+             in SourceRanges(self.source_databases).ranges()],
+            [('http://a.com/', 1000, 1999),
+             ('http://b.com/', 2000, sys.maxsize)])
+
+    def test_get_originating_url(self):
+        config = {'SOURCE_DATABASES': self.source_databases}
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            self.assertEqual(get_originating_url(2000),
+                             'http://b.com/timeseries/d/0/')
+            self.assertIsNone(get_originating_url(42))
+            self.assertEqual(get_originating_urls([42, 1001]), {
+                42: None, 1001: 'http://a.com/timeseries/d/1/'})
+
+        # The cached ranges are invalidated when the setting changes
+        config = {'SOURCE_DATABASES': self.source_databases[:1]}
+        with override_settings(ENHYDRIS_AGGREGATOR=config):
+            self.assertIsNone(get_originating_url(1500))
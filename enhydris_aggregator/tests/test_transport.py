@@ -0,0 +1,71 @@
+from django.test import SimpleTestCase
+
+import requests
+
+from enhydris_aggregator.fetch import fetch_objects
+from enhydris_aggregator.transport import Session
+
+from .mocks import flaky_paths, start_mock_server
+
+
+class TestSession(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.source_db = {
+            'URL': 'http://localhost:{}/'.format(start_mock_server()),
+            'ID_OFFSET': 10000,
+            'RETRIES': 2,
+            'BACKOFF_FACTOR': 0,
+        }
+
+    def tearDown(self):
+        flaky_paths.clear()
+
+    def test_timeout(self):
+        session = Session(dict(self.source_db, CONNECT_TIMEOUT=5,
+                               READ_TIMEOUT=60))
+        self.assertEqual(session.timeout, (5, 60))
+
+    def test_retry(self):
+        flaky_paths['Variable/'] = 2
+        session = Session(self.source_db)
+        objects = list(fetch_objects(self.source_db, 'Variable', session))
+        self.assertEqual(objects[0]['descr'], 'Temperature')
+
+    def test_too_many_failures(self):
+        flaky_paths['Variable/'] = 3
+        session = Session(self.source_db)
+        with self.assertRaises(requests.RequestException):
+            fetch_objects(self.source_db, 'Variable', session)
+
+    def test_interval_type_unavailable(self):
+        # If IntervalType keeps failing with 503 after the retries, the
+        # known interval types are used instead, as with a 404 (the mock
+        # server has only one).
+        flaky_paths['IntervalType/'] = 3
+        session = Session(self.source_db)
+        objects = list(fetch_objects(self.source_db, 'IntervalType', session))
+        self.assertEqual(flaky_paths['IntervalType/'], 0)
+        self.assertEqual(len(objects), 5)
+
+    def test_error_closes_response(self):
+        # Otherwise the connection would not be returned to the pool until
+        # the response is garbage collected
+        session = Session(self.source_db)
+        with self.assertRaises(requests.HTTPError) as cm:
+            fetch_objects(self.source_db, 'Nonexistent', session)
+        self.assertTrue(cm.exception.response.raw.closed)
+
+    def test_conditional_get(self):
+        session = Session(self.source_db)
+        result = fetch_objects(self.source_db, 'Variable', session)
+        self.assertFalse(result.not_modified)
+        self.assertTrue(result.etag)
+        self.assertEqual(len(result.content_hash), 64)
+        result.close()
+
+        result = fetch_objects(self.source_db, 'Variable', session,
+                               etag=result.etag)
+        self.assertTrue(result.not_modified)
+        self.assertEqual(list(result), [])
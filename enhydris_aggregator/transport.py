@@ -0,0 +1,90 @@
+"""HTTP sessions for talking to the source databases.
+
+Each source database gets its own requests session, so that connections
+are kept alive and reused. The session behaviour can be configured with
+the following optional keys of each entry of SOURCE_DATABASES:
+
+CONNECT_TIMEOUT, READ_TIMEOUT
+    Timeouts in seconds for connecting and for waiting for data (default
+    10 and 300).
+
+RETRIES
+    How many times to retry a request that failed because of a connection
+    error, a timeout or a 5xx status (default 3).
+
+BACKOFF_FACTOR
+    Retries are made after BACKOFF_FACTOR * 2 ** (n - 1) seconds, where n
+    is the number of the retry (default 1).
+"""
+
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+DEFAULTS = {
+    'CONNECT_TIMEOUT': 10,
+    'READ_TIMEOUT': 300,
+    'RETRIES': 3,
+    'BACKOFF_FACTOR': 1,
+}
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def get_option(source_db, name):
+    return source_db.get(name, DEFAULTS[name])
+
+
+class Session(requests.Session):
+    """A requests session with default timeouts and retries."""
+
+    def __init__(self, source_db, pool_size=10):
+        super().__init__()
+        self.timeout = (get_option(source_db, 'CONNECT_TIMEOUT'),
+                        get_option(source_db, 'READ_TIMEOUT'))
+        self.retries = get_option(source_db, 'RETRIES')
+        self.backoff_factor = get_option(source_db, 'BACKOFF_FACTOR')
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+    def download(self, url, f, chunk_size, headers=None):
+        """Download url to binary file f and return the response.
+
+        Raises requests.HTTPError if the response status is an error, or
+        requests.exceptions.RetryError if it is still one of RETRY_STATUSES
+        after the retries. Failures while reading the response body, which
+        the adapter does not retry, are retried here by downloading again
+        from the beginning. A response that fails is closed, so that its
+        connection is returned to the pool.
+        """
+        attempt = 0
+        while True:
+            r = self.get(url, stream=True, headers=headers)
+            try:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size):
+                    f.write(chunk)
+                return r
+            except (requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError):
+                r.close()
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff_factor * 2 ** attempt)
+                attempt += 1
+                f.seek(0)
+                f.truncate()
+            except Exception:
+                r.close()
+                raise
@@ -0,0 +1,253 @@
+"""Backends that write the transformed rows to the target database.
+
+The aggregate command transforms the objects it fetches from a source
+database to (item, many_to_many) tuples (see
+Command.transform_object()), and then hands them over to a writer. The
+writer is selected with the WRITER setting of ENHYDRIS_AGGREGATOR:
+
+orm
+    One INSERT per object, with Django's save(); this is slow, but it is
+    the only writer that sends the model signals.
+
+bulk
+    One INSERT per batch of objects (the default).
+
+copy
+    One "COPY ... FROM STDIN" per batch of objects; this is the fastest,
+    but it is available on PostgreSQL only. On other databases the bulk
+    writer is used instead.
+"""
+
+from io import StringIO
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.db.models import AutoField
+
+
+def bulk_insert(model, instances):
+    """Insert model instances using one INSERT query per table.
+
+    This is similar to model.objects.bulk_create(instances), except that it
+    also works for multi-table inherited models such as Station, in which
+    case the tables of the ancestors are filled in first. The instances must
+    already have their primary key set. Unlike save(), no signals are sent.
+
+    bulk_create() refuses multi-table inherited models, even if it is
+    called for each table separately, so this uses the manager's _insert(),
+    which is what bulk_create() itself uses to insert each batch.
+    """
+    if not instances:
+        return
+    for m in _set_parent_links(model, instances):
+        using = router.db_for_write(m)
+        fields = m._meta.local_concrete_fields
+
+        # Some backends (e.g. SQLite) limit the number of parameters per query
+        max_batch_size = connections[using].ops.bulk_batch_size(
+            fields, instances)
+        for batch in batches(instances, max(max_batch_size, 1)):
+            m._base_manager._insert(batch, fields=fields, using=using)
+
+
+def _set_parent_links(model, instances):
+    """Set the parent link fields of multi-table inherited instances.
+
+    Returns the list of concrete models whose tables must be filled in, in
+    the order in which they must be filled in (ancestors first).
+    """
+    concrete_models = [model] + model._meta.get_parent_list()
+    root_pk_attname = concrete_models[-1]._meta.pk.attname
+    for instance in instances:
+        pk = getattr(instance, root_pk_attname)
+        for m in concrete_models:
+            for parent_link in m._meta.parents.values():
+                setattr(instance, parent_link.attname, pk)
+    return list(reversed(concrete_models))
+
+
+def batches(rows, batch_size):
+    """Split an iterable into lists of at most batch_size elements."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class Writer:
+    name = None
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+    def write(self, model, rows):
+        """Insert rows to the database and return their number.
+
+        rows is an iterable of (item, many_to_many) tuples, as returned by
+        Command.transform_object().
+        """
+        raise NotImplementedError
+
+    def get_through_objects(self, model, rows):
+        """Return the rows of the auto-created many-to-many tables.
+
+        The result is a dictionary that maps each through model to a list
+        of its (unsaved) instances.
+        """
+        through_objects = {}
+        for item, many_to_many in rows:
+            for m2m in many_to_many:
+                field = model._meta.get_field(m2m)
+
+                # Skip relationships with "through", they are taken care of
+                # elsewhere
+                through = field.rel.through
+                if not through._meta.auto_created:
+                    continue
+
+                source_attname = field.m2m_field_name() + '_id'
+                target_attname = field.m2m_reverse_field_name() + '_id'
+                through_objects.setdefault(through, []).extend([
+                    through(**{source_attname: item['id'],
+                               target_attname: m2m_item})
+                    for m2m_item in many_to_many[m2m]
+                ])
+        return through_objects
+
+    def update(self, model, rows):
+        """Overwrite existing rows of the database.
+
+        rows is like in write(), but the ids must already exist in the
+        database. The many-to-many relationships mentioned in the rows
+        replace the existing ones.
+        """
+        for item, many_to_many in rows:
+            model(**item).save(force_update=True)
+
+        ids = [item['id'] for item, many_to_many in rows]
+        m2m_names = set()
+        for item, many_to_many in rows:
+            m2m_names.update(many_to_many)
+        for m2m in m2m_names:
+            field = model._meta.get_field(m2m)
+            through = field.rel.through
+            if through._meta.auto_created:
+                through.objects.filter(
+                    **{field.m2m_field_name() + '__in': ids}).delete()
+        for through, objs in self.get_through_objects(model, rows).items():
+            through.objects.bulk_create(objs, batch_size=self.batch_size)
+
+
+class OrmWriter(Writer):
+    name = 'orm'
+
+    def write(self, model, rows):
+        count = 0
+        for item, many_to_many in rows:
+            count += 1
+            new_model_instance = model(**item)
+            new_model_instance.save()
+
+            for m2m in many_to_many:
+                field = model._meta.get_field(m2m)
+                if field.rel.through._meta.auto_created:
+                    getattr(new_model_instance, m2m).add(*many_to_many[m2m])
+        return count
+
+
+class BulkWriter(Writer):
+    name = 'bulk'
+
+    def write(self, model, rows):
+        count = 0
+        for batch in batches(rows, self.batch_size):
+            count += len(batch)
+            self.insert(model, [model(**item) for item, m2m in batch])
+            through_objects = self.get_through_objects(model, batch)
+            for through, objs in through_objects.items():
+                self.insert(through, objs)
+        return count
+
+    def insert(self, model, instances):
+        if model._meta.auto_created:
+            model.objects.bulk_create(instances)
+        else:
+            bulk_insert(model, instances)
+
+
+class CopyWriter(BulkWriter):
+    name = 'copy'
+
+    def insert(self, model, instances):
+        if not instances:
+            return
+        connection = connections[router.db_for_write(model)]
+        qn = connection.ops.quote_name
+        if model._meta.auto_created:
+            concrete_models = [model]
+        else:
+            concrete_models = _set_parent_links(model, instances)
+        for m in concrete_models:
+            # The ids of the auto-created many-to-many tables are left to
+            # the database, as with bulk_create().
+            fields = [f for f in m._meta.local_concrete_fields
+                      if not (m._meta.auto_created and
+                              isinstance(f, AutoField))]
+            data = StringIO()
+            for instance in instances:
+                data.write('\t'.join(
+                    _copy_text(f, instance, connection) for f in fields))
+                data.write('\n')
+            data.seek(0)
+            sql = 'COPY {} ({}) FROM STDIN'.format(
+                qn(m._meta.db_table), ', '.join(qn(f.column) for f in fields))
+            with connection.cursor() as cursor:
+                cursor.copy_expert(sql, data)
+
+
+def _copy_text(field, instance, connection):
+    """Return the value of a field in the text format of COPY."""
+    value = field.pre_save(instance, add=True)
+    if hasattr(field, 'geom_type'):
+        # Geometries are passed as hex-encoded EWKB, which PostGIS accepts
+        # as input.
+        value = field.get_prep_value(value)
+        if value is None:
+            return r'\N'
+        value = value.hexewkb
+        return value.decode('ascii') if isinstance(value, bytes) else value
+    value = field.get_db_prep_save(value, connection=connection)
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+writers = {w.name: w for w in (OrmWriter, BulkWriter, CopyWriter)}
+
+
+def get_writer(batch_size, name=None, using='default'):
+    """Return the writer specified in the settings.
+
+    If name is specified, it overrides the WRITER setting. If the "copy"
+    writer is requested but the database is not PostgreSQL, the "bulk"
+    writer is returned instead.
+    """
+    if name is None:
+        name = settings.ENHYDRIS_AGGREGATOR.get('WRITER', BulkWriter.name)
+    try:
+        writer_class = writers[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            'ENHYDRIS_AGGREGATOR["WRITER"] must be one of {}; got "{}"'
+            .format(', '.join(sorted(writers)), name))
+    if writer_class is CopyWriter and \
+            connections[using].vendor != 'postgresql':
+        writer_class = BulkWriter
+    return writer_class(batch_size)